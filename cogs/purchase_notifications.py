@@ -3,22 +3,115 @@ from discord.ext import commands
 from discord import app_commands
 import os
 import json
+import time
+import asyncio
+import bisect
+import aiohttp
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List, Dict, Any, Tuple, Callable
+from .vm_management import vm_registry
+
+# ===============================================
+# 0. NotificationConfigCache (ギルドごとの通知設定のプロセス内キャッシュ)
+# ===============================================
+NOTIFICATION_CONFIG_DIR = "notification_config"
+# キャッシュ済みの設定ファイルの更新日時を確認する間隔 (秒)
+CONFIG_RECHECK_INTERVAL = 30.0
+
+
+class NotificationConfigCache:
+    """notification_config/{guild_id}/config.json をギルドごとに1回だけ読み込むキャッシュ
+
+    保存 (/vmnote_set) 時はキャッシュを直接更新する。手作業での編集などに備え、
+    CONFIG_RECHECK_INTERVAL 秒ごとにファイルの更新日時だけを確認し、変わっていれば読み直す。
+    それ以外の参照 (購入のたびの通知) ではファイルシステムに触れない。
+    返す辞書は共有されているため、呼び出し側で書き換えないこと。
+    """
+    def __init__(self):
+        # {guild_id: (設定, 読み込み時の mtime, 最後に確認した時刻)}
+        self._entries: Dict[str, Tuple[dict, Optional[float], float]] = {}
+        # {(guild_id, 名前): (元にした設定, 作成した値)} 設定から作った値 (ルーティング表など)
+        self._derived: Dict[Tuple[str, str], Tuple[dict, Any]] = {}
+
+    @staticmethod
+    def config_path(guild_id) -> str:
+        return os.path.join(NOTIFICATION_CONFIG_DIR, str(guild_id), "config.json")
+
+    @classmethod
+    def _mtime(cls, guild_id) -> Optional[float]:
+        try:
+            return os.stat(cls.config_path(guild_id)).st_mtime
+        except OSError:
+            return None
+
+    @classmethod
+    def _read(cls, guild_id) -> dict:
+        try:
+            with open(cls.config_path(guild_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"⚠️ 警告: 通知設定 {cls.config_path(guild_id)} が読み込めません: {e}")
+            return {}
+
+    def get(self, guild_id) -> dict:
+        key = str(guild_id)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and now - entry[2] < CONFIG_RECHECK_INTERVAL:
+            return entry[0]
+        mtime = self._mtime(key)
+        if entry is not None and entry[1] == mtime:
+            self._entries[key] = (entry[0], mtime, now)
+            return entry[0]
+        config = self._read(key)
+        self._entries[key] = (config, mtime, now)
+        return config
+
+    def save(self, guild_id, config: dict):
+        """設定を保存し、キャッシュを更新する"""
+        key = str(guild_id)
+        path = self.config_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(config, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+        self._entries[key] = (dict(config), self._mtime(key), time.monotonic())
+
+    def derived(self, guild_id, name: str, builder: Callable[[dict], Any]) -> Any:
+        """設定から作る値を、設定が変わるまで (キャッシュの辞書が置き換わるまで) 使い回す"""
+        config = self.get(guild_id)
+        key = (str(guild_id), name)
+        cached = self._derived.get(key)
+        if cached is None or cached[0] is not config:
+            cached = (config, builder(config))
+            self._derived[key] = cached
+        return cached[1]
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self._entries.clear()
+            self._derived.clear()
+        else:
+            self._entries.pop(str(guild_id), None)
+
+
+# プロセス全体で共有するキャッシュ (notification_utils.py からも使用)
+notification_config_cache = NotificationConfigCache()
+
 
 # ===============================================
 # 1. PurchaseNotificationManager クラス (設定ファイルの読み書き)
 # ===============================================
 class PurchaseNotificationManager:
-    """通知チャンネルの設定を管理するクラス"""
+    """通知チャンネルの設定を管理するクラス (読み込みは notification_config_cache 経由)"""
     def __init__(self, guild_id):
         self.guild_id = str(guild_id)
-        # 設定を保存するディレクトリ
-        self.config_dir = os.path.join("notification_config", self.guild_id)
+        # 設定を保存するディレクトリ (保存時に作成する)
+        self.config_dir = os.path.join(NOTIFICATION_CONFIG_DIR, self.guild_id)
         self.config_file = os.path.join(self.config_dir, "config.json")
-        
-        if not os.path.exists(self.config_dir):
-            os.makedirs(self.config_dir)
     
     def set_notification_channel(self, channel_id: int):
         """通知チャンネルを設定"""
@@ -27,53 +120,170 @@ class PurchaseNotificationManager:
         self._save_config(config)
     
     def get_notification_channel_id(self) -> Optional[str]:
-        """通知チャンネルIDを取得"""
+        """通知チャンネルIDを取得 (キャッシュ参照のみ)"""
+        return notification_config_cache.get(self.guild_id).get("notification_channel_id")
+    
+    def set_digest_window(self, seconds: int):
+        """ダイジェストモードのまとめる時間 (秒) を設定 (0で無効)"""
         config = self._load_config()
-        return config.get("notification_channel_id")
+        config["digest_window"] = seconds
+        self._save_config(config)
+
+    def get_digest_window(self) -> float:
+        """ダイジェストモードのまとめる時間 (秒)。無効なら0 (キャッシュ参照のみ)"""
+        return float(notification_config_cache.get(self.guild_id).get("digest_window", 0) or 0)
     
+    def set_webhook_delivery(self, enabled: bool, name: Optional[str] = None, avatar_url: Optional[str] = None):
+        """Webhook経由での通知を設定 (名前・アイコンは省略時はBotと同じ)"""
+        config = self._load_config()
+        config["delivery"] = "webhook" if enabled else "channel"
+        config["webhook_name"] = name
+        config["webhook_avatar_url"] = avatar_url
+        self._save_config(config)
+
+    def get_webhook_settings(self) -> Optional[Dict[str, Any]]:
+        """Webhook経由の場合は {"name", "avatar_url", "urls"}、チャンネル直接送信なら None (キャッシュ参照のみ)"""
+        config = notification_config_cache.get(self.guild_id)
+        if config.get("delivery") != "webhook":
+            return None
+        return {
+            "name": config.get("webhook_name"),
+            "avatar_url": config.get("webhook_avatar_url"),
+            "urls": config.get("webhook_urls", {}),
+        }
+
+    def set_webhook_url(self, channel_id, url: Optional[str]):
+        """Botが作成したチャンネルのWebhook URLを記録 (None で削除)"""
+        config = self._load_config()
+        urls = dict(config.get("webhook_urls", {}))
+        if url:
+            urls[str(channel_id)] = url
+        else:
+            urls.pop(str(channel_id), None)
+        config["webhook_urls"] = urls
+        self._save_config(config)
+
+    def get_routes(self) -> List[Dict[str, Any]]:
+        """通知のルーティングルール一覧 (キャッシュ参照のみ)"""
+        return list(notification_config_cache.get(self.guild_id).get("routes", []))
+
+    def add_route(self, route: Dict[str, Any]):
+        config = self._load_config()
+        config["routes"] = list(config.get("routes", [])) + [route]
+        self._save_config(config)
+
+    def remove_route(self, index: int) -> Optional[Dict[str, Any]]:
+        config = self._load_config()
+        routes = list(config.get("routes", []))
+        if not 0 <= index < len(routes):
+            return None
+        removed = routes.pop(index)
+        config["routes"] = routes
+        self._save_config(config)
+        return removed
+
+    def get_router(self) -> 'NotificationRouter':
+        """コンパイル済みのルーティング表 (設定が変わったときだけ作り直す)"""
+        return notification_config_cache.derived(self.guild_id, "router", NotificationRouter.from_config)
+
     def _load_config(self) -> dict:
-        """設定ファイルを読み込み"""
-        if os.path.exists(self.config_file):
-            try:
-                with open(self.config_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except:
-                pass
-        return {}
+        """設定を読み込み (キャッシュのコピーを返す)"""
+        return dict(notification_config_cache.get(self.guild_id))
     
     def _save_config(self, config):
-        """設定ファイルに保存"""
-        with open(self.config_file, "w", encoding="utf-8") as f:
-            json.dump(config, f, ensure_ascii=False, indent=4)
+        """設定ファイルに保存 (キャッシュも更新)"""
+        notification_config_cache.save(self.guild_id, config)
 
 
 # ===============================================
-# 2. send_purchase_notification 関数 (通知送信のユーティリティ)
+# 1.5 NotificationRouter (通知先のルーティング表)
 # ===============================================
-async def send_purchase_notification(
-    bot: commands.Bot, 
-    guild_id: int, 
-    user_id: int, 
-    product_name: str, 
-    price: int, 
-    item_content: str
-):
-    """購入通知を通知チャンネルに送信する"""
-    notification_manager = PurchaseNotificationManager(guild_id)
-    channel_id = notification_manager.get_notification_channel_id()
-    
-    if not channel_id:
-        return  # 通知チャンネルが設定されていない場合は何もしない
-    
-    channel = bot.get_channel(int(channel_id))
-    if not channel:
-        return  # チャンネルが見つからない場合は何もしない
+class NotificationRouter:
+    """ルーティングルールを参照表にコンパイルしたもの
+
+    ルール: {"vm_id"?, "product"?, "min_price"?, "max_price"?, "role_id"?,
+             "channel_id" または "webhook_url"} (省略した条件は「すべて」)
+
+    (VM, 商品) の組 (それぞれ指定あり/なし) ごとに、価格の境界値で区切った区間表を作り、
+    各区間に {ロールID (なしは None): [(ルール番号, 通知先), ...]} を持たせておく。
+    購入時は4通りの (VM, 商品) キーを辞書で引き、価格の区間を二分探索し、
+    購入者のロールで辞書を引くだけで、ルールの条件は評価しない。
+    一致したルールの通知先すべてに (ルール順・重複なしで) 送る。
+    """
+    def __init__(self, routes: List[Dict[str, Any]]):
+        self.has_role_rules = any(route.get("role_id") for route in routes)
+        # {(vm_id | None, product | None): (境界値リスト, [区間ごとの {role_id | None: [(番号, 通知先)]}])}
+        self._tables: Dict[Tuple[Optional[str], Optional[str]], Tuple[List[int], List[Dict[Optional[str], List[Tuple[int, Dict[str, str]]]]]]] = {}
 
+        grouped: Dict[Tuple[Optional[str], Optional[str]], List[Tuple[int, Dict[str, Any]]]] = {}
+        for index, route in enumerate(routes):
+            destination = self._destination(route)
+            if destination is None:
+                continue
+            key = (route.get("vm_id") or None, route.get("product") or None)
+            grouped.setdefault(key, []).append((index, route))
+
+        for key, rules in grouped.items():
+            # 価格 p は segments[bisect_right(bounds, p)] に入る
+            bounds = sorted(
+                {route["min_price"] for _, route in rules if route.get("min_price") is not None}
+                | {route["max_price"] + 1 for _, route in rules if route.get("max_price") is not None}
+            )
+            segments: List[Dict[Optional[str], List[Tuple[int, Dict[str, str]]]]] = [{} for _ in range(len(bounds) + 1)]
+            for index, route in rules:
+                first = bisect.bisect_right(bounds, route["min_price"]) if route.get("min_price") is not None else 0
+                last = bisect.bisect_right(bounds, route["max_price"]) if route.get("max_price") is not None else len(bounds)
+                role = str(route["role_id"]) if route.get("role_id") else None
+                for segment in segments[first:last + 1]:
+                    segment.setdefault(role, []).append((index, self._destination(route)))
+            self._tables[key] = (bounds, segments)
+
+    @staticmethod
+    def _destination(route: Dict[str, Any]) -> Optional[Dict[str, str]]:
+        if route.get("webhook_url"):
+            return {"webhook_url": route["webhook_url"]}
+        if route.get("channel_id"):
+            return {"channel_id": str(route["channel_id"])}
+        return None
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'NotificationRouter':
+        return cls(config.get("routes", []))
+
+    def __bool__(self) -> bool:
+        return bool(self._tables)
+
+    def route(self, vm_id: Optional[str], products: List[str], price: int, role_ids: List[str]) -> List[Dict[str, str]]:
+        """購入に一致する通知先の一覧 (ルール順、重複なし)"""
+        hits: Dict[int, Dict[str, str]] = {}
+        for vm_key in ({vm_id, None} if vm_id else {None}):
+            for product_key in (*products, None):
+                table = self._tables.get((vm_key, product_key))
+                if table is None:
+                    continue
+                bounds, segments = table
+                segment = segments[bisect.bisect_right(bounds, price)]
+                for role in (None, *role_ids):
+                    for index, destination in segment.get(role, ()):
+                        hits[index] = destination
+        destinations, seen = [], set()
+        for index in sorted(hits):
+            key = tuple(hits[index].items())
+            if key not in seen:
+                seen.add(key)
+                destinations.append(hits[index])
+        return destinations
+
+
+# ===============================================
+# 2. send_purchase_notification 関数 (通知送信のユーティリティ)
+# ===============================================
+def _build_purchase_embed(bot: commands.Bot, guild_id: int, user_id: int, product_name: str, price: int) -> discord.Embed:
+    """購入1件分の通知埋め込みを作成"""
     guild = bot.get_guild(int(guild_id))
     user = guild.get_member(int(user_id)) if guild else None
     user_mention = user.mention if user else f"<@{user_id}>"
     
-    # 購入通知埋め込みを作成
     embed = discord.Embed(
         title="自動販売機",
         description=f"商品が購入されました。購入者にはDMでアイテムが送られます。",
@@ -84,29 +294,372 @@ async def send_purchase_notification(
     embed.add_field(name="購入者", value=user_mention, inline=False)
     embed.add_field(name="購入金額", value=f"```{price:,}円```", inline=False)
     embed.add_field(name="商品", value=f"```{product_name}```", inline=False)
-    
-    # アイテム内容のプレビュー
-    if len(item_content) > 100:
-        item_preview = item_content[:97] + "..."
-    else:
-        item_preview = item_content
 
     embed.set_footer(
         text="Made by LT",
-        icon_url=bot.user.avatar.url if bot.user.avatar else discord.Embed.Empty
+        icon_url=bot.user.avatar.url if bot.user and bot.user.avatar else None
     )
-    
-    try:
-        await channel.send(embed=embed)
-    except discord.Forbidden:
-        print(f"ERROR: チャンネルID {channel_id} に通知を送信できませんでした (権限不足)。")
-    except Exception as e:
-        print(f"ERROR: 通知送信中に予期せぬエラーが発生しました: {e}")
+    return embed
+
+
+def _truncate_lines(lines: List[str], limit: int = 1024) -> str:
+    """埋め込みフィールドの上限に収まるように行を切り詰める (省略した件数を末尾に付ける)"""
+    text = ""
+    for i, line in enumerate(lines):
+        suffix = f"\n…他 {len(lines) - i} 件"
+        if len(text) + len(line) + 1 + len(suffix) > limit:
+            return text + suffix
+        text += ("\n" if text else "") + line
+    return text or "-"
+
+
+# ===============================================
+# 2.4 WebhookDelivery (Webhook経由の通知送信)
+# ===============================================
+WEBHOOK_DEFAULT_NAME = "自販機通知"
+
+
+class WebhookDelivery:
+    """通知チャンネルごとのWebhookを作成・キャッシュして送信するクラス
+
+    Webhookへの送信はBot本体のレート制限バケットとは別に数えられるため、
+    購入が集中しても応答 (インタラクション) の送信と競合しない。
+    すべてのWebhookは1つの aiohttp セッションを共有し、レート制限ヘッダー
+    (429 / X-RateLimit-*) への待機は discord.py のWebhookアダプターが行う。
+    作成したWebhookのURLは通知設定に保存し、再起動後も使い回す。
+    """
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        # {channel_id または ルールのWebhook URL: discord.Webhook}
+        self._webhooks: Dict[str, discord.Webhook] = {}
+        self._create_lock = asyncio.Lock()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def _get_webhook(self, channel: discord.TextChannel, manager: PurchaseNotificationManager, urls: Dict[str, str]) -> discord.Webhook:
+        key = str(channel.id)
+        webhook = self._webhooks.get(key)
+        if webhook is not None:
+            return webhook
+        async with self._create_lock:
+            webhook = self._webhooks.get(key)
+            if webhook is not None:
+                return webhook
+            url = urls.get(key)
+            if url is None:
+                created = await channel.create_webhook(name=WEBHOOK_DEFAULT_NAME, reason="自販機の購入通知用")
+                url = created.url
+                manager.set_webhook_url(key, url)
+            webhook = discord.Webhook.from_url(url, session=self._get_session())
+            self._webhooks[key] = webhook
+            return webhook
+
+    async def send(self, bot: commands.Bot, channel: discord.TextChannel, manager: PurchaseNotificationManager, settings: Dict[str, Any], embed: discord.Embed):
+        """Webhookで送信する (Webhookが削除されていた場合は作り直して1回だけ再送)"""
+        name = settings.get("name") or (bot.user.name if bot.user else WEBHOOK_DEFAULT_NAME)
+        avatar_url = settings.get("avatar_url") or (bot.user.display_avatar.url if bot.user else None)
+        urls = dict(settings.get("urls", {}))
+        for attempt in range(2):
+            webhook = await self._get_webhook(channel, manager, urls)
+            try:
+                await webhook.send(embed=embed, username=name, avatar_url=avatar_url)
+                return
+            except discord.NotFound:
+                # チャンネル側でWebhookが削除された
+                self._webhooks.pop(str(channel.id), None)
+                urls.pop(str(channel.id), None)
+                manager.set_webhook_url(channel.id, None)
+                if attempt == 1:
+                    raise
+
+    async def send_url(self, bot: commands.Bot, url: str, settings: Optional[Dict[str, Any]], embed: discord.Embed):
+        """ルーティングルールで指定されたWebhook URLへ送信する (作り直しはしない)"""
+        settings = settings or {}
+        name = settings.get("name") or (bot.user.name if bot.user else WEBHOOK_DEFAULT_NAME)
+        avatar_url = settings.get("avatar_url") or (bot.user.display_avatar.url if bot.user else None)
+        webhook = self._webhooks.get(url)
+        if webhook is None:
+            webhook = discord.Webhook.from_url(url, session=self._get_session())
+            self._webhooks[url] = webhook
+        try:
+            await webhook.send(embed=embed, username=name, avatar_url=avatar_url)
+        except discord.NotFound:
+            self._webhooks.pop(url, None)
+            raise
+
+    async def close(self):
+        self._webhooks.clear()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+webhook_delivery = WebhookDelivery()
+
+
+async def _deliver(bot: commands.Bot, channel, manager: PurchaseNotificationManager, embed: discord.Embed):
+    """設定に応じてWebhookまたはチャンネルへ直接送信する"""
+    settings = manager.get_webhook_settings()
+    if settings is not None:
+        try:
+            await webhook_delivery.send(bot, channel, manager, settings, embed)
+            return
+        except discord.Forbidden:
+            # Webhookの管理権限がない場合はチャンネルへ直接送信する
+            print(f"⚠️ 警告: チャンネルID {channel.id} のWebhookを作成できないため、直接送信します (権限不足)。")
+    await channel.send(embed=embed)
+
+
+def _destination_key(destination: Dict[str, str]) -> str:
+    if "webhook_url" in destination:
+        return f"webhook:{destination['webhook_url']}"
+    return f"channel:{destination['channel_id']}"
+
+
+async def _send_to(bot: commands.Bot, manager: PurchaseNotificationManager, destination: Dict[str, str], embed: discord.Embed):
+    """通知先 (チャンネルまたはWebhook URL) へ送信する。チャンネルが見つからない場合は何もしない"""
+    if "webhook_url" in destination:
+        await webhook_delivery.send_url(bot, destination["webhook_url"], manager.get_webhook_settings(), embed)
+        return
+    channel = bot.get_channel(int(destination["channel_id"]))
+    if channel:
+        await _deliver(bot, channel, manager, embed)
+
+
+async def _buyer_role_ids(bot: commands.Bot, guild_id, user_id) -> List[str]:
+    guild = bot.get_guild(int(guild_id))
+    if guild is None:
+        return []
+    member = guild.get_member(int(user_id))
+    if member is None:
+        try:
+            member = await guild.fetch_member(int(user_id))
+        except discord.HTTPException:
+            return []
+    return [str(role.id) for role in member.roles]
+
+
+# ===============================================
+# 2.5 NotificationDigester (購入が集中したときの通知のまとめ送信)
+# ===============================================
+class NotificationDigester:
+    """ダイジェストモードのギルドで、短時間に集中した購入通知を1件にまとめるクラス
+
+    ウィンドウが開いていないときの購入はすぐに通知し、同時に digest_window 秒の
+    ウィンドウを開く。ウィンドウ中の購入は溜めておき、終了時に1件の集計埋め込み
+    (件数・売上・商品別内訳・購入者一覧) として送る。溜まっていた場合は次の
+    ウィンドウを続けて開き、何も来なければウィンドウを閉じる。
+    ウィンドウは通知先 (ルーティング先のチャンネル・Webhook) ごとに開く。
+    """
+    def __init__(self):
+        # {(guild_id, 通知先キー): [購入, ...]} 開いているウィンドウで溜めている購入
+        self._buffers: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self._tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    def offer(self, bot: commands.Bot, guild_id, destination: Dict[str, str], window: float, purchase: Dict[str, Any]) -> bool:
+        """購入を渡す。ウィンドウ中で溜めた場合は True (呼び出し側はこの通知先へ送信しない)"""
+        key = (str(guild_id), _destination_key(destination))
+        if key in self._buffers:
+            self._buffers[key].append(purchase)
+            return True
+        # バースト外の購入はすぐに送り、以降の購入を溜めるウィンドウを開く
+        self._buffers[key] = []
+        self._tasks[key] = asyncio.get_running_loop().create_task(self._run_window(bot, key, destination, window))
+        return False
+
+    async def _run_window(self, bot: commands.Bot, key: Tuple[str, str], destination: Dict[str, str], window: float):
+        try:
+            while True:
+                await asyncio.sleep(window)
+                purchases = self._buffers.get(key)
+                if not purchases:
+                    break
+                self._buffers[key] = []
+                await self._send_digest(bot, key[0], destination, window, purchases)
+        finally:
+            self._buffers.pop(key, None)
+            self._tasks.pop(key, None)
+
+    async def _send_digest(self, bot: commands.Bot, guild_id: str, destination: Dict[str, str], window: float, purchases: List[Dict[str, Any]]):
+        manager = PurchaseNotificationManager(guild_id)
+
+        if len(purchases) == 1:
+            p = purchases[0]
+            embed = _build_purchase_embed(bot, guild_id, p["user_id"], p["product_name"], p["price"])
+        else:
+            revenue = sum(p["price"] for p in purchases)
+            per_product: Dict[str, List[int]] = {}
+            buyers: List[str] = []
+            for p in purchases:
+                per_product.setdefault(p["product_name"], [0, 0])
+                per_product[p["product_name"]][0] += 1
+                per_product[p["product_name"]][1] += p["price"]
+                mention = f"<@{p['user_id']}>"
+                if mention not in buyers:
+                    buyers.append(mention)
+            ranking = sorted(per_product.items(), key=lambda kv: kv[1][1], reverse=True)
+
+            embed = discord.Embed(
+                title="自動販売機 - 購入まとめ",
+                description=f"直近 {window:g} 秒間に **{len(purchases):,}** 件の購入がありました。",
+                color=discord.Color.green(),
+                timestamp=datetime.now()
+            )
+            embed.add_field(name="合計金額", value=f"```{revenue:,}円```", inline=False)
+            embed.add_field(
+                name="商品別",
+                value=_truncate_lines([f"`{name}` × {count} / {total:,}円" for name, (count, total) in ranking]),
+                inline=False
+            )
+            embed.add_field(name=f"購入者 ({len(buyers)}人)", value=_truncate_lines(buyers), inline=False)
+            embed.set_footer(
+                text="Made by LT",
+                icon_url=bot.user.avatar.url if bot.user and bot.user.avatar else None
+            )
+
+        try:
+            await _send_to(bot, manager, destination, embed)
+        except Exception as e:
+            print(f"ERROR: 購入通知のまとめを送信できませんでした ({_destination_key(destination)}): {e}")
+
+    def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+
+notification_digester = NotificationDigester()
+
+
+async def send_purchase_notification(
+    bot: commands.Bot, 
+    guild_id: int, 
+    user_id: int, 
+    product_name: str, 
+    price: int, 
+    item_content: str,
+    raise_on_error: bool = False,
+    vm_id: Optional[str] = None,
+    products: Optional[List[str]] = None
+):
+    """購入通知を送信する (raise_on_error=True の場合、すべての通知先で失敗したときにエラーを送出)
+
+    ルーティングルールに一致した通知先すべてへ送り、どれにも一致しなければ通知チャンネルへ送る。
+    products はまとめ買いの場合の商品名の一覧 (省略時は product_name のみ)。
+    """
+    notification_manager = PurchaseNotificationManager(guild_id)
+    router = notification_manager.get_router()
+
+    destinations: List[Dict[str, str]] = []
+    if router:
+        role_ids = await _buyer_role_ids(bot, guild_id, user_id) if router.has_role_rules else []
+        destinations = router.route(vm_id, products or [product_name], price, role_ids)
+    if not destinations:
+        channel_id = notification_manager.get_notification_channel_id()
+        if not channel_id:
+            return  # 通知チャンネルが設定されていない場合は何もしない
+        destinations = [{"channel_id": channel_id}]
+
+    # ダイジェストモード: 購入が集中している間は通知先ごとにまとめて送る
+    window = notification_manager.get_digest_window()
+    if window > 0:
+        purchase = {"user_id": user_id, "product_name": product_name, "price": price}
+        destinations = [d for d in destinations if not notification_digester.offer(bot, guild_id, d, window, purchase)]
+        if not destinations:
+            return
+
+    embed = _build_purchase_embed(bot, guild_id, user_id, product_name, price)
+
+    errors: List[Exception] = []
+    for destination in destinations:
+        try:
+            await _send_to(bot, notification_manager, destination, embed)
+        except discord.Forbidden as e:
+            print(f"ERROR: {_destination_key(destination)} に通知を送信できませんでした (権限不足)。")
+            errors.append(e)
+        except Exception as e:
+            print(f"ERROR: 通知送信中に予期せぬエラーが発生しました: {e}")
+            errors.append(e)
+    # 一部の通知先に届いた場合はリトライしない (届いた通知先へ重複して送らないため)
+    if raise_on_error and errors and len(errors) == len(destinations):
+        raise errors[0]
+
+
+async def send_low_stock_alert(
+    bot: commands.Bot,
+    guild_id: int,
+    vm_name: str,
+    product_name: str,
+    remaining: int,
+    threshold: int,
+    raise_on_error: bool = False,
+    vm_id: Optional[str] = None,
+    price: Optional[int] = None
+):
+    """低在庫の警告を送信する (購入通知と同じルーティングルール・通知チャンネルを使用)
+
+    ルールは自販機・商品・価格の条件で照合する (購入者がいないためロール条件付きのルールは対象外)。
+    どれにも一致しなければ通知チャンネルへ送る。
+    """
+    notification_manager = PurchaseNotificationManager(guild_id)
+    router = notification_manager.get_router()
+
+    destinations: List[Dict[str, str]] = []
+    if router and price is not None:
+        destinations = router.route(vm_id, [product_name], price, [])
+    if not destinations:
+        channel_id = notification_manager.get_notification_channel_id()
+        if not channel_id:
+            return  # 通知チャンネルが設定されていない場合は何もしない
+        destinations = [{"channel_id": channel_id}]
+
+    embed = discord.Embed(
+        title="⚠️ 在庫残りわずか",
+        description=f"自販機`{vm_name}`の商品`{product_name}`の在庫が少なくなっています。",
+        color=discord.Color.orange(),
+        timestamp=datetime.now()
+    )
+    embed.add_field(name="残り在庫", value=f"```{remaining:,}個```", inline=True)
+    embed.add_field(name="通知する在庫数", value=f"```{threshold:,}個以下```", inline=True)
+
+    errors: List[Exception] = []
+    for destination in destinations:
+        try:
+            await _send_to(bot, notification_manager, destination, embed)
+        except discord.Forbidden as e:
+            print(f"ERROR: {_destination_key(destination)} に低在庫通知を送信できませんでした (権限不足)。")
+            errors.append(e)
+        except Exception as e:
+            print(f"ERROR: 低在庫通知の送信中に予期せぬエラーが発生しました: {e}")
+            errors.append(e)
+    # 一部の通知先に届いた場合はリトライしない (届いた通知先へ重複して送らないため)
+    if raise_on_error and errors and len(errors) == len(destinations):
+        raise errors[0]
+
+
+def _describe_route(route: Dict[str, Any]) -> str:
+    """ルーティングルールの表示用テキスト"""
+    conditions = []
+    if route.get("vm_id"):
+        conditions.append(f"自販機`{route.get('vm_name', route['vm_id'])}`")
+    if route.get("product"):
+        conditions.append(f"商品`{route['product']}`")
+    if route.get("min_price") is not None or route.get("max_price") is not None:
+        low = f"{route['min_price']:,}円" if route.get("min_price") is not None else ""
+        high = f"{route['max_price']:,}円" if route.get("max_price") is not None else ""
+        conditions.append(f"価格 {low}〜{high}")
+    if route.get("role_id"):
+        conditions.append(f"ロール <@&{route['role_id']}>")
+    target = f"<#{route['channel_id']}>" if route.get("channel_id") else "Webhook"
+    return f"{' / '.join(conditions) or 'すべての購入'} → {target}"
 
 
 # ===============================================
 # 3. SetNotificationChannelCog クラス (通知設定コマンド)
-#    - コマンド名: /vmnote_set
+#    - コマンド名: /vmnote_set, /vmnote_digest, /vmnote_webhook,
+#                  /vmnote_route_add, /vmnote_route_list, /vmnote_route_remove
 # ===============================================
 class SetNotificationChannelCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
@@ -135,5 +688,166 @@ class SetNotificationChannelCog(commands.Cog):
             await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
 
 
+    @app_commands.command(
+        name="vmnote_digest",
+        description="購入が集中したときに通知を指定秒数ごとに1件へまとめます（管理者専用）。"
+    )
+    @app_commands.describe(seconds="まとめる時間（秒）。0でまとめずに毎回通知")
+    async def vmnote_digest_command(self, interaction: discord.Interaction, seconds: app_commands.Range[int, 0, 3600]):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        try:
+            PurchaseNotificationManager(interaction.guild_id).set_digest_window(seconds)
+            if seconds:
+                message = f"✅ 購入が集中したときは **{seconds}** 秒ごとに通知を1件へまとめます（単発の購入はすぐに通知されます）。"
+            else:
+                message = "✅ ダイジェストモードを無効にしました。購入ごとに通知します。"
+            await interaction.followup.send(message, ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @app_commands.command(
+        name="vmnote_webhook",
+        description="購入通知をWebhook経由で送信します（カスタム名・アイコン、管理者専用）。"
+    )
+    @app_commands.describe(
+        enabled="Webhook経由で送信するか（オフでBotから直接送信）",
+        name="通知に表示する名前（省略時はBotの名前）",
+        avatar_url="通知に表示するアイコン画像のURL（省略時はBotのアイコン）"
+    )
+    async def vmnote_webhook_command(self, interaction: discord.Interaction, enabled: bool, name: Optional[str] = None, avatar_url: Optional[str] = None):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        if avatar_url and not avatar_url.startswith(("http://", "https://")):
+            return await interaction.followup.send("❌ アイコン画像のURLは http(s):// で始まる必要があります。", ephemeral=True)
+
+        try:
+            PurchaseNotificationManager(interaction.guild_id).set_webhook_delivery(enabled, name, avatar_url)
+            if enabled:
+                message = (
+                    "✅ 購入通知をWebhook経由で送信します。\n"
+                    "Webhookは初回の通知時に通知チャンネルへ自動作成されます（Botに「ウェブフックの管理」権限が必要です）。"
+                )
+            else:
+                message = "✅ 購入通知をBotから直接送信します。"
+            await interaction.followup.send(message, ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @app_commands.command(
+        name="vmnote_route_add",
+        description="条件に一致する購入の通知を別のチャンネル・Webhookへ送るルールを追加します（管理者専用）。"
+    )
+    @app_commands.describe(
+        channel="通知先のチャンネル（webhook_url とどちらか一方）",
+        webhook_url="通知先のWebhook URL（channel とどちらか一方）",
+        vm_name="対象の自販機名（省略時はすべて）",
+        product_name="対象の商品名（省略時はすべて）",
+        min_price="対象の最低価格（省略時は下限なし）",
+        max_price="対象の最高価格（省略時は上限なし）",
+        role="購入者が持つロール（省略時はすべて）"
+    )
+    async def vmnote_route_add_command(
+        self,
+        interaction: discord.Interaction,
+        channel: Optional[discord.TextChannel] = None,
+        webhook_url: Optional[str] = None,
+        vm_name: Optional[str] = None,
+        product_name: Optional[str] = None,
+        min_price: Optional[app_commands.Range[int, 0]] = None,
+        max_price: Optional[app_commands.Range[int, 0]] = None,
+        role: Optional[discord.Role] = None
+    ):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        if (channel is None) == (webhook_url is None):
+            return await interaction.followup.send("❌ 通知先はチャンネルかWebhook URLのどちらか一方を指定してください。", ephemeral=True)
+        if webhook_url and not webhook_url.startswith("https://"):
+            return await interaction.followup.send("❌ Webhook URLは https:// で始まる必要があります。", ephemeral=True)
+        if min_price is not None and max_price is not None and min_price > max_price:
+            return await interaction.followup.send("❌ 最低価格は最高価格以下にしてください。", ephemeral=True)
+
+        try:
+            route: Dict[str, Any] = {}
+            if vm_name:
+                vm_id = vm_registry.get_vm_id(interaction.guild_id, vm_name)
+                if not vm_id:
+                    return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+                route["vm_id"] = vm_id
+                route["vm_name"] = vm_name
+            if product_name:
+                route["product"] = product_name
+            if min_price is not None:
+                route["min_price"] = min_price
+            if max_price is not None:
+                route["max_price"] = max_price
+            if role is not None:
+                route["role_id"] = str(role.id)
+            if channel is not None:
+                route["channel_id"] = str(channel.id)
+            else:
+                route["webhook_url"] = webhook_url
+
+            manager = PurchaseNotificationManager(interaction.guild_id)
+            manager.add_route(route)
+            await interaction.followup.send(
+                f"✅ ルーティングルール #{len(manager.get_routes())} を追加しました。\n{_describe_route(route)}",
+                ephemeral=True
+            )
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @app_commands.command(
+        name="vmnote_route_list",
+        description="購入通知のルーティングルールの一覧を表示します（管理者専用）。"
+    )
+    async def vmnote_route_list_command(self, interaction: discord.Interaction):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        routes = PurchaseNotificationManager(interaction.guild_id).get_routes()
+        if not routes:
+            return await interaction.followup.send(
+                "ℹ️ ルーティングルールはありません。すべての購入通知は通知チャンネルへ送られます。", ephemeral=True
+            )
+        lines = [f"**#{i}** {_describe_route(route)}" for i, route in enumerate(routes, start=1)]
+        lines.append("どのルールにも一致しない購入は通知チャンネルへ送られます。")
+        await interaction.followup.send("\n".join(lines)[:1900], ephemeral=True)
+
+    @app_commands.command(
+        name="vmnote_route_remove",
+        description="購入通知のルーティングルールを削除します（管理者専用）。"
+    )
+    @app_commands.describe(number="削除するルールの番号（/vmnote_route_list で確認）")
+    async def vmnote_route_remove_command(self, interaction: discord.Interaction, number: app_commands.Range[int, 1]):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        try:
+            removed = PurchaseNotificationManager(interaction.guild_id).remove_route(number - 1)
+            if removed is None:
+                return await interaction.followup.send(f"❌ ルール #{number} が見つかりません。", ephemeral=True)
+            await interaction.followup.send(f"✅ ルール #{number} を削除しました。\n{_describe_route(removed)}", ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    async def cog_unload(self):
+        notification_digester.stop()
+        await webhook_delivery.close()
+
+
 async def setup(bot: commands.Bot):
     await bot.add_cog(SetNotificationChannelCog(bot))
\ No newline at end of file
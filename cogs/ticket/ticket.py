@@ -5,8 +5,11 @@ from discord.ui import Button, View, Select
 import json
 import os
 import asyncio
-from typing import Optional, Dict, Any, List, Union
+import time
+from collections import deque
+from typing import Optional, Dict, Any, List, Union, Tuple, Deque
 from pathlib import Path
+from .ticket_store import TicketStore
 
 # =========================================================
 # ファイルパス設定
@@ -14,6 +17,16 @@ from pathlib import Path
 # cogs/ticket.py が 'cogs' フォルダ内にあることを前提とし、ルートディレクトリを参照
 BASE_DIR = Path(__file__).parent.parent.parent 
 TICKET_DATA_FILE = BASE_DIR / "ticket_data.json"
+TICKET_JOURNAL_FILE = BASE_DIR / "ticket_data.journal"
+
+# チャンネル名の変更は Discord 側で 1チャンネルあたり 10分に2回程度までに制限されている
+RENAME_LIMIT = 2
+RENAME_PERIOD = 600.0
+
+# 事前作成しておくチケットチャンネル (ユーザー名には使えない文字を含めて、実チケットと区別する)
+POOL_CHANNEL_NAME = "ticket-準備中"
+POOL_MAX_SIZE = 10
+POOL_REFILL_INTERVAL = 2.0  # 補充でチャンネルを作成する間隔 (秒)
 TICKET_PANEL_SETTINGS_FILE = BASE_DIR / "ticket_panel_settings.json" 
 
 # =========================================================
@@ -49,9 +62,54 @@ def _save_json(file_path: Path, data: Dict[str, Any]):
         print(f"Error saving {file_path.name}: {e}")
 
 # 初期ロード
-ticket_data: Dict[str, Dict[str, Union[str, List[str]]]] = _load_json(TICKET_DATA_FILE)
+# チケットの状態はジャーナルに追記して保存する (ticket_data.json はスナップショット)
+ticket_store = TicketStore(TICKET_DATA_FILE, TICKET_JOURNAL_FILE)
+ticket_data: Dict[str, Dict[str, Union[str, List[str]]]] = ticket_store.data
 panel_settings: Dict[str, Dict[str, str]] = _load_json(TICKET_PANEL_SETTINGS_FILE)
 
+# 開いているチケットの索引: {(guild_id, opener_id): channel_id}
+# ticket_data から作り、チケットの作成・クローズ・チャンネル削除のたびに更新する
+ticket_index: Dict[Tuple[str, str], str] = {}
+
+
+def _rebuild_ticket_index():
+    """ticket_data から索引を作り直す (guild_id が未記録の古いチケットは除く)"""
+    ticket_index.clear()
+    for channel_id, data in ticket_data.items():
+        if data.get("guild_id"):
+            ticket_index[(data["guild_id"], data["opener_id"])] = channel_id
+
+
+def _backfill_ticket_guilds(bot: commands.Bot):
+    """guild_id が未記録の古いチケットに、チャンネルから分かるギルドIDを補う"""
+    for channel_id, data in list(ticket_data.items()):
+        if data.get("guild_id"):
+            continue
+        channel = bot.get_channel(int(channel_id))
+        if channel is not None:
+            ticket_store.set(channel_id, {**data, "guild_id": str(channel.guild.id)})
+    _rebuild_ticket_index()
+
+
+def _register_ticket(channel_id: str, data: Dict[str, Any]):
+    ticket_store.set(channel_id, data)
+    ticket_index[(data["guild_id"], data["opener_id"])] = channel_id
+
+
+def _forget_ticket(channel_id: str) -> bool:
+    """チケットをデータと索引から外す (登録されていなければ False)"""
+    data = ticket_data.get(channel_id)
+    if data is None:
+        return False
+    ticket_store.delete(channel_id)
+    key = (data.get("guild_id"), data["opener_id"])
+    if ticket_index.get(key) == channel_id:
+        del ticket_index[key]
+    return True
+
+
+_rebuild_ticket_index()
+
 
 def create_error_embed(description: str) -> discord.Embed:
     """赤色のエラーメッセージEmbedを作成する"""
@@ -61,8 +119,176 @@ def create_error_embed(description: str) -> discord.Embed:
         color=discord.Color.red()
     )
 
-async def _update_channel_name(channel: discord.TextChannel, opener: discord.Member, handler_ids: List[str]):
-    """チャンネル名を更新するロジック"""
+class ChannelRenameScheduler:
+    """チャンネル名の変更をチャンネルごとに予約し、レート制限の範囲内で適用するクラス
+
+    予約はそのチャンネルの最新の名前だけを保持し (途中の名前は捨てる)、
+    直近 RENAME_PERIOD 秒の変更が RENAME_LIMIT 回に達している間は
+    バックグラウンドで枠が空くのを待ってから1回だけ変更する。
+    呼び出し側 (インタラクション) は変更の完了を待たない。
+    """
+    def __init__(self):
+        # {channel_id: 適用待ちの名前}
+        self._desired: Dict[int, str] = {}
+        self._channels: Dict[int, discord.TextChannel] = {}
+        # {channel_id: 直近の変更時刻}
+        self._history: Dict[int, Deque[float]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def request(self, channel: discord.TextChannel, name: str):
+        """チャンネル名の変更を予約する (すぐに戻る)"""
+        if channel.id not in self._desired and channel.name == name:
+            return
+        self._desired[channel.id] = name
+        self._channels[channel.id] = channel
+        if channel.id not in self._tasks:
+            self._tasks[channel.id] = asyncio.get_running_loop().create_task(self._run(channel.id))
+
+    def cancel(self, channel_id: int):
+        """チャンネルの予約を取り消す (チケットのクローズ・チャンネル削除時)"""
+        self._desired.pop(channel_id, None)
+        self._history.pop(channel_id, None)
+        task = self._tasks.pop(channel_id, None)
+        if task is not None:
+            task.cancel()
+
+    def record(self, channel_id: int):
+        """スケジューラー外で行った名前の変更 (チケット開設時など) を回数に含める"""
+        self._wait_time(channel_id)
+        self._history[channel_id].append(time.monotonic())
+
+    def _wait_time(self, channel_id: int) -> float:
+        history = self._history.setdefault(channel_id, deque())
+        now = time.monotonic()
+        while history and now - history[0] >= RENAME_PERIOD:
+            history.popleft()
+        if len(history) < RENAME_LIMIT:
+            return 0.0
+        return history[0] + RENAME_PERIOD - now
+
+    async def _run(self, channel_id: int):
+        try:
+            while channel_id in self._desired:
+                wait = self._wait_time(channel_id)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                # 待っている間に届いた予約も含め、最新の名前だけを適用する
+                name = self._desired.pop(channel_id)
+                channel = self._channels[channel_id]
+                if channel.name == name:
+                    continue
+                self._history[channel_id].append(time.monotonic())
+                try:
+                    await channel.edit(name=name, reason="対応者の変更に伴うチケットチャンネル名の更新")
+                except discord.NotFound:
+                    self._desired.pop(channel_id, None)
+                except discord.HTTPException as e:
+                    print(f"チャンネル名の変更に失敗しました: {e}")
+        finally:
+            if self._tasks.get(channel_id) is asyncio.current_task():
+                del self._tasks[channel_id]
+            if channel_id not in self._desired:
+                self._channels.pop(channel_id, None)
+
+    def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        self._desired.clear()
+
+
+rename_scheduler = ChannelRenameScheduler()
+
+
+class TicketChannelPool:
+    """カテゴリーごとに非公開のチケットチャンネルを事前作成しておくクラス
+
+    チケットの開設時はプールのチャンネルを1つ取り出し、名前と権限を
+    1回の channel.edit で書き換えるだけで済む (作成の待ち時間をユーザーに見せない)。
+    取り出すたびにバックグラウンドで設定数まで補充し、設定数を減らした場合は余りを削除する。
+    プールの中身は保存せず、起動時にカテゴリー内の POOL_CHANNEL_NAME のチャンネルを引き取る。
+    """
+    def __init__(self):
+        # {category_id: [channel_id, ...]}
+        self._channels: Dict[int, Deque[int]] = {}
+        self._targets: Dict[int, int] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def size(self, category_id: int) -> int:
+        return len(self._channels.get(category_id, ()))
+
+    def adopt(self, category: discord.CategoryChannel):
+        """カテゴリー内に残っている事前作成チャンネルをプールに戻す (起動時)"""
+        pool = self._channels.setdefault(category.id, deque())
+        for channel in category.text_channels:
+            if channel.name == POOL_CHANNEL_NAME and str(channel.id) not in ticket_data and channel.id not in pool:
+                pool.append(channel.id)
+
+    def configure(self, category: discord.CategoryChannel, size: int):
+        """プールの目標数を設定し、補充 (または削減) を始める"""
+        self._targets[category.id] = size
+        self._kick(category)
+
+    def take(self, category: discord.CategoryChannel) -> Optional[discord.TextChannel]:
+        """事前作成チャンネルを1つ取り出す (空なら None)"""
+        pool = self._channels.get(category.id)
+        channel = None
+        while pool and channel is None:
+            channel = category.guild.get_channel(pool.popleft())
+        self._kick(category)
+        return channel
+
+    def discard(self, channel_id: int):
+        """削除されたチャンネルをプールから外す"""
+        for pool in self._channels.values():
+            if channel_id in pool:
+                pool.remove(channel_id)
+
+    def _kick(self, category: discord.CategoryChannel):
+        if category.id in self._tasks:
+            return
+        if self.size(category.id) == self._targets.get(category.id, 0):
+            return
+        self._tasks[category.id] = asyncio.get_running_loop().create_task(self._refill(category))
+
+    async def _refill(self, category: discord.CategoryChannel):
+        guild = category.guild
+        pool = self._channels.setdefault(category.id, deque())
+        try:
+            while True:
+                target = self._targets.get(category.id, 0)
+                if len(pool) > target:
+                    channel = guild.get_channel(pool.pop())
+                    if channel is not None:
+                        await channel.delete(reason="チケット用チャンネルの事前作成数の変更")
+                    continue
+                if len(pool) == target:
+                    break
+                channel = await guild.create_text_channel(
+                    name=POOL_CHANNEL_NAME,
+                    category=category,
+                    overwrites={guild.default_role: discord.PermissionOverwrite(view_channel=False)},
+                    reason="チケット用チャンネルの事前作成"
+                )
+                pool.append(channel.id)
+                await asyncio.sleep(POOL_REFILL_INTERVAL)
+        except discord.HTTPException as e:
+            print(f"⚠️ 警告: チケット用チャンネルの事前作成に失敗しました (カテゴリーID {category.id}): {e}")
+        finally:
+            self._tasks.pop(category.id, None)
+
+    def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+
+
+ticket_pool = TicketChannelPool()
+
+
+def _update_channel_name(channel: discord.TextChannel, opener: discord.Member, handler_ids: List[str]):
+    """チャンネル名を更新するロジック (変更は予約のみ、適用はスケジューラーが行う)"""
     safe_opener_name = opener.name.lower().replace(' ', '-').replace('.', '')
     
     handler_name_suffix = ""
@@ -78,11 +304,7 @@ async def _update_channel_name(channel: discord.TextChannel, opener: discord.Mem
     if len(new_name) > 100:
         new_name = new_name[:100]
 
-    if channel.name != new_name:
-        try:
-            await channel.edit(name=new_name, reason="対応者の変更に伴うチケットチャンネル名の更新")
-        except discord.HTTPException as e:
-            print(f"チャンネル名の変更に失敗しました: {e}")
+    rename_scheduler.request(channel, new_name)
 
 # =========================================================
 # カスタム View (ボタンとセレクトメニュー)
@@ -108,12 +330,11 @@ class ConfirmRemoveView(View):
         
         new_handler_ids = [h_id for h_id in handler_ids if h_id != self.target_id]
         
-        ticket_data[channel_id]["handler_ids"] = new_handler_ids
-        _save_json(TICKET_DATA_FILE, ticket_data)
+        ticket_store.set(channel_id, {**ticket_data[channel_id], "handler_ids": new_handler_ids})
 
         opener = interaction.guild.get_member(int(self.opener_id))
         if opener:
-            await _update_channel_name(interaction.channel, opener, new_handler_ids)
+            _update_channel_name(interaction.channel, opener, new_handler_ids)
         
         target_member = interaction.guild.get_member(int(self.target_id))
         if target_member:
@@ -191,11 +412,7 @@ class ConfirmCloseView(View):
             view=None
         )
         
-        channel_id = str(interaction.channel_id)
-        global ticket_data
-        if channel_id in ticket_data:
-            del ticket_data[channel_id]
-            _save_json(TICKET_DATA_FILE, ticket_data)
+        _forget_ticket(str(interaction.channel_id))
         
         await asyncio.sleep(5)
         try:
@@ -210,164 +427,173 @@ class ConfirmCloseView(View):
             view=None
         )
 
-# --- チケット操作 View (チャンネル内に送信されるボタン) ---
-class TicketInitialView(View):
-    def __init__(self, bot: commands.Bot, opener_id: str, staff_role_id: str):
-        super().__init__(timeout=None) 
-        self.bot = bot
-        self.opener_id = opener_id
-        self.staff_role_id = staff_role_id
-
-    async def _check_staff_permission(self, interaction: discord.Interaction, for_close: bool = False) -> bool:
-        """対応スタッフロールまたはAdmin権限をチェックする"""
-        is_admin = interaction.user.guild_permissions.administrator
-        is_opener = str(interaction.user.id) == self.opener_id
-        is_staff = False
-
-        if self.staff_role_id:
-            staff_role = interaction.guild.get_role(int(self.staff_role_id))
-            if staff_role and staff_role in interaction.user.roles:
-                is_staff = True
-        
-        # 閉じる操作の場合: 作成者、スタッフ、AdminのいずれかであればOK
-        if for_close and (is_admin or is_opener or is_staff):
-             return True
-        
-        # 対応/削除操作の場合: スタッフ、AdminであればOK
-        if not for_close and (is_admin or is_staff):
-            return True
-        
-        # 権限不足の場合
-        error_msg = "この操作を実行するには、**対応スタッフロール**または**管理者権限**が必要です。"
-        if for_close:
-             error_msg = "チケットを閉じるには、**作成者**、**対応スタッフ**または**管理者権限**が必要です。"
-             
-        await interaction.response.send_message(
-            embed=create_error_embed(error_msg),
-            ephemeral=True
-        )
-        return False
-
-    # --- 閉じるボタン ---
-    @discord.ui.button(label="閉じる", style=ButtonStyle.danger, custom_id="ticket_close")
-    async def close_button(self, interaction: discord.Interaction, button: Button):
-        if not await self._check_staff_permission(interaction, for_close=True):
-            return
-
-        await interaction.response.send_message(
-            embed=discord.Embed(title="⚠️ 本当に閉じますか？", description="この操作は元に戻せません。", color=discord.Color.yellow()),
-            view=ConfirmCloseView(self.bot),
-            ephemeral=True
-        )
+# --- チケット操作ボタンの処理 (ルーターから呼ばれる) ---
+async def _check_staff_permission(interaction: discord.Interaction, opener_id: Optional[str], for_close: bool = False) -> bool:
+    """対応スタッフロールまたはAdmin権限をチェックする (スタッフロールはパネル設定から参照)"""
+    is_admin = interaction.user.guild_permissions.administrator
+    is_opener = opener_id is not None and str(interaction.user.id) == opener_id
+    is_staff = False
+
+    staff_role_id = panel_settings.get(str(interaction.guild_id), {}).get("staff_role_id")
+    if staff_role_id:
+        staff_role = interaction.guild.get_role(int(staff_role_id))
+        if staff_role and staff_role in interaction.user.roles:
+            is_staff = True
+    
+    # 閉じる操作の場合: 作成者、スタッフ、AdminのいずれかであればOK
+    if for_close and (is_admin or is_opener or is_staff):
+         return True
+    
+    # 対応/削除操作の場合: スタッフ、AdminであればOK
+    if not for_close and (is_admin or is_staff):
+        return True
+    
+    # 権限不足の場合
+    error_msg = "この操作を実行するには、**対応スタッフロール**または**管理者権限**が必要です。"
+    if for_close:
+         error_msg = "チケットを閉じるには、**作成者**、**対応スタッフ**または**管理者権限**が必要です。"
+    
+    if interaction.response.is_done():
+        await interaction.followup.send(embed=create_error_embed(error_msg), ephemeral=True)
+    else:
+        await interaction.response.send_message(embed=create_error_embed(error_msg), ephemeral=True)
+    return False
+
+# --- 閉じるボタン ---
+async def handle_ticket_close(interaction: discord.Interaction):
+    ticket = ticket_data.get(str(interaction.channel_id))
+    if not await _check_staff_permission(interaction, ticket["opener_id"] if ticket else None, for_close=True):
+        return
+
+    await interaction.response.send_message(
+        embed=discord.Embed(title="⚠️ 本当に閉じますか？", description="この操作は元に戻せません。", color=discord.Color.yellow()),
+        view=ConfirmCloseView(interaction.client),
+        ephemeral=True
+    )
 
-    # --- 対応するボタン ---
-    @discord.ui.button(label="このチケットを対応する", style=ButtonStyle.success, custom_id="ticket_handle")
-    async def handle_button(self, interaction: discord.Interaction, button: Button):
-        if not await self._check_staff_permission(interaction):
-            return
+# --- 対応するボタン ---
+async def handle_ticket_handle(interaction: discord.Interaction):
+    if not await _check_staff_permission(interaction, None):
+        return
 
-        channel_id = str(interaction.channel_id)
-        user_id = str(interaction.user.id)
-        global ticket_data
-        
-        if channel_id not in ticket_data:
-            return await interaction.response.send_message(embed=create_error_embed("チケットデータが見つかりません。"), ephemeral=True)
-        
-        handler_ids = ticket_data[channel_id].get("handler_ids", [])
-        opener_id = ticket_data[channel_id]["opener_id"]
+    channel_id = str(interaction.channel_id)
+    user_id = str(interaction.user.id)
+    
+    if channel_id not in ticket_data:
+        return await interaction.response.send_message(embed=create_error_embed("チケットデータが見つかりません。"), ephemeral=True)
+    
+    handler_ids = list(ticket_data[channel_id].get("handler_ids", []))
+    opener_id = ticket_data[channel_id]["opener_id"]
 
-        # 対応者に追加したらチャンネルを見れるようにする
-        await interaction.channel.set_permissions(interaction.user, view_channel=True, send_messages=True)
+    # 対応者に追加したらチャンネルを見れるようにする
+    await interaction.channel.set_permissions(interaction.user, view_channel=True, send_messages=True)
+    
+    if user_id in handler_ids:
+        handler_ids.remove(user_id) 
+    handler_ids.append(user_id) 
         
-        if user_id in handler_ids:
-            handler_ids.remove(user_id) 
-        handler_ids.append(user_id) 
-            
-        ticket_data[channel_id]["handler_ids"] = handler_ids
-        _save_json(TICKET_DATA_FILE, ticket_data)
+    ticket_store.set(channel_id, {**ticket_data[channel_id], "handler_ids": handler_ids})
+
+    opener = interaction.guild.get_member(int(opener_id))
+    if opener:
+        _update_channel_name(interaction.channel, opener, handler_ids)
+
+    await interaction.response.send_message(
+        embed=discord.Embed(
+            description=f"✅ {interaction.user.mention} 様を対応者に追加しました。\nチャンネル名にも順次反映されます。",
+            color=discord.Color.green()
+        ),
+        ephemeral=False 
+    )
+    
+# --- 対応者を削除するボタン ---
+async def handle_ticket_remove_handler(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
 
-        opener = interaction.guild.get_member(int(opener_id))
-        if opener:
-            await _update_channel_name(interaction.channel, opener, handler_ids)
+    if not await _check_staff_permission(interaction, None):
+        return
 
-        await interaction.response.send_message(
-            embed=discord.Embed(
-                description=f"✅ {interaction.user.mention} 様を対応者に追加しました。\nチャンネル名に反映されています。",
-                color=discord.Color.green()
-            ),
-            ephemeral=False 
-        )
-        
-    # --- 対応者を削除するボタン ---
-    @discord.ui.button(label="対応者を削除する", style=ButtonStyle.secondary, custom_id="ticket_remove_handler")
-    async def remove_handler_button(self, interaction: discord.Interaction, button: Button):
-        await interaction.response.defer(ephemeral=True)
+    channel_id = str(interaction.channel_id)
 
-        if not await self._check_staff_permission(interaction):
-            return
+    if channel_id not in ticket_data:
+        return await interaction.followup.send("❌ チケットデータが見つかりません。", ephemeral=True)
 
-        channel_id = str(interaction.channel_id)
-        global ticket_data
-
-        if channel_id not in ticket_data:
-            return await interaction.followup.send("❌ チケットデータが見つかりません。", ephemeral=True)
-
-        handler_ids = ticket_data[channel_id].get("handler_ids", [])
-        opener_id = ticket_data[channel_id]["opener_id"]
-        
-        if not handler_ids:
-            return await interaction.followup.send("❌ 現在、対応者は登録されていません。", ephemeral=True)
+    handler_ids = ticket_data[channel_id].get("handler_ids", [])
+    opener_id = ticket_data[channel_id]["opener_id"]
+    
+    if not handler_ids:
+        return await interaction.followup.send("❌ 現在、対応者は登録されていません。", ephemeral=True)
 
-        # HandlerSelectViewを生成し、アイテムがあるか確認 (400 Bad Request対策)
-        handler_view = HandlerSelectView(self.bot, handler_ids, opener_id)
+    # HandlerSelectViewを生成し、アイテムがあるか確認 (400 Bad Request対策)
+    handler_view = HandlerSelectView(interaction.client, handler_ids, opener_id)
 
-        if not handler_view.children:
-            # 登録IDはあったが、対応するユーザーが全員サーバーに存在しない場合
-            return await interaction.followup.send("❌ 登録されている対応者が見つかりませんでした。データが古い可能性があります。", ephemeral=True)
+    if not handler_view.children:
+        # 登録IDはあったが、対応するユーザーが全員サーバーに存在しない場合
+        return await interaction.followup.send("❌ 登録されている対応者が見つかりませんでした。データが古い可能性があります。", ephemeral=True)
 
-        await interaction.followup.send( 
-            embed=discord.Embed(title="対応者削除", description="削除したい対応者をセレクトメニューから選択してください。", color=discord.Color.blue()),
-            view=handler_view, # 生成したViewを渡す
-            ephemeral=True
-        )
+    await interaction.followup.send( 
+        embed=discord.Embed(title="対応者削除", description="削除したい対応者をセレクトメニューから選択してください。", color=discord.Color.blue()),
+        view=handler_view, # 生成したViewを渡す
+        ephemeral=True
+    )
 
 # --- チケットパネルのボタン ---
-class TicketPanelButton(discord.ui.Button):
-    def __init__(self, bot: commands.Bot, label, custom_id):
-        super().__init__(label=label, style=ButtonStyle.primary, custom_id=custom_id)
-        self.bot = bot # botインスタンスを保持
-
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.defer(ephemeral=True, thinking=True)
+async def handle_ticket_open(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    
+    settings = panel_settings.get(str(interaction.guild_id))
+    if not settings:
+        return await interaction.followup.send("❌ チケットパネルの設定が見つかりません。`/ticket` コマンドで設定してください。", ephemeral=True)
         
-        settings = panel_settings.get(str(interaction.guild_id))
-        if not settings:
-            return await interaction.followup.send("❌ チケットパネルの設定が見つかりません。`/ticket` コマンドで設定してください。", ephemeral=True)
-            
-        category_id = settings.get("category_id")
-        staff_role_id = settings.get("staff_role_id")
-        welcome_message = settings.get("welcome_message", "") 
+    category_id = settings.get("category_id")
+    staff_role_id = settings.get("staff_role_id")
+    welcome_message = settings.get("welcome_message", "") 
 
-        
-        category = interaction.guild.get_channel(int(category_id))
-        if not category or category.type != ChannelType.category:
-            return await interaction.followup.send("❌ 設定されたカテゴリーが見つかりません。", ephemeral=True)
+    
+    category = interaction.guild.get_channel(int(category_id))
+    if not category or category.type != ChannelType.category:
+        return await interaction.followup.send("❌ 設定されたカテゴリーが見つかりません。", ephemeral=True)
 
-        opener_name = interaction.user.name.lower().replace(' ', '-').replace('.', '')
-        
-        for channel in interaction.guild.channels:
-            if channel.name.startswith(f"ticket-{opener_name}"):
-                return await interaction.followup.send(f"❌ 既にチケット <#{channel.id}> が開かれています。", ephemeral=True)
+    opener_name = interaction.user.name.lower().replace(' ', '-').replace('.', '')
+    
+    existing_id = ticket_index.get((str(interaction.guild_id), str(interaction.user.id)))
+    if existing_id:
+        if interaction.guild.get_channel(int(existing_id)):
+            return await interaction.followup.send(f"❌ 既にチケット <#{existing_id}> が開かれています。", ephemeral=True)
+        # チャンネルが削除済みの古い記録は取り除く
+        _forget_ticket(existing_id)
+
+    overwrites = {
+        interaction.guild.default_role: discord.PermissionOverwrite(view_channel=False),
+        interaction.user: discord.PermissionOverwrite(view_channel=True, send_messages=True),
+    }
+    if staff_role_id:
+        staff_role = interaction.guild.get_role(int(staff_role_id))
+        if staff_role:
+            overwrites[staff_role] = discord.PermissionOverwrite(view_channel=True, send_messages=True)
+            
+    # 事前作成したチャンネルがあれば、名前と権限の書き換え1回で開設する
+    new_channel = None
+    pooled = ticket_pool.take(category)
+    if pooled is not None:
+        try:
+            await pooled.edit(
+                name=f"ticket-{opener_name}",
+                overwrites=overwrites,
+                reason=f"チケット作成: {interaction.user.name}"
+            )
+            rename_scheduler.record(pooled.id)
+            new_channel = pooled
+        except discord.HTTPException as e:
+            print(f"⚠️ 警告: 事前作成したチケットチャンネルを使用できませんでした: {e}")
+            # プールからは取り出し済みで、書き換えがどこまで反映されたか分からないため削除する
+            # (プールの補充は take() の時点で始まっている)
+            try:
+                await pooled.delete(reason="使用できなかった事前作成チケットチャンネルの削除")
+            except discord.HTTPException:
+                pass
 
-        overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(view_channel=False),
-            interaction.user: discord.PermissionOverwrite(view_channel=True, send_messages=True),
-        }
-        if staff_role_id:
-            staff_role = interaction.guild.get_role(int(staff_role_id))
-            if staff_role:
-                overwrites[staff_role] = discord.PermissionOverwrite(view_channel=True, send_messages=True)
-                
+    if new_channel is None:
         try:
             new_channel = await interaction.guild.create_text_channel(
                 name=f"ticket-{opener_name}",
@@ -378,43 +604,94 @@ class TicketPanelButton(discord.ui.Button):
         except discord.Forbidden:
             return await interaction.followup.send("❌ チャンネルを作成する権限がありません。", ephemeral=True)
 
-        # ウェルカムメッセージがない場合のデフォルト処理
-        if welcome_message and welcome_message.strip():
-            welcome_embed = discord.Embed(
-                title="🎫 チケットが開かれました",
-                description=f"ようこそ、{interaction.user.mention} 様。\n{welcome_message}",
-                color=discord.Color.green()
-            )
-            content = interaction.user.mention 
-        else:
-            # デフォルトメッセージ (ご要望通り)
-            staff_mention = f"<@&{staff_role_id}>" if staff_role_id else "**対応スタッフ**"
-            welcome_embed = discord.Embed(
-                title="🎫 対応者をお待ちください",
-                description=(
-                    f"対応者がくるまでお待ちください。\n"
-                    f"{staff_mention} {interaction.user.mention}"
-                ),
-                color=discord.Color.orange()
-            )
-            content = f"{staff_mention} {interaction.user.mention}" 
+    # ウェルカムメッセージがない場合のデフォルト処理
+    if welcome_message and welcome_message.strip():
+        welcome_embed = discord.Embed(
+            title="🎫 チケットが開かれました",
+            description=f"ようこそ、{interaction.user.mention} 様。\n{welcome_message}",
+            color=discord.Color.green()
+        )
+        content = interaction.user.mention 
+    else:
+        # デフォルトメッセージ (ご要望通り)
+        staff_mention = f"<@&{staff_role_id}>" if staff_role_id else "**対応スタッフ**"
+        welcome_embed = discord.Embed(
+            title="🎫 対応者をお待ちください",
+            description=(
+                f"対応者がくるまでお待ちください。\n"
+                f"{staff_mention} {interaction.user.mention}"
+            ),
+            color=discord.Color.orange()
+        )
+        content = f"{staff_mention} {interaction.user.mention}" 
+
+    # チケットデータ保存
+    _register_ticket(str(new_channel.id), {
+        "guild_id": str(interaction.guild_id),
+        "opener_id": str(interaction.user.id),
+        "handler_ids": []
+    })
+
+    # チケット操作View (ボタン群) を送信
+    await new_channel.send(
+        content=content,
+        embed=welcome_embed,
+        view=build_ticket_view()
+    )
+    
+    await interaction.followup.send(f"✅ チケット <#{new_channel.id}> を作成しました。", ephemeral=True)
 
-        # チケットデータ保存
-        global ticket_data
-        ticket_data[str(new_channel.id)] = {
-            "opener_id": str(interaction.user.id),
-            "handler_ids": []
-        }
-        _save_json(TICKET_DATA_FILE, ticket_data)
 
-        # チケット操作View (ボタン群) を送信
-        await new_channel.send(
-            content=content,
-            embed=welcome_embed,
-            view=TicketInitialView(self.bot, str(interaction.user.id), staff_role_id)
-        )
-        
-        await interaction.followup.send(f"✅ チケット <#{new_channel.id}> を作成しました。", ephemeral=True)
+# --- UI Components (custom_id を解析して処理を振り分ける単一ルーター) ---
+class TicketComponentRouter(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"(?P<action>ticket_close|ticket_handle|ticket_remove_handler|ticket_create_button)(?:_(?P<guild_id>[0-9]+))?"
+):
+    """チケットパネル・チケット内の全ボタンを受け付けるルーター
+
+    作成者はチケットデータ、対応スタッフロールはパネル設定からクリック時に引くため、
+    チケットごとのViewをメモリに持つ必要がなく、起動時の復元処理も不要になる。
+    """
+    def __init__(self, item: discord.ui.Button, action: str):
+        super().__init__(item)
+        self.action = action
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(item, match["action"])
+
+    async def callback(self, interaction: discord.Interaction):
+        if self.action == "ticket_close":
+            await handle_ticket_close(interaction)
+        elif self.action == "ticket_handle":
+            await handle_ticket_handle(interaction)
+        elif self.action == "ticket_remove_handler":
+            await handle_ticket_remove_handler(interaction)
+        elif self.action == "ticket_create_button":
+            await handle_ticket_open(interaction)
+
+
+def build_ticket_view() -> View:
+    """チケット操作View (チャンネル内に送信されるボタン)"""
+    view = View(timeout=None)
+    view.add_item(TicketComponentRouter(
+        Button(label="閉じる", style=ButtonStyle.danger, custom_id="ticket_close"), "ticket_close"
+    ))
+    view.add_item(TicketComponentRouter(
+        Button(label="このチケットを対応する", style=ButtonStyle.success, custom_id="ticket_handle"), "ticket_handle"
+    ))
+    view.add_item(TicketComponentRouter(
+        Button(label="対応者を削除する", style=ButtonStyle.secondary, custom_id="ticket_remove_handler"), "ticket_remove_handler"
+    ))
+    return view
+
+
+def build_panel_view(guild_id: str, label: str) -> View:
+    """チケットパネルのView"""
+    button = Button(label=label, style=ButtonStyle.primary, custom_id=f"ticket_create_button_{guild_id}")
+    view = View(timeout=None)
+    view.add_item(TicketComponentRouter(button, "ticket_create_button"))
+    return view
 
 
 # =========================================================
@@ -423,7 +700,6 @@ class TicketPanelButton(discord.ui.Button):
 class TicketCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.bot.add_view(ConfirmCloseView(self.bot)) 
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -435,27 +711,30 @@ class TicketCog(commands.Cog):
         except Exception as e:
             print(f"ERROR: Failed to sync slash commands: {e}")
 
-        global panel_settings
-        panel_settings = _load_json(TICKET_PANEL_SETTINGS_FILE) 
+        # ボタンは setup で登録したルーターが処理するため、ここでのViewの復元は不要
+        _backfill_ticket_guilds(self.bot)
 
-        # Bot再起動時、永続的なボタンを復元
+        # 事前作成チャンネルのプールを引き取り、設定数まで補充する
         for guild_id, settings in panel_settings.items():
-            label = settings.get("label", "🎫 チケットを作成")
-            custom_id = f"ticket_create_button_{guild_id}"
-            
-            # チケットパネルボタンのViewを復元
-            view = View(timeout=None)
-            view.add_item(TicketPanelButton(self.bot, label, custom_id=custom_id)) 
-            self.bot.add_view(view)
+            pool_size = int(settings.get("pool_size", 0))
+            category = self.bot.get_channel(int(settings.get("category_id", 0)))
+            if pool_size and isinstance(category, discord.CategoryChannel):
+                ticket_pool.adopt(category)
+                ticket_pool.configure(category, pool_size)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        # チケットチャンネルが手動で削除された場合もデータと索引から外す
+        _forget_ticket(str(channel.id))
+        rename_scheduler.cancel(channel.id)
+        ticket_pool.discard(channel.id)
 
-            # チケット操作View (チャンネル内ボタン) の復元
-            staff_role_id = settings.get("staff_role_id")
-            global ticket_data
-            ticket_data = _load_json(TICKET_DATA_FILE)
-            for channel_id, data in ticket_data.items():
-                # チャンネルがまだ存在する場合のみViewを復元
-                if self.bot.get_channel(int(channel_id)):
-                     self.bot.add_view(TicketInitialView(self.bot, data["opener_id"], staff_role_id))
+    async def cog_unload(self):
+        rename_scheduler.stop()
+        ticket_pool.stop()
+        # 書き込み待ちのチケットの変更をファイルへ反映し、書き込みスレッドを終了する
+        # (再読み込み時はモジュールごと新しい TicketStore が作られる)
+        await asyncio.to_thread(ticket_store.close)
 
 
     # --- /ticket コマンド (パネル設置) ---
@@ -492,15 +771,25 @@ class TicketCog(commands.Cog):
         await interaction.response.defer() 
 
         guild_id = str(interaction.guild.id)
+        previous = panel_settings.get(guild_id, {})
+        pool_size = int(previous.get("pool_size", 0))
         
         panel_settings[guild_id] = {
             "category_id": str(category.id),
             "staff_role_id": str(role.id),
             "welcome_message": welcome if welcome is not None else "", 
-            "label": label
+            "label": label,
+            "pool_size": pool_size
         }
         _save_json(TICKET_PANEL_SETTINGS_FILE, panel_settings)
 
+        # カテゴリーを変更した場合は、事前作成チャンネルも新しいカテゴリーへ移す
+        old_category = interaction.guild.get_channel(int(previous.get("category_id", 0)))
+        if isinstance(old_category, discord.CategoryChannel) and old_category.id != category.id:
+            ticket_pool.configure(old_category, 0)
+        if pool_size:
+            ticket_pool.configure(category, pool_size)
+
         embed = discord.Embed(
             title=title,
             description=description,
@@ -509,9 +798,7 @@ class TicketCog(commands.Cog):
         if image:
             embed.set_image(url=image)
 
-        custom_id = f"ticket_create_button_{guild_id}"
-        view = View(timeout=None) 
-        view.add_item(TicketPanelButton(self.bot, label, custom_id=custom_id)) 
+        view = build_panel_view(guild_id, label)
 
         # followup.sendを使ってメッセージを送信 (deferが公開のため、ephemeral=Falseは省略可だが、明示的に指定)
         await interaction.followup.send(embed=embed, view=view, ephemeral=False)
@@ -520,11 +807,49 @@ class TicketCog(commands.Cog):
         await interaction.followup.send("✅ チケットパネルを正常に設置しました。Botを再起動してもボタンは機能し続けます。", ephemeral=True)
 
 
+    # --- /ticket_pool コマンド (チャンネルの事前作成) ---
+    @app_commands.command(
+        name="ticket_pool",
+        description="チケット用のチャンネルを事前作成しておき、チケットをすぐに開けるようにします（管理者専用）。"
+    )
+    @app_commands.describe(size=f"事前作成しておくチャンネル数（0で無効、最大{POOL_MAX_SIZE}）")
+    @app_commands.default_permissions(administrator=True)
+    async def ticket_pool_command(self, interaction: discord.Interaction, size: app_commands.Range[int, 0, POOL_MAX_SIZE]):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        settings = panel_settings.get(str(interaction.guild_id))
+        if not settings:
+            return await interaction.followup.send("❌ チケットパネルの設定が見つかりません。`/ticket` コマンドで設定してください。", ephemeral=True)
+        category = interaction.guild.get_channel(int(settings.get("category_id", 0)))
+        if not isinstance(category, discord.CategoryChannel):
+            return await interaction.followup.send("❌ 設定されたカテゴリーが見つかりません。", ephemeral=True)
+
+        try:
+            settings["pool_size"] = size
+            _save_json(TICKET_PANEL_SETTINGS_FILE, panel_settings)
+            ticket_pool.adopt(category)
+            ticket_pool.configure(category, size)
+            if size:
+                message = (
+                    f"✅ カテゴリー **{category.name}** にチケット用チャンネルを **{size}** 個事前作成しておきます。\n"
+                    "作成はバックグラウンドで順番に行われます。"
+                )
+            else:
+                message = "✅ チャンネルの事前作成を無効にしました。残っている事前作成チャンネルは削除されます。"
+            await interaction.followup.send(message, ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+
 async def setup(bot: commands.Bot):
-    global ticket_data
     global panel_settings
-    ticket_data = _load_json(TICKET_DATA_FILE)
     panel_settings = _load_json(TICKET_PANEL_SETTINGS_FILE)
+    _rebuild_ticket_index()
     
-    await bot.add_cog(TicketCog(bot))
-    bot.add_view(ConfirmCloseView(bot))
\ No newline at end of file
+    # 永続的なボタンはここで1回だけ登録する (再接続のたびに復元しない)
+    bot.add_dynamic_items(TicketComponentRouter)
+    bot.add_view(ConfirmCloseView(bot))
+    await bot.add_cog(TicketCog(bot))
\ No newline at end of file
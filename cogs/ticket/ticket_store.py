@@ -0,0 +1,182 @@
+# cogs/ticket/ticket_store.py
+
+import os
+import json
+import atexit
+import time
+import queue
+import threading
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+# =========================================================
+# 設定
+# =========================================================
+FSYNC_INTERVAL = 0.05    # この時間 (秒) 内に届いた変更はまとめて1回の fsync で書き込む
+SNAPSHOT_EVERY = 500     # この件数の変更ごとにスナップショットを保存してジャーナルを空にする
+
+
+# =========================================================
+# TicketStore (ジャーナル + スナップショットによるチケット状態の保存)
+# =========================================================
+class TicketStore:
+    """チケットの状態を追記型ジャーナルとスナップショットで保存するクラス
+
+    - snapshot_path (ticket_data.json) : ある時点の全チケット {channel_id: データ}
+    - journal_path                     : それ以降の変更を1行1件で追記
+                                         {"op": "set", "id", "data"} / {"op": "del", "id"}
+
+    data はイベントループ側が直接参照するメモリ上の状態で、set / delete は
+    data を更新して変更をキューに積むだけで戻る。ファイルへの書き込みは
+    専用のスレッドが行い、FSYNC_INTERVAL 秒内の変更を1回の fsync にまとめる。
+    書き込みスレッドは自分用の写しに変更を適用しておき、SNAPSHOT_EVERY 件ごとに
+    その写しをスナップショットとして書き出すため、ループ側で全体を直列化することはない。
+    起動時はスナップショットを読み、ジャーナルを再生する (set / del は何度適用しても同じ結果)。
+    書き込みスレッドはプロセス終了時 (atexit) またはコグのアンロード時の close() で
+    キューを書き切ってから終了する。
+    """
+    def __init__(self, snapshot_path: Path, journal_path: Path):
+        self.snapshot_path = Path(snapshot_path)
+        self.journal_path = Path(journal_path)
+        self.data: Dict[str, Dict[str, Any]] = self._load()
+        # 書き込みスレッド専用の写し (スナップショットの元)
+        self._mirror: Dict[str, Dict[str, Any]] = json.loads(json.dumps(self.data))
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self._closed = False
+
+    # --- 読み込み ---
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        data: Dict[str, Dict[str, Any]] = {}
+        if self.snapshot_path.exists():
+            try:
+                with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                    data = json.load(f) or {}
+            except Exception as e:
+                print(f"⚠️ 警告: チケットデータ {self.snapshot_path.name} が読み込めません: {e}")
+
+        self._since_snapshot = 0
+        if not self.journal_path.exists():
+            return data
+        with open(self.journal_path, "r+b") as f:
+            raw = f.read()
+            complete = raw[:raw.rfind(b"\n") + 1]
+            if len(complete) != len(raw):
+                # 書き込み途中で終わった末尾の行を切り捨てる
+                f.truncate(len(complete))
+        for line in complete.splitlines():
+            try:
+                self._apply(data, json.loads(line))
+                self._since_snapshot += 1
+            except (json.JSONDecodeError, KeyError) as e:
+                print(f"⚠️ 警告: チケットジャーナルの壊れた行をスキップしました: {e}")
+        return data
+
+    @staticmethod
+    def _apply(data: Dict[str, Dict[str, Any]], record: Dict[str, Any]):
+        if record["op"] == "set":
+            data[record["id"]] = record["data"]
+        elif record["op"] == "del":
+            data.pop(record["id"], None)
+
+    # --- 変更 ---
+    def set(self, channel_id: str, ticket: Dict[str, Any]):
+        """チケットを登録・更新する (ファイルへの書き込みは待たない)"""
+        self.data[channel_id] = ticket
+        self._append({"op": "set", "id": channel_id, "data": ticket})
+
+    def delete(self, channel_id: str) -> bool:
+        """チケットを削除する (登録されていなければ False)"""
+        if self.data.pop(channel_id, None) is None:
+            return False
+        self._append({"op": "del", "id": channel_id})
+        return True
+
+    def _append(self, record: Dict[str, Any]):
+        # 呼び出し時点の内容で直列化する (以降に data 側が書き換えられても影響しない)
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._thread_lock:
+            if not self._closed:
+                self._queue.put(line)
+                if self._thread is None:
+                    # デーモンスレッドは終了時に強制終了されるため、atexit で書き切らせる
+                    atexit.register(self.close)
+                    self._thread = threading.Thread(target=self._writer, name="ticket-journal-writer", daemon=True)
+                    self._thread.start()
+                return
+        # close() 後に届いた変更 (終了処理中のイベントなど) は、キューの書き込みが
+        # 終わるのを待ってからその場で書き込む (ジャーナルの順序を保つ)
+        if self._thread is not None:
+            self._thread.join()
+        with open(self.journal_path, "ab") as journal:
+            journal.write(line.encode("utf-8"))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def flush(self):
+        """キューに積まれた変更がすべて書き込まれるまで待つ (ブロッキング)"""
+        self._queue.join()
+
+    def close(self):
+        """キューに積まれた変更を書き切ってから書き込みスレッドを終了する (ブロッキング、何度呼んでもよい)"""
+        with self._thread_lock:
+            if not self._closed:
+                self._closed = True
+                if self._thread is not None:
+                    atexit.unregister(self.close)
+                    self._queue.put(None)  # 終了の合図 (これより前の変更はすべて書き込まれる)
+        if self._thread is not None:
+            self._thread.join()
+
+    # --- 書き込みスレッド ---
+    def _writer(self):
+        journal = open(self.journal_path, "ab")
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FSYNC_INTERVAL
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                closing = True
+                batch.pop()
+                self._queue.task_done()
+            try:
+                journal.write("".join(batch).encode("utf-8"))
+                journal.flush()
+                os.fsync(journal.fileno())
+                for line in batch:
+                    self._apply(self._mirror, json.loads(line))
+                self._since_snapshot += len(batch)
+                if self._since_snapshot >= SNAPSHOT_EVERY:
+                    self._write_snapshot()
+                    # スナップショットの確定後にジャーナルを空にする (間で落ちても再生は冪等)
+                    journal.truncate(0)
+                    os.fsync(journal.fileno())
+                    self._since_snapshot = 0
+            except Exception as e:
+                print(f"ERROR: チケットデータの書き込みに失敗しました: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        journal.close()
+
+    def _write_snapshot(self):
+        tmp_path = self.snapshot_path.with_name(self.snapshot_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._mirror, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        dir_fd = os.open(self.snapshot_path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
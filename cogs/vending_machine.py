@@ -5,123 +5,696 @@ from discord.ext import commands
 from discord import app_commands
 import os
 import json
-from datetime import datetime
 import asyncio
-from typing import Optional, List
-# 🔥 修正: VendingMachineクラスとファイル操作をvm_managementからインポート
-from .vm_management import VendingMachine
-# 🔥 修正: 通知関数を purchase_notifications.py からインポート
-from .purchase_notifications import send_purchase_notification 
+import time
+import hashlib
+import csv
+import bisect
+import re
+import tempfile
+import aiohttp
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple, Set, Callable, Awaitable
+# vm_management.pyからコアクラスと通知関数をインポート
+from .vm_management import VendingMachine, vm_registry, inventory_pools, add_change_listener, remove_change_listener, add_stock_listener, remove_stock_listener, add_delete_listener, remove_delete_listener
+from .vm_pipeline import purchase_pipeline
+from .vm_sales import get_sales_ledger, flush_all as flush_sales
+from .vm_alerts import stock_alerts, subscription_store
 
-# --- UI Components (購入ロジックを含む) ---
+# --- 表示キャッシュ ---
 
-class PurchaseButton(discord.ui.Button):
-    def __init__(self, vm_id: str, product_name: str, custom_id: str):
-        super().__init__(label="購入", style=discord.ButtonStyle.green, custom_id=custom_id)
-        self.vm_id = vm_id
-        self.product_name = product_name
+# 1ページあたりの商品数 (Discordのセレクト選択肢・Embedフィールドの上限)
+PAGE_SIZE = 25
+# まとめ買い1回あたりの最大個数
+CART_MAX_ITEMS = 500
+# DM本文の上限 (これを超える場合はアイテムをファイルで添付する)
+DM_CONTENT_LIMIT = 1900
+# まとめ買いの商品別内訳の上限 (応答・DMの本文が 2000 文字を超えないように残りは省略する)
+CART_SUMMARY_LIMIT = 1000
+# 購入通知に載せる商品名の上限 (Embedフィールドは 1024 文字まで)
+NOTIFICATION_NAME_LIMIT = 900
+
+
+def product_key(product_name: str) -> str:
+    """custom_id・セレクトの値に使う商品の短いキー (custom_id・値は100文字までのため商品名は入れない)"""
+    return "k" + hashlib.sha1(product_name.encode("utf-8")).hexdigest()[:12]
+
+
+class PanelRenderCache:
+    """描画済みのパネル (Embed辞書とSelectOption一覧) を (vm_id, version) 単位で保持するクラス
     
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.defer(ephemeral=True, thinking=True)
-        
-        # VMのロードと購入処理
-        try:
-            vm_data = VendingMachine.load_vm(self.vm_id)
-            vm = VendingMachine.from_dict(vm_data)
-            
-            # アイテムを購入 (在庫が減る場合はvm_management側で保存される)
-            item = vm.purchase_item(self.product_name)
-            
-            if not item:
-                return await interaction.followup.send("❌ 在庫切れ、または商品が見つかりません。", ephemeral=True)
-            
-            # 購入通知を送信 (この関数は purchase_notifications.py で定義されています)
-            await send_purchase_notification(
-                bot=interaction.client,
-                guild_id=interaction.guild_id,
-                user_id=interaction.user.id,
-                product_name=self.product_name,
-                price=vm.products[self.product_name]["price"],
-                item_content=item
-            )
-            
-            # 購入者にDMでアイテムを送信
+    VMが変更されるとバージョンが進むため、古い描画結果は次の参照時に作り直される。
+    商品選択・ページ切り替え時は辞書参照だけで済み、ファイル読み込みやEmbedの再構築を行わない。
+    商品名の並び・位置・前方一致検索用の索引は商品構成が変わったときだけ作り直す。
+    """
+    def __init__(self):
+        # {vm_id: {"version": int, "pages": {page: (dict, list)}, "selected": {product_name: (dict, list)}}}
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        # {vm_id: {"version": int, "names": list, "positions": dict, "keys": dict, "prefix_keys": list, "prefix_names": list}}
+        self._catalogs: Dict[str, Dict[str, Any]] = {}
+
+    # --- 商品構成の索引 ---
+    def _catalog(self, vm: VendingMachine) -> Dict[str, Any]:
+        catalog = self._catalogs.get(vm.vm_id)
+        if catalog is None or catalog["version"] != vm.catalog_version or len(catalog["names"]) != len(vm.products):
+            names = list(vm.products)
+            prefix = sorted((name.lower(), name) for name in names)
+            catalog = {
+                "version": vm.catalog_version,
+                "names": names,
+                "positions": {name: i for i, name in enumerate(names)},
+                "keys": {product_key(name): name for name in names},
+                "prefix_keys": [key for key, _ in prefix],
+                "prefix_names": [name for _, name in prefix],
+            }
+            self._catalogs[vm.vm_id] = catalog
+        return catalog
+
+    def page_count(self, vm: VendingMachine) -> int:
+        return max(1, -(-len(self._catalog(vm)["names"]) // PAGE_SIZE))
+
+    def page_of(self, vm: VendingMachine, product_name: str) -> int:
+        """商品が載っているページ番号 (見つからない場合は0)"""
+        return self._catalog(vm)["positions"].get(product_name, 0) // PAGE_SIZE
+
+    def resolve_product(self, vm: VendingMachine, value: str) -> str:
+        """custom_id・セレクトの値を商品名に戻す (キー導入前のパネルは商品名がそのまま入っている)"""
+        return self._catalog(vm)["keys"].get(value, value)
+
+    def search(self, vm: VendingMachine, query: str, limit: int = PAGE_SIZE) -> List[str]:
+        """商品名の前方一致検索 (大文字小文字を区別しない)。二分探索で先頭を求める"""
+        catalog = self._catalog(vm)
+        keys = catalog["prefix_keys"]
+        query = query.strip().lower()
+        results = []
+        i = bisect.bisect_left(keys, query)
+        while i < len(keys) and keys[i].startswith(query) and len(results) < limit:
+            results.append(catalog["prefix_names"][i])
+            i += 1
+        return results
+
+    # --- 描画結果 ---
+    def _entry(self, vm: VendingMachine) -> Dict[str, Any]:
+        entry = self._entries.get(vm.vm_id)
+        if entry is None or entry["version"] != vm.version:
+            entry = {"version": vm.version, "pages": {}, "selected": {}}
+            self._entries[vm.vm_id] = entry
+        return entry
+
+    def get_page(self, vm: VendingMachine, page: int = 0) -> Tuple[Dict[str, Any], List[discord.SelectOption], int]:
+        """未選択状態のページのEmbed辞書とオプション一覧 (戻り値の3つ目は補正後のページ番号)"""
+        total = self.page_count(vm)
+        page = min(max(page, 0), total - 1)
+        entry = self._entry(vm)
+        rendered = entry["pages"].get(page)
+        if rendered is None:
+            names = self._catalog(vm)["names"][page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+            page_label = f"ページ {page + 1}/{total}" if total > 1 else None
+            rendered = (vm.create_embed(product_names=names, page_label=page_label).to_dict(), build_select_options(vm, names))
+            entry["pages"][page] = rendered
+        return rendered[0], rendered[1], page
+
+    def get_panel(self, vm: VendingMachine) -> Tuple[Dict[str, Any], List[discord.SelectOption]]:
+        """1ページ目の未選択状態のEmbed辞書とオプション一覧"""
+        embed_dict, options, _ = self.get_page(vm, 0)
+        return embed_dict, options
+
+    def get_selected(self, vm: VendingMachine, product_name: str) -> Tuple[Dict[str, Any], List[discord.SelectOption], int]:
+        """商品選択中のEmbed辞書とオプション一覧 (選択中の商品が載っているページを表示)"""
+        page = self.page_of(vm, product_name)
+        entry = self._entry(vm)
+        selected = entry["selected"].get(product_name)
+        if selected is None:
+            page_embed, page_options, page = self.get_page(vm, page)
+            options = [
+                discord.SelectOption(label=o.label, value=o.value, description=o.description, default=(o.value == product_key(product_name)))
+                for o in page_options
+            ]
+            embed_dict = dict(page_embed, title=f"🛒 {vm.name} - {product_name} 選択中")
+            selected = (embed_dict, options)
+            entry["selected"][product_name] = selected
+        return selected[0], selected[1], page
+
+    def invalidate(self, vm_id: str):
+        self._entries.pop(vm_id, None)
+        self._catalogs.pop(vm_id, None)
+
+
+def build_select_options(vm: VendingMachine, product_names: Optional[List[str]] = None) -> List[discord.SelectOption]:
+    """商品セレクトのオプションを構築"""
+    options = []
+    for product_name in (product_names if product_names is not None else vm.products):
+        product_info = vm.products[product_name]
+        stock_display = f"{vm.stock_count(product_name)}個"
+        price = product_info["price"]
+        label = f"{product_name} - ¥{price:,}"
+        description = f"{price:,}円｜在庫: {stock_display} / {product_info['description'][:50]}"
+        options.append(discord.SelectOption(
+            label=label[:100],
+            value=product_key(product_name),
+            description=description[:100]
+        ))
+    return options
+
+
+panel_cache = PanelRenderCache()
+
+
+# --- 投稿済みパネルの在庫表示の自動更新 ---
+
+class PanelRefresher:
+    """VMの変更を受けて、投稿済みパネルのEmbedとセレクトをまとめて更新するクラス
+    
+    変更のたびに編集するのではなく、1メッセージあたり EDIT_INTERVAL 秒に
+    1回まで編集をまとめる。描画結果が前回の編集と同じ場合は編集しない。
+    メッセージごとに表示中のページ・選択中の商品を覚えておき、その表示のまま描き直す。
+    投稿・ページ切り替え・商品選択・起動の時点で表示中の内容を記録しておき、
+    見た目の変わらない変更 (パネル位置の保存など) では編集しない。
+    """
+    EDIT_INTERVAL = 5.0
+
+    def __init__(self):
+        self.bot: Optional[commands.Bot] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # {vm_id: 予約済みの更新タスク}
+        self._pending: Dict[str, asyncio.Task] = {}
+        # {vm_id: 最後に更新した時刻}
+        self._last_flush: Dict[str, float] = {}
+        # {message_id: 最後に書き込んだEmbedとセレクトのハッシュ}
+        self._last_digest: Dict[str, str] = {}
+        # {message_id: (表示中のページ番号, 選択中の商品名)} (切り替え時に記録、未記録は1ページ目・未選択)
+        self._views: Dict[str, Tuple[int, Optional[str]]] = {}
+        # {vm_id: {message_id, ...}} 自販機の削除時に上の2つから取り除くための索引
+        self._messages: Dict[str, Set[str]] = {}
+
+    def _render(self, vm: VendingMachine, page: int, selected: Optional[str]):
+        """(ハッシュ, Embed辞書, オプション一覧, ページ番号, 選択中の商品名) を返す"""
+        if selected is not None and selected in vm.products:
+            embed_dict, options, page = panel_cache.get_selected(vm, selected)
+        else:
+            selected = None
+            embed_dict, options, page = panel_cache.get_page(vm, page)
+        rendered = [embed_dict, selected, page, [(o.label, o.description) for o in options]]
+        digest = hashlib.sha1(json.dumps(rendered, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+        return digest, embed_dict, options, page, selected
+
+    def set_view(self, vm: VendingMachine, message_id, page: int = 0, selected_product_name: Optional[str] = None):
+        """パネルに今表示している内容を記録する (投稿・切り替えでメッセージを書き換えた直後に呼ぶ)"""
+        message_id = str(message_id)
+        self._views[message_id] = (page, selected_product_name)
+        self._last_digest[message_id] = self._render(vm, page, selected_product_name)[0]
+        self._messages.setdefault(vm.vm_id, set()).add(message_id)
+
+    def _forget_message(self, vm_id: str, message_id: str):
+        self._views.pop(message_id, None)
+        self._last_digest.pop(message_id, None)
+        self._messages.get(vm_id, set()).discard(message_id)
+
+    def forget_vm(self, vm_id: str):
+        """削除された自販機のパネルの記録を破棄する (削除リスナー)"""
+        for message_id in self._messages.pop(vm_id, set()):
+            self._views.pop(message_id, None)
+            self._last_digest.pop(message_id, None)
+        self._last_flush.pop(vm_id, None)
+        task = self._pending.pop(vm_id, None)
+        if task is not None:
+            task.cancel()
+
+    def start(self, bot: commands.Bot):
+        self.bot = bot
+        self._loop = asyncio.get_running_loop()
+        add_change_listener(self.on_vm_changed)
+        add_delete_listener(self.forget_vm)
+        # 再起動直後の最初の変更で同じ内容を書き直さないよう、投稿済みパネルの表示を記録する
+        # (再起動前の表示は1ページ目・未選択として扱う)
+        for vm_id in vm_registry.list_all_vms():
             try:
-                await interaction.user.send(
-                    f"🎉 **ご購入ありがとうございます！**\n"
-                    f"商品: `{self.product_name}`\n"
-                    f"--- アイテム内容 ---\n"
-                    f"```{item}```"
-                )
-                await interaction.followup.send("✅ DMに商品を送りました。", ephemeral=True)
-            except discord.Forbidden:
-                await interaction.followup.send("❌ DMを送信できませんでした。DM設定を確認してください。", ephemeral=True)
+                vm = vm_registry.get_vm(vm_id)
+            except Exception as e:
+                print(f"⚠️ 警告: 自販機 {vm_id} のパネルを記録できませんでした: {e}")
+                continue
+            for panel in vm.panels:
+                self.set_view(vm, panel["message_id"])
+
+    def stop(self):
+        remove_change_listener(self.on_vm_changed)
+        remove_delete_listener(self.forget_vm)
+        for task in self._pending.values():
+            task.cancel()
+        self._pending.clear()
+
+    def on_vm_changed(self, vm: VendingMachine):
+        if not vm.panels or self._loop is None:
+            return
+        # 別スレッドから呼ばれる場合もあるため、イベントループ上で予約する
+        self._loop.call_soon_threadsafe(self._schedule, vm.vm_id)
+
+    def _schedule(self, vm_id: str):
+        if vm_id in self._pending:
+            return  # 既に予約済み (この間の変更は次の更新にまとめられる)
+        elapsed = time.monotonic() - self._last_flush.get(vm_id, 0.0)
+        delay = max(0.0, self.EDIT_INTERVAL - elapsed)
+        self._pending[vm_id] = self._loop.create_task(self._flush_later(vm_id, delay))
 
+    async def _flush_later(self, vm_id: str, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._pending.pop(vm_id, None)
+        self._last_flush[vm_id] = time.monotonic()
+        try:
+            vm = vm_registry.get_vm(vm_id)
         except FileNotFoundError:
-            await interaction.followup.send("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
-        except Exception as e:
-            await interaction.followup.send(f"❌ 購入中にエラーが発生しました: {str(e)}", ephemeral=True)
+            return
+
+        removed = []
+        for panel in list(vm.panels):
+            message_id = panel["message_id"]
+            page, selected = self._views.get(message_id, (0, None))
+            digest, embed_dict, options, page, selected = self._render(vm, page, selected)
+            if self._last_digest.get(message_id) == digest:
+                continue
+            embed = discord.Embed.from_dict(embed_dict)
+            view = build_panel_view(vm_id, options, selected, page, panel_cache.page_count(vm))
+            try:
+                channel = self.bot.get_partial_messageable(int(panel["channel_id"]))
+                await channel.get_partial_message(int(message_id)).edit(embed=embed, view=view)
+                self._last_digest[message_id] = digest
+                self._messages.setdefault(vm_id, set()).add(message_id)
+            except (discord.NotFound, discord.Forbidden):
+                # 削除されたメッセージ・見えなくなったチャンネルは追跡をやめる
+                removed.append(panel)
+                self._forget_message(vm_id, message_id)
+            except discord.HTTPException as e:
+                print(f"⚠️ 警告: 自販機パネル {message_id} の更新に失敗しました: {e}")
+
+        if removed:
+            vm.panels = [p for p in vm.panels if p not in removed]
+            vm.save_vm()
+
+
+panel_refresher = PanelRefresher()
+
+
+# --- 自販機エンジン (ルーターから呼ばれる処理本体) ---
+
+async def handle_purchase(interaction: discord.Interaction, vm_id: str, product_name: str):
+    """購入ボタンの処理"""
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    
+    # Paypay連携ロジックなどが入る場合もありますが、ここでは直接購入処理を実行します
+    
+    try:
+        vm = vm_registry.get_vm(vm_id)
+        
+        # アイテムを購入 (VM単位で直列化され、同じinteractionの再送では在庫を消費しない)
+        item, duplicate = await vm.purchase(product_name, interaction.id, interaction.user.id)
+        
+        if not item:
+            return await interaction.followup.send(f"❌ 商品`{product_name}`は現在、在庫切れです。", ephemeral=True)
+        if duplicate:
+            return await interaction.followup.send("⚠️ この購入は既に処理されています。DMをご確認ください。", ephemeral=True)
+        
+        # 在庫の確定後すぐに応答し、通知とDMはバックグラウンドで送る
+        await interaction.followup.send("✅ 購入が完了しました。DMに商品をお送りします。", ephemeral=True)
+
+        # 購入通知を送信
+        await purchase_pipeline.submit({
+            "type": "notification",
+            "guild_id": interaction.guild_id,
+            "user_id": interaction.user.id,
+            "product_name": product_name,
+            "price": vm.products[product_name]["price"],
+            "item_content": item,
+            "vm_id": vm_id
+        })
+        
+        # 購入者にDMでアイテムを送信 (DMが閉じている場合はエフェメラルで代替送信)
+        await purchase_pipeline.submit({
+            "type": "dm",
+            "user_id": interaction.user.id,
+            "content": (
+                f"🎉 **ご購入ありがとうございます！**\n"
+                f"自販機: `{vm.name}`\n"
+                f"商品: `{product_name}`\n"
+                f"--- アイテム内容 ---\n"
+                f"```{item}```"
+            ),
+            "_interaction": interaction
+        })
+
+    except FileNotFoundError:
+        await interaction.followup.send("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
+    except Exception as e:
+        await interaction.followup.send(f"❌ 購入中に予期せぬエラーが発生しました: {str(e)}", ephemeral=True)
+
+
+def _truncate(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
 
 
-class ProductSelect(discord.ui.Select):
-    def __init__(self, vm_id: str, options: list):
-        super().__init__(
-            custom_id=f"vm_select_{vm_id}",
-            placeholder="商品を選択してください...",
-            options=options
+def _cart_summary(result: Dict[str, List[str]], limit: int = CART_SUMMARY_LIMIT) -> str:
+    """まとめ買いの商品別内訳 (limit 文字を超える分は商品数だけ表示する)"""
+    lines: List[str] = []
+    length = 0
+    for index, (name, items) in enumerate(result.items()):
+        line = f"`{name}` × {len(items)}"
+        if length + len(line) + 1 > limit:
+            lines.append(f"…ほか {len(result) - index} 商品")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+async def handle_cart_purchase(interaction: discord.Interaction, vm_id: str, cart: Dict[str, int]):
+    """まとめ買いの処理 (在庫の確定・DM・通知をそれぞれ1回で行う)"""
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    try:
+        vm = vm_registry.get_vm(vm_id)
+
+        result, duplicate = await vm.purchase_cart(cart, interaction.id, interaction.user.id)
+
+        if result is None:
+            shortages = [
+                f"`{name}`: 希望 {quantity} 個 / 在庫 {vm.stock_count(name) if name in vm.products else 0} 個"
+                for name, quantity in cart.items()
+                if name not in vm.products or (vm.stock_count(name) != "∞" and vm.stock_count(name) < quantity)
+            ]
+            if not shortages:
+                # 商品ごとには足りていても、同じ共有在庫プールを使う商品の合計が足りない
+                shortages = ["同じ在庫プールを共有する商品の合計数が、プールの在庫を超えています。"]
+            return await interaction.followup.send("❌ 在庫が足りないため購入できませんでした。\n" + "\n".join(shortages), ephemeral=True)
+        if duplicate:
+            return await interaction.followup.send("⚠️ この購入は既に処理されています。DMをご確認ください。", ephemeral=True)
+
+        total_units = sum(len(items) for items in result.values())
+        total_price = sum(vm.products[name]["price"] * len(items) for name, items in result.items())
+        summary = _cart_summary(result)
+        await interaction.followup.send(
+            f"✅ {total_units} 個の購入が完了しました（合計 ¥{total_price:,}）。DMに商品をお送りします。\n{summary}",
+            ephemeral=True
         )
-        self.vm_id = vm_id
 
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.defer()
-        selected_product_name = self.values[0]
+        item_text = "\n\n".join(
+            f"[{name}]\n" + "\n".join(items) for name, items in result.items()
+        )
+
+        # 購入通知を1件だけ送信
+        await purchase_pipeline.submit({
+            "type": "notification",
+            "guild_id": interaction.guild_id,
+            "user_id": interaction.user.id,
+            "product_name": _truncate(", ".join(f"{name} ×{len(items)}" for name, items in result.items()), NOTIFICATION_NAME_LIMIT),
+            "price": total_price,
+            "item_content": item_text,
+            "vm_id": vm_id,
+            "products": list(result)
+        })
+
+        # 全アイテムを1通のDMで送信 (長すぎる場合はファイルで添付)
+        header = (
+            f"🎉 **ご購入ありがとうございます！**\n"
+            f"自販機: `{vm.name}`\n"
+            f"{summary}\n"
+            f"合計: ¥{total_price:,}\n"
+        )
+        dm_job = {"type": "dm", "user_id": interaction.user.id, "_interaction": interaction}
+        body = f"--- アイテム内容 ---\n```{item_text}```"
+        if len(header) + len(body) <= DM_CONTENT_LIMIT:
+            dm_job["content"] = header + body
+        else:
+            dm_job["content"] = header + "アイテムは添付ファイルをご確認ください。"
+            dm_job["attachment"] = item_text
+            dm_job["filename"] = f"{vm.name}_items.txt"
+        await purchase_pipeline.submit(dm_job)
+
+    except FileNotFoundError:
+        await interaction.followup.send("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
+    except Exception as e:
+        await interaction.followup.send(f"❌ 購入中に予期せぬエラーが発生しました: {str(e)}", ephemeral=True)
+
+
+async def handle_product_select(interaction: discord.Interaction, vm_id: str, selected_product_name: str):
+    """商品セレクトの処理 (パネルを選択中の表示に切り替える)"""
+    await interaction.response.defer()
+    
+    try:
+        vm = vm_registry.get_vm(vm_id)
+
+        # 描画済みのEmbedとオプションをキャッシュから取得 (VMが変更されていなければ辞書参照のみ)
+        embed_dict, options, page = panel_cache.get_selected(vm, selected_product_name)
+        if interaction.message:
+            panel_refresher.set_view(vm, interaction.message.id, page, selected_product_name)
+
+        # メッセージを更新
+        await interaction.edit_original_response(
+            embed=discord.Embed.from_dict(embed_dict),
+            view=build_panel_view(vm_id, options, selected_product_name, page, panel_cache.page_count(vm))
+        )
         
+    except FileNotFoundError:
+        await interaction.followup.send("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
+    except Exception as e:
+        await interaction.followup.send(f"❌ 選択中にエラーが発生しました: {str(e)}", ephemeral=True)
+
+
+async def handle_page(interaction: discord.Interaction, vm_id: str, page: int):
+    """ページ切り替えボタンの処理 (キャッシュ済みのページ描画を返す)"""
+    try:
+        vm = vm_registry.get_vm(vm_id)
+        embed_dict, options, page = panel_cache.get_page(vm, page)
+        if interaction.message:
+            panel_refresher.set_view(vm, interaction.message.id, page)
+        await interaction.response.edit_message(
+            embed=discord.Embed.from_dict(embed_dict),
+            view=build_panel_view(vm_id, options, None, page, panel_cache.page_count(vm))
+        )
+    except FileNotFoundError:
+        await interaction.response.send_message("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
+    except Exception as e:
+        await interaction.response.send_message(f"❌ ページの切り替え中にエラーが発生しました: {str(e)}", ephemeral=True)
+
+
+class ProductSearchModal(discord.ui.Modal):
+    """商品名の前方一致検索モーダル"""
+    def __init__(self, vm_id: str):
+        super().__init__(title="商品を検索")
+        self.vm_id = vm_id
+        self.query = discord.ui.TextInput(
+            label="商品名 (前方一致)",
+            placeholder="商品名の先頭を入力してください",
+            max_length=100,
+            required=True
+        )
+        self.add_item(self.query)
+
+    async def on_submit(self, interaction: discord.Interaction):
         try:
-            vm_data = VendingMachine.load_vm(self.vm_id)
-            vm = VendingMachine.from_dict(vm_data)
+            vm = vm_registry.get_vm(self.vm_id)
+        except FileNotFoundError:
+            return await interaction.response.send_message("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
 
-            # Viewを再構築
-            new_view = VendingMachineView(self.vm_id)
-            new_view.children = [c for c in new_view.children if not isinstance(c, PurchaseButton)]
-            
-            # 新しいボタンを作成してViewに追加
-            purchase_button = PurchaseButton(
-                vm_id=self.vm_id,
-                product_name=selected_product_name,
-                custom_id=f"purchase_{self.vm_id}_{selected_product_name}"
-            )
-            new_view.add_item(purchase_button)
+        names = panel_cache.search(vm, self.query.value)
+        if not names:
+            return await interaction.response.send_message(f"🔍 `{self.query.value}` で始まる商品は見つかりませんでした。", ephemeral=True)
 
-            # Embedを更新
-            embed = vm.create_embed(selected_product_name)
+        # 検索結果から選ぶと、このメッセージが該当ページの購入画面に切り替わる
+        view = discord.ui.View(timeout=None)
+        select = discord.ui.Select(
+            custom_id=f"vm_select_{self.vm_id}",
+            placeholder="検索結果から商品を選択してください...",
+            options=build_select_options(vm, names)
+        )
+        view.add_item(VMComponentRouter(select, "vm_select", self.vm_id))
+        await interaction.response.send_message(f"🔍 `{self.query.value}` の検索結果: **{len(names)}** 件", view=view, ephemeral=True)
 
-            # メッセージを更新
-            await interaction.edit_original_response(embed=embed, view=new_view)
-            
+
+class CartModal(discord.ui.Modal):
+    """まとめ買いモーダル (1行に「商品名 数量」を入力)"""
+    LINE_PATTERN = re.compile(r"^(?P<name>.+?)\s*(?:[x×*]\s*)?(?P<quantity>\d+)$")
+
+    def __init__(self, vm_id: str, selected_product_name: Optional[str] = None):
+        super().__init__(title="まとめ買い")
+        self.vm_id = vm_id
+        self.cart_input = discord.ui.TextInput(
+            label="商品名と数量（1行に1商品）",
+            style=discord.TextStyle.paragraph,
+            placeholder="商品A 3\n商品B 1",
+            default=f"{selected_product_name} 1" if selected_product_name else None,
+            max_length=2000,
+            required=True
+        )
+        self.add_item(self.cart_input)
+
+    @classmethod
+    def parse(cls, text: str, products: Dict[str, Any]) -> Dict[str, int]:
+        """入力を {商品名: 数量} に変換する (数量を省略した行は1個、同じ商品は合算)
+
+        行全体が商品名に一致する場合は、末尾の数字も商品名の一部として扱う。
+        """
+        cart: Dict[str, int] = {}
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            match = None if line in products else cls.LINE_PATTERN.match(line)
+            name, quantity = (match["name"].strip(), int(match["quantity"])) if match else (line, 1)
+            cart[name] = cart.get(name, 0) + quantity
+        return cart
+
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            vm = vm_registry.get_vm(self.vm_id)
         except FileNotFoundError:
-            await interaction.followup.send("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
-        except Exception as e:
-            await interaction.followup.send(f"❌ 選択中にエラーが発生しました: {str(e)}", ephemeral=True)
+            return await interaction.response.send_message("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
 
+        cart = self.parse(self.cart_input.value, vm.products)
+        unknown = [name for name in cart if name not in vm.products]
+        if unknown:
+            return await interaction.response.send_message("❌ 商品が見つかりません: " + ", ".join(f"`{name}`" for name in unknown), ephemeral=True)
+        if not cart or any(quantity <= 0 for quantity in cart.values()):
+            return await interaction.response.send_message("❌ 数量は1以上で指定してください。", ephemeral=True)
+        if sum(cart.values()) > CART_MAX_ITEMS:
+            return await interaction.response.send_message(f"❌ 一度に購入できるのは {CART_MAX_ITEMS} 個までです。", ephemeral=True)
 
-class VendingMachineView(discord.ui.View):
-    def __init__(self, vm_id: str):
-        super().__init__(timeout=None)
+        await handle_cart_purchase(interaction, self.vm_id, cart)
+
+
+# --- UI Components (custom_id を解析してエンジンに振り分ける単一ルーター) ---
+
+class VMComponentRouter(
+    discord.ui.DynamicItem[discord.ui.Item],
+    template=r"(?P<action>vm_select|vm_page|vm_search|vm_cart|purchase)_(?P<vm_id>[0-9A-Za-z]+)(?:_(?P<arg>.+))?"
+):
+    """自販機パネルの全ボタン・セレクトを受け付けるルーター
+    
+    custom_id (例: vm_select_{vm_id}, purchase_{vm_id}_{商品キー}) を正規表現で解析して
+    処理を振り分けるため、VMごとのViewをメモリに持つ必要がなく、再起動後も
+    これまでに投稿したすべてのパネルがそのまま動作する。
+    """
+    def __init__(self, item: discord.ui.Item, action: str, vm_id: str, arg: Optional[str] = None):
+        super().__init__(item)
+        self.action = action
         self.vm_id = vm_id
-        self.add_item(ProductSelect(vm_id, options=[]))
-        # 初期の購入ボタンは無効で追加しておく
-        self.add_item(PurchaseButton(vm_id, "default", f"purchase_{vm_id}_default_disabled"))
+        self.arg = arg
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Item, match):
+        return cls(item, match["action"], match["vm_id"], match["arg"])
+
+    def _product_name(self, value: Optional[str]) -> Optional[str]:
+        if not value:
+            return value
+        try:
+            return panel_cache.resolve_product(vm_registry.get_vm(self.vm_id), value)
+        except FileNotFoundError:
+            return value # 削除済みの自販機 (各処理側でエラーを返す)
+
+    async def callback(self, interaction: discord.Interaction):
+        if self.action == "vm_select":
+            values = interaction.data.get("values") or []
+            if values:
+                await handle_product_select(interaction, self.vm_id, self._product_name(values[0]))
+        elif self.action == "purchase":
+            await handle_purchase(interaction, self.vm_id, self._product_name(self.arg) or "")
+        elif self.action == "vm_page":
+            await handle_page(interaction, self.vm_id, int(self.arg) if (self.arg or "").isdigit() else 0)
+        elif self.action == "vm_search":
+            await interaction.response.send_modal(ProductSearchModal(self.vm_id))
+        elif self.action == "vm_cart":
+            await interaction.response.send_modal(CartModal(self.vm_id, self._product_name(self.arg)))
+
+
+def build_panel_view(
+    vm_id: str,
+    options: List[discord.SelectOption],
+    selected_product_name: Optional[str] = None,
+    page: int = 0,
+    page_count: int = 1
+) -> discord.ui.View:
+    """パネルのViewを構築 (全コンポーネントをルーターで包むため、Viewは保持されない)"""
+    view = discord.ui.View(timeout=None)
+    select = discord.ui.Select(
+        custom_id=f"vm_select_{vm_id}",
+        placeholder="商品を選択してください...",
+        options=options,
+        row=0
+    )
+    view.add_item(VMComponentRouter(select, "vm_select", vm_id))
+    
+    if selected_product_name:
+        button = discord.ui.Button(
+            label=f"『{_truncate(selected_product_name, 70)}』を購入",  # ボタンのラベルは80文字まで
+            style=discord.ButtonStyle.green,
+            custom_id=f"purchase_{vm_id}_{product_key(selected_product_name)}",
+            row=1
+        )
+    else:
+        # 初期の購入ボタンは無効で表示しておく (Selectで選択されたら置き換えられる)
+        button = discord.ui.Button(
+            label="『商品を選択してください』を購入",
+            style=discord.ButtonStyle.green,
+            custom_id=f"purchase_{vm_id}_default_disabled",
+            disabled=True,
+            row=1
+        )
+    view.add_item(VMComponentRouter(button, "purchase", vm_id, product_key(selected_product_name) if selected_product_name else None))
+
+    # まとめ買い (選択中の商品があれば入力欄に初期値として入れる)
+    cart_button = discord.ui.Button(
+        label="🛒 まとめ買い",
+        style=discord.ButtonStyle.primary,
+        custom_id=f"vm_cart_{vm_id}_{product_key(selected_product_name)}" if selected_product_name else f"vm_cart_{vm_id}",
+        row=1
+    )
+    view.add_item(VMComponentRouter(cart_button, "vm_cart", vm_id, product_key(selected_product_name) if selected_product_name else None))
+
+    # 商品が1ページに収まらない場合のみページ切り替え・検索を表示
+    if page_count > 1:
+        prev_button = discord.ui.Button(
+            label="◀ 前のページ",
+            style=discord.ButtonStyle.secondary,
+            custom_id=f"vm_page_{vm_id}_{max(page - 1, 0)}",
+            disabled=(page <= 0),
+            row=2
+        )
+        next_button = discord.ui.Button(
+            label=f"次のページ ▶ ({page + 1}/{page_count})",
+            style=discord.ButtonStyle.secondary,
+            custom_id=f"vm_page_{vm_id}_{min(page + 1, page_count - 1)}",
+            disabled=(page >= page_count - 1),
+            row=2
+        )
+        search_button = discord.ui.Button(
+            label="🔍 商品を検索",
+            style=discord.ButtonStyle.primary,
+            custom_id=f"vm_search_{vm_id}",
+            row=2
+        )
+        view.add_item(VMComponentRouter(prev_button, "vm_page", vm_id, str(max(page - 1, 0))))
+        view.add_item(VMComponentRouter(next_button, "vm_page", vm_id, str(min(page + 1, page_count - 1))))
+        view.add_item(VMComponentRouter(search_button, "vm_search", vm_id))
+    return view
 
 
 # --- Cog: 自販機の表示 (/vmpost) ---
 class CreateVendingMachineCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self._registered_views = set() 
+
+    async def cog_unload(self):
+        panel_refresher.stop()
+        remove_delete_listener(panel_cache.invalidate)
+        remove_stock_listener(stock_alerts.on_stock_event)
+        stock_alerts.stop()
+        await purchase_pipeline.stop()
+        flush_sales()
 
     @app_commands.command(
-        name="vmpost", # 🔥 修正コマンド名
-        description="指定した自動販売機をチャンネルに表示します。"
+        name="vmpost", 
+        description="指定した自動販売機をチャンネルに表示します（管理者専用）。"
     )
     @app_commands.describe(vm_name="表示したい自動販売機の名前")
     async def vmpost_command(self, interaction: discord.Interaction, vm_name: str):
@@ -135,38 +708,20 @@ class CreateVendingMachineCog(commands.Cog):
             if not vm_id:
                 return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
                 
-            vm_data = VendingMachine.load_vm(vm_id)
-            vm = VendingMachine.from_dict(vm_data)
-
-            view = VendingMachineView(vm_id)
-            embed = vm.create_embed()
-
-            # オプションの構築
-            options = []
-            for product_name, product_info in vm.products.items():
-                stock_count = "∞" if product_info.get("infinite_stock", False) else len(product_info.get("stock", []))
-                stock_display = f"{stock_count}個"
-                price = product_info["price"]
-                label = f"{product_name} - ¥{price}"
-                description = f"{price}円｜在庫: {stock_display} / {product_info['description'][:50]}"
-                
-                options.append(discord.SelectOption(
-                    label=label,
-                    value=product_name,
-                    description=description
-                ))
-            
-            # セレクトコンポーネントにオプションを設定
-            select_component = next((c for c in view.children if isinstance(c, ProductSelect)), None)
-            if select_component:
-                select_component.options = options
-            
-            # 永続Viewの登録
-            if vm_id not in self._registered_views:
-                self.bot.add_view(view)
-                self._registered_views.add(vm_id)
-            
-            await interaction.channel.send(embed=embed, view=view)
+            vm = vm_registry.get_vm(vm_id)
+
+            embed_dict, options = panel_cache.get_panel(vm)
+            embed = discord.Embed.from_dict(embed_dict)
+            view = build_panel_view(vm_id, options, None, 0, panel_cache.page_count(vm))
+
+            message = await interaction.channel.send(embed=embed, view=view)
+
+            # 在庫変更時に自動更新できるよう、パネルの位置を記録
+            vm.panels.append({"channel_id": str(message.channel.id), "message_id": str(message.id)})
+            vm.save_vm()
+            # 投稿した内容を記録し、この保存による更新で同じ内容を書き直さない
+            panel_refresher.set_view(vm, message.id)
+
             await interaction.followup.send(f"✅ 自販機`{vm_name}`をこのチャンネルに表示しました。", ephemeral=True)
             
         except Exception as e:
@@ -175,10 +730,12 @@ class CreateVendingMachineCog(commands.Cog):
 
 # --- Cog: 商品の追加 (/vm_add_product) ---
 class AddProductToVMCog(commands.Cog):
-    # ...
+    def __init__(self, bot):
+        self.bot = bot
+
     @app_commands.command(
-        name="vm_add_product", # 🔥 修正コマンド名
-        description="自販機に新しい商品スロットを追加します。"
+        name="vm_add_product", 
+        description="自販機に新しい商品スロットを追加します（管理者専用）。"
     )
     @app_commands.describe(
         vm_name="自販機の名前",
@@ -197,270 +754,628 @@ class AddProductToVMCog(commands.Cog):
             return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
 
         try:
-            vm_data = VendingMachine.load_vm(vm_id)
-            # 商品データを直接更新
-            vm_data["products"][product_name] = {
+            vm = vm_registry.get_vm(vm_id)
+            
+            if product_name in vm.products:
+                return await interaction.followup.send(f"❌ 商品`{product_name}`は既に存在します。在庫を追加する場合は別のコマンドを使ってください。", ephemeral=True)
+
+            # 商品データを更新
+            vm.products[product_name] = {
                 "price": price,
                 "description": description,
-                "stock": [],
+                "stock_id": os.urandom(6).hex(),
+                "stock_count": 0,
                 "infinite_stock": False,
                 "infinite_item": ""
             }
-            
-            # VendingMachineクラスのsave_vmを再利用する
-            vm = VendingMachine.from_dict(vm_data)
             vm.save_vm()
                 
-            await interaction.followup.send(f"✅ 自販機`{vm_name}`に商品`{product_name}` (¥{price}) を追加しました。", ephemeral=True)
+            await interaction.followup.send(f"✅ 自販機`{vm_name}`に商品`{product_name}` (¥{price:,}) を追加しました。", ephemeral=True)
             
         except Exception as e:
             await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
 
+    @app_commands.command(
+        name="vm_add_gacha",
+        description="自販機に重み付きランダム抽選（ガチャ）商品を追加します（管理者専用）。"
+    )
+    @app_commands.describe(
+        vm_name="自販機の名前",
+        product_name="商品名",
+        price="価格",
+        description="商品の説明"
+    )
+    async def vm_add_gacha_command(self, interaction: discord.Interaction, vm_name: str, product_name: str, price: int, description: str):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
 
-async def setup(bot: commands.Bot):
-    await bot.add_cog(CreateVendingMachineCog(bot))
-    await bot.add_cog(AddProductToVMCog(bot))
-    # (永続Viewの再ロードロジックもここに追加されます)import discord
-from discord.ext import commands
-from discord import app_commands
-import os
-import json
-import asyncio
-from typing import Optional, List, Dict, Any
-# vm_management.pyからコアクラスと通知関数をインポート
-from .vm_management import VendingMachine
-from .purchase_notifications import send_purchase_notification 
+        await interaction.response.defer(ephemeral=True)
 
-# --- UI Components (購入ロジックを含む) ---
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
 
-class PurchaseButton(discord.ui.Button):
-    def __init__(self, vm_id: str, product_name: str, custom_id: str):
-        super().__init__(label=f"『{product_name}』を購入", style=discord.ButtonStyle.green, custom_id=custom_id)
-        self.vm_id = vm_id
-        self.product_name = product_name
-    
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.defer(ephemeral=True, thinking=True)
-        
-        # Paypay連携ロジックなどが入る場合もありますが、ここでは直接購入処理を実行します
-        
         try:
-            vm_data = VendingMachine.load_vm(self.vm_id)
-            vm = VendingMachine.from_dict(vm_data)
-            
-            # アイテムを購入 (在庫が減る場合はvm_management側で保存される)
-            item = vm.purchase_item(self.product_name)
-            
-            if not item:
-                return await interaction.followup.send(f"❌ 商品`{self.product_name}`は現在、在庫切れです。", ephemeral=True)
-            
-            # 購入通知を送信
-            await send_purchase_notification(
-                bot=interaction.client,
-                guild_id=interaction.guild_id,
-                user_id=interaction.user.id,
-                product_name=self.product_name,
-                price=vm.products[self.product_name]["price"],
-                item_content=item
+            vm = vm_registry.get_vm(vm_id)
+
+            if product_name in vm.products:
+                return await interaction.followup.send(f"❌ 商品`{product_name}`は既に存在します。", ephemeral=True)
+
+            # プールは /vm_gacha_pool で追加し、在庫は /vm_restock の pool 引数で補充する
+            vm.products[product_name] = {
+                "type": "gacha",
+                "price": price,
+                "description": description,
+                "pools": {},
+                "stock_count": 0,
+                "infinite_stock": False,
+                "infinite_item": ""
+            }
+            vm.save_vm()
+
+            await interaction.followup.send(
+                f"✅ 自販機`{vm_name}`にガチャ商品`{product_name}` (¥{price:,}) を追加しました。\n"
+                f"`/vm_gacha_pool` で排出プール（レアリティ）と重みを設定してください。",
+                ephemeral=True
             )
-            
-            # 購入者にDMでアイテムを送信
-            try:
-                await interaction.user.send(
-                    f"🎉 **ご購入ありがとうございます！**\n"
-                    f"自販機: `{vm.name}`\n"
-                    f"商品: `{self.product_name}`\n"
-                    f"--- アイテム内容 ---\n"
-                    f"```{item}```"
-                )
-                await interaction.followup.send("✅ DMに商品を送りました。ご確認ください。", ephemeral=True)
-            except discord.Forbidden:
-                await interaction.followup.send("❌ DMを送信できませんでした。あなたのDM設定（サーバーメンバーからのDM）を確認してください。", ephemeral=True)
 
-        except FileNotFoundError:
-            await interaction.followup.send("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
         except Exception as e:
-            await interaction.followup.send(f"❌ 購入中に予期せぬエラーが発生しました: {str(e)}", ephemeral=True)
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
 
+    @app_commands.command(
+        name="vm_gacha_pool",
+        description="ガチャ商品の排出プールを追加、または重みを変更します（管理者専用）。"
+    )
+    @app_commands.describe(
+        vm_name="自販機の名前",
+        product_name="ガチャ商品名",
+        pool_name="プール名（例: SSR, SR, R）",
+        weight="排出の重み（0で排出停止）"
+    )
+    async def vm_gacha_pool_command(self, interaction: discord.Interaction, vm_name: str, product_name: str, pool_name: str, weight: app_commands.Range[float, 0.0, None]):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
 
-class ProductSelect(discord.ui.Select):
-    def __init__(self, vm_id: str, options: list):
-        super().__init__(
-            custom_id=f"vm_select_{vm_id}",
-            placeholder="商品を選択してください...",
-            options=options
-        )
-        self.vm_id = vm_id
+        await interaction.response.defer(ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
 
-    async def callback(self, interaction: discord.Interaction):
-        await interaction.response.defer()
-        selected_product_name = self.values[0]
-        
         try:
-            vm_data = VendingMachine.load_vm(self.vm_id)
-            vm = VendingMachine.from_dict(vm_data)
+            vm = vm_registry.get_vm(vm_id)
+            product = vm.products.get(product_name)
+            if product is None or product.get("type") != "gacha":
+                return await interaction.followup.send(f"❌ ガチャ商品`{product_name}`が見つかりません。", ephemeral=True)
 
-            # Viewを再構築
-            new_view = VendingMachineView(self.vm_id)
-            # 既存のSelect以外のコンポーネントをクリア
-            new_view.children = [c for c in new_view.children if not isinstance(c, PurchaseButton)]
-            
-            # 新しいボタンを作成してViewに追加
-            purchase_button = PurchaseButton(
-                vm_id=self.vm_id,
-                product_name=selected_product_name,
-                custom_id=f"purchase_{self.vm_id}_{selected_product_name}"
+            vm.set_gacha_pool(product_name, pool_name, weight)
+
+            pools = product["pools"]
+            total = sum(pool.get("weight", 0) for pool in pools.values()) or 1
+            lines = [
+                f"`{name}`: 重み {pool.get('weight', 0):g} ({pool.get('weight', 0) / total:.1%}) / 在庫 {vm.pool_stock_count(product_name, name):,} 個"
+                for name, pool in pools.items()
+            ]
+            await interaction.followup.send(
+                f"✅ ガチャ商品`{product_name}`のプール`{pool_name}`を設定しました。\n" + "\n".join(lines),
+                ephemeral=True
             )
-            new_view.add_item(purchase_button)
-            
-            # Selectコンポーネントにオプションを再設定（選択状態を維持）
-            select_component = next((c for c in new_view.children if isinstance(c, ProductSelect)), None)
-            if select_component:
-                 select_component.options = self.options
-                 select_component.default_values = [discord.SelectOption(label=selected_product_name, value=selected_product_name)]
 
-            # Embedを更新
-            embed = vm.create_embed(selected_product_name)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+
+# --- Cog: 在庫の一括補充 (/vm_restock, /vm_pool_restock) ---
+class RestockVMCog(commands.Cog):
+    CHUNK_SIZE = 5000          # この件数ごとに台帳へコミット
+    PROGRESS_INTERVAL = 2.0    # 進捗メッセージの更新間隔 (秒)
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @staticmethod
+    def _parse_line(raw: bytes, is_csv: bool, first: bool) -> Optional[str]:
+        """1行をアイテムに変換 (空行は None)。CSVの場合は1列目を使う"""
+        line = raw.decode("utf-8-sig" if first else "utf-8", errors="replace").rstrip("\r\n")
+        if is_csv:
+            row = next(csv.reader([line]), [])
+            line = row[0] if row else ""
+        line = line.strip()
+        return line or None
+
+    async def _stream_restock(self, interaction: discord.Interaction, file: discord.Attachment, add: Callable[[List[str]], Awaitable[int]]):
+        """添付ファイルを行単位でストリーミングし、CHUNK_SIZE 件ごとに add() でコミットする
+
+        add() は台帳への書き込みをスレッドで行うコルーチン (補充中も購入処理を止めない)。
+
+        戻り値は (追加件数, 重複でスキップした件数, 進捗メッセージ)。
+        """
+        is_csv = file.filename.lower().endswith(".csv")
+        progress = await interaction.followup.send(f"⏳ `{file.filename}` を読み込んでいます...", ephemeral=True, wait=True)
+
+        added = skipped = read = 0
+        chunk: List[str] = []
+        last_report = time.monotonic()
+
+        async def commit():
+            nonlocal added, skipped, chunk
+            items, chunk = chunk, []
+            count = await add(items)
+            added += count
+            skipped += len(items) - count
+
+        # 添付ファイルを行単位でストリーミングし、全体をメモリに載せない
+        async with aiohttp.ClientSession() as session:
+            async with session.get(file.url) as resp:
+                resp.raise_for_status()
+                first = True
+                async for raw in resp.content:
+                    item = self._parse_line(raw, is_csv, first)
+                    first = False
+                    if item is None:
+                        continue
+                    read += 1
+                    chunk.append(item)
+                    if len(chunk) >= self.CHUNK_SIZE:
+                        await commit()
+                        if time.monotonic() - last_report >= self.PROGRESS_INTERVAL:
+                            last_report = time.monotonic()
+                            await progress.edit(content=f"⏳ 補充中... 読み込み **{read:,}** 行 / 追加 **{added:,}** 件 / 重複 **{skipped:,}** 件")
+        if chunk:
+            await commit()
+        return added, skipped, progress
+
+    @app_commands.command(
+        name="vm_restock",
+        description="テキスト/CSVファイルから商品の在庫を一括で補充します（管理者専用）。"
+    )
+    @app_commands.describe(
+        vm_name="自販機の名前",
+        product_name="商品名",
+        file="1行に1アイテムのテキストファイル、またはCSVファイル（1列目を使用）",
+        pool="ガチャ商品の場合は補充先のプール名"
+    )
+    async def vm_restock_command(self, interaction: discord.Interaction, vm_name: str, product_name: str, file: discord.Attachment, pool: Optional[str] = None):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            vm = vm_registry.get_vm(vm_id)
+            if product_name not in vm.products:
+                return await interaction.followup.send(f"❌ 商品`{product_name}`が見つかりません。", ephemeral=True)
+            if vm.products[product_name].get("infinite_stock", False):
+                return await interaction.followup.send(f"❌ 商品`{product_name}`は無限在庫のため補充できません。", ephemeral=True)
+            if vm.products[product_name].get("type") == "gacha":
+                if pool not in vm.products[product_name].get("pools", {}):
+                    return await interaction.followup.send(f"❌ ガチャ商品`{product_name}`の補充先プールを `pool` に指定してください（`/vm_gacha_pool` で追加できます）。", ephemeral=True)
+            else:
+                pool = None
+
+            added, skipped, progress = await self._stream_restock(
+                interaction, file, lambda items: vm.add_stock_async(product_name, items, dedupe=True, pool_name=pool)
+            )
+            await progress.edit(content=(
+                f"✅ 自販機`{vm_name}`の商品`{product_name}`に在庫を補充しました。\n"
+                f"追加: **{added:,}** 件 / 重複スキップ: **{skipped:,}** 件 / 現在の在庫: **{vm.stock_count(product_name):,}** 個"
+            ))
 
-            # メッセージを更新
-            await interaction.edit_original_response(embed=embed, view=new_view)
-            
-        except FileNotFoundError:
-            await interaction.followup.send("❌ この自販機は削除されたか、見つかりません。", ephemeral=True)
         except Exception as e:
-            await interaction.followup.send(f"❌ 選択中にエラーが発生しました: {str(e)}", ephemeral=True)
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
 
 
-class VendingMachineView(discord.ui.View):
-    def __init__(self, vm_id: str):
-        super().__init__(timeout=None)
-        self.vm_id = vm_id
-        # Selectは初期化時にオプションなしで追加
-        self.add_item(ProductSelect(vm_id, options=[]))
-        # 初期の購入ボタンは仮で追加しておく (Selectで選択されたら置き換えられる)
-        self.add_item(PurchaseButton(vm_id, "商品を選択してください", f"purchase_{vm_id}_default_disabled"))
+    @app_commands.command(
+        name="vm_pool_restock",
+        description="テキスト/CSVファイルから共有在庫プールを一括で補充します（管理者専用）。"
+    )
+    @app_commands.describe(
+        pool_name="在庫プールの名前",
+        file="1行に1アイテムのテキストファイル、またはCSVファイル（1列目を使用）"
+    )
+    async def vm_pool_restock_command(self, interaction: discord.Interaction, pool_name: str, file: discord.Attachment):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
 
+        await interaction.response.defer(ephemeral=True)
 
-# --- Cog: 自販機の表示 (/vmpost) ---
-class CreateVendingMachineCog(commands.Cog):
+        pool_id = inventory_pools.find(interaction.guild_id, pool_name)
+        if not pool_id:
+            return await interaction.followup.send(f"❌ 在庫プール`{pool_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            added, skipped, progress = await self._stream_restock(
+                interaction, file, lambda items: inventory_pools.add_stock_async(pool_id, items, dedupe=True)
+            )
+            await progress.edit(content=(
+                f"✅ 在庫プール`{pool_name}`に在庫を補充しました。\n"
+                f"追加: **{added:,}** 件 / 重複スキップ: **{skipped:,}** 件 / 現在の在庫: **{inventory_pools.remaining(pool_id):,}** 個"
+            ))
+
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+
+# --- Cog: 共有在庫プール (/vm_pool_*) ---
+class InventoryPoolCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        # 永続Viewの登録管理用（gファイルに倣い、このCogで管理）
-        self._registered_views: set = set() 
 
     @app_commands.command(
-        name="vmpost", 
-        description="指定した自動販売機をチャンネルに表示します（管理者専用）。"
+        name="vm_pool_create",
+        description="複数の自販機で共有できる在庫プールを作成します（管理者専用）。"
     )
-    @app_commands.describe(vm_name="表示したい自動販売機の名前")
-    async def vmpost_command(self, interaction: discord.Interaction, vm_name: str):
+    @app_commands.describe(pool_name="在庫プールの名前")
+    async def vm_pool_create_command(self, interaction: discord.Interaction, pool_name: str):
         if not interaction.user.guild_permissions.administrator:
             return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
-            
+
         await interaction.response.defer(ephemeral=True)
-        
+
+        if inventory_pools.find(interaction.guild_id, pool_name):
+            return await interaction.followup.send(f"❌ 在庫プール`{pool_name}`は既に存在します。", ephemeral=True)
+
         try:
-            vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
-            if not vm_id:
-                return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
-                
-            vm_data = VendingMachine.load_vm(vm_id)
-            vm = VendingMachine.from_dict(vm_data)
-
-            view = VendingMachineView(vm_id)
-            embed = vm.create_embed()
-
-            # オプションの構築
-            options = []
-            for product_name, product_info in vm.products.items():
-                stock_count = "∞" if product_info.get("infinite_stock", False) else len(product_info.get("stock", []))
-                stock_display = f"{stock_count}個"
-                price = product_info["price"]
-                label = f"{product_name} - ¥{price:,}"
-                description = f"{price:,}円｜在庫: {stock_display} / {product_info['description'][:50]}"
-                
-                options.append(discord.SelectOption(
-                    label=label,
-                    value=product_name,
-                    description=description
-                ))
-            
-            # セレクトコンポーネントにオプションを設定
-            select_component = next((c for c in view.children if isinstance(c, ProductSelect)), None)
-            if select_component:
-                select_component.options = options
-            
-            # 永続Viewの登録
-            if vm_id not in self._registered_views:
-                # Bot起動時に永続Viewのリスナーが呼ばれるため、ここでは重複登録を避けるためセットに追加する処理のみ
-                # 実際にはsetupフックでボットにViewを add_view する必要があります
-                pass 
-            
-            # 初期ボタンを無効化
-            initial_button = next((c for c in view.children if isinstance(c, PurchaseButton)), None)
-            if initial_button:
-                initial_button.disabled = True
+            pool_id = inventory_pools.create(interaction.guild_id, pool_name)
+            await interaction.followup.send(f"✅ 在庫プール`{pool_name}`を作成しました！ID: `{pool_id}`", ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
 
-            await interaction.channel.send(embed=embed, view=view)
-            await interaction.followup.send(f"✅ 自販機`{vm_name}`をこのチャンネルに表示しました。", ephemeral=True)
-            
+    @app_commands.command(
+        name="vm_pool_share",
+        description="在庫プールを別のサーバーでも使えるようにします（管理者専用）。"
+    )
+    @app_commands.describe(pool_name="在庫プールの名前", guild_id="共有先のサーバーID")
+    async def vm_pool_share_command(self, interaction: discord.Interaction, pool_name: str, guild_id: str):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        pool_id = inventory_pools.find(interaction.guild_id, pool_name)
+        if not pool_id or inventory_pools.get(pool_id)["owner_guild_id"] != str(interaction.guild_id):
+            return await interaction.followup.send(f"❌ このサーバーが所有する在庫プール`{pool_name}`が見つかりません。", ephemeral=True)
+        if not guild_id.isdigit():
+            return await interaction.followup.send("❌ サーバーIDは数字で指定してください。", ephemeral=True)
+
+        try:
+            inventory_pools.share(pool_id, guild_id)
+            await interaction.followup.send(f"✅ 在庫プール`{pool_name}`をサーバー`{guild_id}`と共有しました。", ephemeral=True)
         except Exception as e:
             await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
 
+    @app_commands.command(
+        name="vm_pool_link",
+        description="商品の在庫を共有在庫プールから払い出すようにします（管理者専用）。"
+    )
+    @app_commands.describe(
+        vm_name="自販機の名前",
+        product_name="商品名",
+        pool_name="在庫プールの名前（商品に残っている在庫はプールへ移されます）"
+    )
+    async def vm_pool_link_command(self, interaction: discord.Interaction, vm_name: str, product_name: str, pool_name: str):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
 
-# --- Cog: 商品の追加 (/vm_add_product) ---
-class AddProductToVMCog(commands.Cog):
+        await interaction.response.defer(ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+        pool_id = inventory_pools.find(interaction.guild_id, pool_name)
+        if not pool_id:
+            return await interaction.followup.send(f"❌ 在庫プール`{pool_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            vm = vm_registry.get_vm(vm_id)
+            product = vm.products.get(product_name)
+            if product is None:
+                return await interaction.followup.send(f"❌ 商品`{product_name}`が見つかりません。", ephemeral=True)
+            if product.get("infinite_stock", False) or product.get("type") == "gacha":
+                return await interaction.followup.send(f"❌ 商品`{product_name}`は在庫プールに紐付けできません。", ephemeral=True)
+
+            async with vm._purchase_lock:
+                vm.link_pool(product_name, pool_id)
+            await interaction.followup.send(
+                f"✅ 商品`{product_name}`を在庫プール`{pool_name}`に紐付けました。現在の在庫: **{vm.stock_count(product_name):,}** 個",
+                ephemeral=True
+            )
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @app_commands.command(
+        name="vm_pool_unlink",
+        description="商品と在庫プールの紐付けを解除します（管理者専用）。"
+    )
+    @app_commands.describe(vm_name="自販機の名前", product_name="商品名")
+    async def vm_pool_unlink_command(self, interaction: discord.Interaction, vm_name: str, product_name: str):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            vm = vm_registry.get_vm(vm_id)
+            if not vm.products.get(product_name, {}).get("pool_id"):
+                return await interaction.followup.send(f"❌ 商品`{product_name}`は在庫プールに紐付けられていません。", ephemeral=True)
+
+            async with vm._purchase_lock:
+                vm.link_pool(product_name, None)
+            await interaction.followup.send(f"✅ 商品`{product_name}`の在庫プールの紐付けを解除しました。", ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @app_commands.command(
+        name="vm_pool_list",
+        description="このサーバーで使える在庫プールと在庫数を表示します（管理者専用）。"
+    )
+    async def vm_pool_list_command(self, interaction: discord.Interaction):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        try:
+            lines = []
+            for pool_id in inventory_pools.list_for_guild(interaction.guild_id):
+                pool = inventory_pools.get(pool_id)
+                owner = "" if pool["owner_guild_id"] == str(interaction.guild_id) else "（共有）"
+                lines.append(
+                    f"`{pool['name']}`{owner}: 在庫 **{inventory_pools.remaining(pool_id):,}** 個 / "
+                    f"参照している自販機 {inventory_pools.ref_count(pool_id)} 台"
+                )
+            if not lines:
+                return await interaction.followup.send("在庫プールはまだありません。`/vm_pool_create` で作成できます。", ephemeral=True)
+            embed = discord.Embed(title="📦 在庫プール", description="\n".join(lines)[:4000], color=discord.Color.blue())
+            await interaction.followup.send(embed=embed, ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @app_commands.command(
+        name="vm_pool_delete",
+        description="在庫プールを削除します。どの商品からも参照されていない場合のみ削除できます（管理者専用）。"
+    )
+    @app_commands.describe(pool_name="在庫プールの名前")
+    async def vm_pool_delete_command(self, interaction: discord.Interaction, pool_name: str):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        pool_id = inventory_pools.find(interaction.guild_id, pool_name)
+        if not pool_id or inventory_pools.get(pool_id)["owner_guild_id"] != str(interaction.guild_id):
+            return await interaction.followup.send(f"❌ このサーバーが所有する在庫プール`{pool_name}`が見つかりません。", ephemeral=True)
+        if inventory_pools.ref_count(pool_id):
+            return await interaction.followup.send(f"❌ 在庫プール`{pool_name}`は {inventory_pools.ref_count(pool_id)} 台の自販機から参照されています。先に紐付けを解除してください。", ephemeral=True)
+
+        try:
+            inventory_pools.delete(pool_id)
+            await interaction.followup.send(f"✅ 在庫プール`{pool_name}`を削除しました。", ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+
+# --- Cog: 低在庫の警告・入荷通知 (/vm_low_stock, /vm_subscribe, /vm_unsubscribe) ---
+class StockAlertCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
     @app_commands.command(
-        name="vm_add_product", 
-        description="自販機に新しい商品スロットを追加します（管理者専用）。"
+        name="vm_low_stock",
+        description="商品の在庫が指定数以下になったら通知チャンネルに警告します（管理者専用）。"
     )
     @app_commands.describe(
         vm_name="自販機の名前",
         product_name="商品名",
-        price="価格",
-        description="商品の説明"
+        threshold="警告する在庫数（0で無効）"
     )
-    async def vm_add_product_command(self, interaction: discord.Interaction, vm_name: str, product_name: str, price: int, description: str):
+    async def vm_low_stock_command(self, interaction: discord.Interaction, vm_name: str, product_name: str, threshold: app_commands.Range[int, 0, None]):
         if not interaction.user.guild_permissions.administrator:
             return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
-            
+
         await interaction.response.defer(ephemeral=True)
-        
+
         vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
         if not vm_id:
             return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
 
         try:
-            vm_data = VendingMachine.load_vm(vm_id)
-            vm = VendingMachine.from_dict(vm_data)
-            
-            if product_name in vm.products:
-                return await interaction.followup.send(f"❌ 商品`{product_name}`は既に存在します。在庫を追加する場合は別のコマンドを使ってください。", ephemeral=True)
+            vm = vm_registry.get_vm(vm_id)
+            product = vm.products.get(product_name)
+            if product is None:
+                return await interaction.followup.send(f"❌ 商品`{product_name}`が見つかりません。", ephemeral=True)
+            if product.get("infinite_stock", False):
+                return await interaction.followup.send(f"❌ 商品`{product_name}`は無限在庫です。", ephemeral=True)
 
-            # 商品データを更新
-            vm.products[product_name] = {
-                "price": price,
-                "description": description,
-                "stock": [],
-                "infinite_stock": False,
-                "infinite_item": ""
-            }
+            product["low_stock_threshold"] = threshold
+            vm._low_stock_alerted.pop(product_name, None)
             vm.save_vm()
-                
-            await interaction.followup.send(f"✅ 自販機`{vm_name}`に商品`{product_name}` (¥{price:,}) を追加しました。", ephemeral=True)
-            
+
+            if threshold:
+                message = f"✅ 商品`{product_name}`の在庫が **{threshold:,}** 個以下になったら通知チャンネルに警告します。"
+            else:
+                message = f"✅ 商品`{product_name}`の低在庫の警告を無効にしました。"
+            await interaction.followup.send(message, ephemeral=True)
+
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @app_commands.command(
+        name="vm_subscribe",
+        description="在庫切れの商品が入荷したらDMでお知らせします。"
+    )
+    @app_commands.describe(vm_name="自販機の名前", product_name="商品名")
+    async def vm_subscribe_command(self, interaction: discord.Interaction, vm_name: str, product_name: str):
+        await interaction.response.defer(ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            vm = vm_registry.get_vm(vm_id)
+            if product_name not in vm.products:
+                return await interaction.followup.send(f"❌ 商品`{product_name}`が見つかりません。", ephemeral=True)
+            stock = vm.stock_count(product_name)
+            if stock == "∞" or stock > 0:
+                return await interaction.followup.send(f"ℹ️ 商品`{product_name}`は在庫があります（{stock}個）。", ephemeral=True)
+
+            if subscription_store.subscribe(vm_id, product_name, interaction.user.id):
+                await interaction.followup.send(f"🔔 商品`{product_name}`が入荷したらDMでお知らせします。", ephemeral=True)
+            else:
+                await interaction.followup.send(f"ℹ️ 商品`{product_name}`の入荷通知は既に登録されています。", ephemeral=True)
+
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @app_commands.command(
+        name="vm_unsubscribe",
+        description="商品の入荷通知を解除します。"
+    )
+    @app_commands.describe(vm_name="自販機の名前", product_name="商品名")
+    async def vm_unsubscribe_command(self, interaction: discord.Interaction, vm_name: str, product_name: str):
+        await interaction.response.defer(ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            if subscription_store.unsubscribe(vm_id, product_name, interaction.user.id):
+                await interaction.followup.send(f"✅ 商品`{product_name}`の入荷通知を解除しました。", ephemeral=True)
+            else:
+                await interaction.followup.send(f"ℹ️ 商品`{product_name}`の入荷通知は登録されていません。", ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+
+# --- Cog: 売上統計 (/vm_stats, /vm_stats_export) ---
+class VMStatsCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+
+    @app_commands.command(
+        name="vm_stats",
+        description="自販機の売上統計を表示します（管理者専用）。"
+    )
+    @app_commands.describe(vm_name="自販機の名前", days="集計する日数（デフォルト: 7日）")
+    async def vm_stats_command(self, interaction: discord.Interaction, vm_name: str, days: app_commands.Range[int, 1, 365] = 7):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.response.send_message(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            # 逐次更新されている集計を参照するだけなので、deferせずに即答できる
+            stats = get_sales_ledger(vm_id).summary(days)
+
+            embed = discord.Embed(
+                title=f"📊 {vm_name} - 売上統計",
+                description=f"直近 **{days}** 日間: **{stats['units']:,}** 個 / **¥{stats['revenue']:,}**",
+                color=discord.Color.blue()
+            )
+            ranking = sorted(stats["products"].items(), key=lambda kv: kv[1][1], reverse=True)[:10]
+            if ranking:
+                embed.add_field(
+                    name="商品別 (売上順)",
+                    value="\n".join(f"`{name}`: {units:,} 個 / ¥{revenue:,}" for name, (units, revenue) in ranking)[:1024],
+                    inline=False
+                )
+            if stats["top_buyers"]:
+                embed.add_field(
+                    name="上位購入者 (累計)",
+                    value="\n".join(f"{i}. <@{buyer}>: ¥{revenue:,}" for i, (buyer, revenue) in enumerate(stats["top_buyers"], 1)),
+                    inline=False
+                )
+            embed.set_footer(text=f"累計: {stats['total_units']:,} 個 / ¥{stats['total_revenue']:,}")
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+        except Exception as e:
+            await interaction.response.send_message(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
+    @staticmethod
+    def _write_csv(vm_id: str, since: Optional[float], until: Optional[float]) -> Tuple[str, int]:
+        """売上台帳を1行ずつ読みながら一時CSVに書き出す (別スレッドで実行)"""
+        count = 0
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8-sig", newline="", suffix=".csv", delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(["datetime", "vm_id", "product", "price", "units", "buyer_id"])
+            for record in get_sales_ledger(vm_id).iter_records(since, until):
+                writer.writerow([
+                    datetime.fromtimestamp(record["ts"]).strftime("%Y-%m-%d %H:%M:%S"),
+                    record["vm_id"], record["product"], record["price"], record.get("units", 1), record["buyer"]
+                ])
+                count += 1
+            return f.name, count
+
+    @app_commands.command(
+        name="vm_stats_export",
+        description="自販機の売上履歴をCSVで出力します（管理者専用）。"
+    )
+    @app_commands.describe(
+        vm_name="自販機の名前",
+        since="開始日 (YYYY-MM-DD、省略時は最初から)",
+        until="終了日 (YYYY-MM-DD、この日を含む。省略時は現在まで)"
+    )
+    async def vm_stats_export_command(self, interaction: discord.Interaction, vm_name: str, since: Optional[str] = None, until: Optional[str] = None):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            since_ts = datetime.strptime(since, "%Y-%m-%d").timestamp() if since else None
+            until_ts = (datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1)).timestamp() if until else None
+        except ValueError:
+            return await interaction.followup.send("❌ 日付は `YYYY-MM-DD` の形式で指定してください。", ephemeral=True)
+
+        path = None
+        try:
+            path, count = await asyncio.to_thread(self._write_csv, vm_id, since_ts, until_ts)
+            await interaction.followup.send(
+                f"✅ 自販機`{vm_name}`の売上履歴 **{count:,}** 件を出力しました。",
+                file=discord.File(path, filename=f"sales_{vm_name}.csv"),
+                ephemeral=True
+            )
+        except discord.HTTPException as e:
+            await interaction.followup.send(f"❌ ファイルを送信できませんでした（サイズ上限の可能性があります）。期間を絞ってください: {e}", ephemeral=True)
         except Exception as e:
             await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+        finally:
+            if path and os.path.exists(path):
+                os.remove(path)
 
 
 # =========================================================
 # 3. Setup
 # =========================================================
 async def setup(bot: commands.Bot):
+    # 購入後処理 (通知・DM) のワーカーを起動し、前回のデッドレターを再送する
+    await purchase_pipeline.start(bot)
+    # 投稿済みパネルの在庫表示を変更に追従させる
+    panel_refresher.start(bot)
+    # 削除された自販機の描画キャッシュ・商品索引を破棄する
+    add_delete_listener(panel_cache.invalidate)
+    # 低在庫の警告と入荷通知
+    add_stock_listener(stock_alerts.on_stock_event)
+    # 全パネルのボタン・セレクトを単一のルーターで受け付ける (VMごとの再登録は不要)
+    bot.add_dynamic_items(VMComponentRouter)
     await bot.add_cog(CreateVendingMachineCog(bot))
     await bot.add_cog(AddProductToVMCog(bot))
-    # Botの再起動時に永続Viewを再登録するロジックもここに追加します
-    # (例: bot.add_view(VendingMachineView(vm_id)) のような処理)
\ No newline at end of file
+    await bot.add_cog(RestockVMCog(bot))
+    await bot.add_cog(InventoryPoolCog(bot))
+    await bot.add_cog(StockAlertCog(bot))
+    await bot.add_cog(VMStatsCog(bot))
\ No newline at end of file
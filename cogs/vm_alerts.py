@@ -0,0 +1,144 @@
+# cogs/vm_alerts.py
+
+import os
+import json
+import asyncio
+from typing import Optional, List, Dict, Tuple
+from .vm_management import VM_CONFIG_DIR, VendingMachine, atomic_write_json
+from .vm_pipeline import purchase_pipeline
+
+# =========================================================
+# 設定
+# =========================================================
+SUBSCRIPTION_DIR = os.path.join(VM_CONFIG_DIR, "subscriptions")
+RESTOCK_BATCH_WINDOW = 10.0   # 入荷通知をまとめる時間 (秒)。同じ人への複数商品の入荷を1通にする
+DM_BATCH_SIZE = 20            # 一度にパイプラインへ投入するDMの数
+DM_BATCH_INTERVAL = 1.0       # DMのバッチ間の待ち時間 (秒)
+
+
+# =========================================================
+# SubscriptionStore (入荷通知の購読者)
+# =========================================================
+class SubscriptionStore:
+    """商品ごとの入荷通知の購読者を自販機単位のファイルで保持するクラス
+
+    vm_config/subscriptions/{vm_id}.json: {商品名: [user_id, ...]}
+    入荷を通知した購読は取り除く (1回限りの「入荷したら知らせる」)。
+    """
+    def __init__(self):
+        # {vm_id: {product_name: [user_id, ...]}}
+        self._cache: Dict[str, Dict[str, List[str]]] = {}
+
+    def _path(self, vm_id: str) -> str:
+        return os.path.join(SUBSCRIPTION_DIR, f"{vm_id}.json")
+
+    def _load(self, vm_id: str) -> Dict[str, List[str]]:
+        subscriptions = self._cache.get(vm_id)
+        if subscriptions is None:
+            subscriptions = {}
+            if os.path.exists(self._path(vm_id)):
+                try:
+                    with open(self._path(vm_id), "r", encoding="utf-8") as f:
+                        subscriptions = json.load(f)
+                except Exception as e:
+                    print(f"⚠️ 警告: 入荷通知の購読ファイル {self._path(vm_id)} が読み込めません: {e}")
+            self._cache[vm_id] = subscriptions
+        return subscriptions
+
+    def _save(self, vm_id: str):
+        atomic_write_json(self._path(vm_id), self._cache.get(vm_id, {}), ensure_ascii=False)
+
+    def subscribe(self, vm_id: str, product_name: str, user_id) -> bool:
+        """購読を追加する (既に購読済みなら False)"""
+        users = self._load(vm_id).setdefault(product_name, [])
+        if str(user_id) in users:
+            return False
+        users.append(str(user_id))
+        self._save(vm_id)
+        return True
+
+    def unsubscribe(self, vm_id: str, product_name: str, user_id) -> bool:
+        subscriptions = self._load(vm_id)
+        users = subscriptions.get(product_name, [])
+        if str(user_id) not in users:
+            return False
+        users.remove(str(user_id))
+        if not users:
+            del subscriptions[product_name]
+        self._save(vm_id)
+        return True
+
+    def take(self, vm_id: str, product_name: str) -> List[str]:
+        """商品の購読者を取り出し、購読を解除する"""
+        subscriptions = self._load(vm_id)
+        users = subscriptions.pop(product_name, [])
+        if users:
+            self._save(vm_id)
+        return users
+
+
+subscription_store = SubscriptionStore()
+
+
+# =========================================================
+# StockAlertDispatcher (在庫イベント → 通知ジョブ)
+# =========================================================
+class StockAlertDispatcher:
+    """在庫イベントを受け取り、購入後パイプラインへ通知ジョブを投入するクラス
+
+    - low_stock: 通知チャンネルへ警告を1件送る
+    - restocked: 購読者への入荷DMを RESTOCK_BATCH_WINDOW 秒ぶんまとめ、
+                 1人1通にしてから DM_BATCH_SIZE 件ずつ間隔を空けて投入する
+    """
+    def __init__(self):
+        # {user_id: [(自販機名, 商品名), ...]} 送信待ちの入荷通知
+        self._pending: Dict[str, List[Tuple[str, str]]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def on_stock_event(self, event: str, vm: VendingMachine, product_name: str, remaining: int):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return # イベントループ外 (移行ツールなど) では通知しない
+        if event == "low_stock":
+            loop.create_task(purchase_pipeline.submit({
+                "type": "low_stock",
+                "guild_id": vm.guild_id,
+                "vm_name": vm.name,
+                "product_name": product_name,
+                "remaining": remaining,
+                "threshold": vm.products[product_name].get("low_stock_threshold", 0),
+                "vm_id": vm.vm_id,
+                "price": vm.products[product_name].get("price"),
+            }))
+        elif event == "restocked":
+            for user_id in subscription_store.take(vm.vm_id, product_name):
+                self._pending.setdefault(user_id, []).append((vm.name, product_name))
+            if self._pending and (self._flush_task is None or self._flush_task.done()):
+                self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # 送信中に届いた入荷は新しい _pending に溜まるので、空になるまで繰り返す
+        # (購読は take() の時点で解除済みのため、取りこぼすと二度と通知されない)
+        while self._pending:
+            await asyncio.sleep(RESTOCK_BATCH_WINDOW)
+            pending, self._pending = self._pending, {}
+            user_ids = list(pending)
+            for start in range(0, len(user_ids), DM_BATCH_SIZE):
+                for user_id in user_ids[start:start + DM_BATCH_SIZE]:
+                    lines = "\n".join(f"・自販機`{vm_name}`の`{product_name}`" for vm_name, product_name in pending[user_id])
+                    await purchase_pipeline.submit({
+                        "type": "dm",
+                        "user_id": user_id,
+                        "content": f"🔔 **入荷のお知らせ**\n購読していた商品が入荷しました。\n{lines}"
+                    })
+                if start + DM_BATCH_SIZE < len(user_ids):
+                    await asyncio.sleep(DM_BATCH_INTERVAL)
+
+    def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+
+stock_alerts = StockAlertDispatcher()
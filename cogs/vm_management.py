@@ -6,13 +6,444 @@ from discord import app_commands
 import os
 import json
 import hashlib
-from typing import Optional, List, Dict, Any
+import shutil
+import asyncio
+import tempfile
+from collections import OrderedDict
+from contextlib import ExitStack
+from typing import Optional, List, Dict, Any, Tuple, Callable
 from io import BytesIO
+from .vm_stock import StockLedger, AliasTable, get_ledger, drop_ledger
+from .vm_sales import get_sales_ledger
 
 # --- ファイルパス設定 ---
 VM_CONFIG_DIR = "vm_config"
 if not os.path.exists(VM_CONFIG_DIR):
     os.makedirs(VM_CONFIG_DIR)
+# 自販機ファイルはギルドごとのディレクトリに置く: vm_config/guilds/{guild_id}/{vm_id}.json
+VM_GUILDS_DIR = os.path.join(VM_CONFIG_DIR, "guilds")
+
+# 自販機ファイルの形式バージョン
+#   1: vm_config/{vm_id}.json 直下に置かれていた旧形式 (schema_version なし)
+#   2: ギルド別ディレクトリ + schema_version
+SCHEMA_VERSION = 2
+
+
+def atomic_write_json(path: str, data: Any, **dump_kwargs):
+    """一時ファイルに書き込み、fsync してから rename で置き換える
+
+    書き込み途中でプロセスが落ちても、元のファイルか新しいファイルの
+    どちらかが完全な形で残る。
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    # rename 自体を永続化するため、ディレクトリも fsync する
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+def upgrade_vm_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """古い形式の自販機データを現在の SCHEMA_VERSION に変換する (読み込み時に適用)"""
+    version = data.get("schema_version", 1)
+    if version < 2:
+        # v1 → v2: 保存先の移動は次の save_vm で行われる
+        data.setdefault("panels", [])
+    data["schema_version"] = SCHEMA_VERSION
+    return data
+
+
+# =========================================================
+# 0. VMRegistry (ギルドID・VM名 → VM ID のインメモリインデックス)
+# =========================================================
+class VMRegistry:
+    """全ギルドの自販機インデックスをプロセス全体で保持するクラス
+    
+    起動時に一度だけ vm_config/ を走査し、以降は作成・保存・削除のたびに
+    インデックスを更新する。名前からのID検索はファイルを読まずに O(1) で返す。
+    """
+    def __init__(self):
+        self._loaded = False
+        # {guild_id: {vm_name: vm_id}}
+        self._name_index: Dict[str, Dict[str, str]] = {}
+        # {guild_id: [vm_id, ...]} (作成順)
+        self._guild_vms: Dict[str, List[str]] = {}
+        # {vm_id: (guild_id, vm_name)} 逆引き (名前変更・削除時に使用)
+        self._vm_keys: Dict[str, Tuple[str, str]] = {}
+        # {vm_id: VendingMachine} 読み込み済みのインスタンス (購入ロックを共有するため1VM1インスタンス)
+        self._instances: Dict[str, 'VendingMachine'] = {}
+        # {vm_id: ファイルパス} (旧形式の直下ファイルも含む)
+        self._paths: Dict[str, str] = {}
+
+    def load(self):
+        """vm_config/ を走査してインデックスを構築する (起動時に一度だけ)
+
+        ギルド別ディレクトリと、未移行の旧形式 (vm_config 直下) の両方を読む。
+        同じ VM が両方にある場合 (移行途中で停止した場合) はギルド別を優先する。
+        """
+        self._name_index.clear()
+        self._guild_vms.clear()
+        self._vm_keys.clear()
+        self._instances.clear()
+        self._paths.clear()
+        paths = [os.path.join(VM_CONFIG_DIR, filename) for filename in sorted(os.listdir(VM_CONFIG_DIR))]
+        if os.path.isdir(VM_GUILDS_DIR):
+            for guild_dir in sorted(os.listdir(VM_GUILDS_DIR)):
+                guild_path = os.path.join(VM_GUILDS_DIR, guild_dir)
+                if os.path.isdir(guild_path):
+                    paths.extend(os.path.join(guild_path, filename) for filename in sorted(os.listdir(guild_path)))
+        for path in paths:
+            filename = os.path.basename(path)
+            if not filename.endswith(".json") or filename.startswith(".") or not os.path.isfile(path):
+                continue
+            vm_id = filename[:-len(".json")]
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.register(vm_id, data["guild_id"], data["name"], path=path)
+                inventory_pools.sync_refs(vm_id, data.get("products", {}))
+            except Exception as e:
+                print(f"⚠️ 警告: 自販機ファイル {path} の読み込みに失敗しました: {e}")
+        self._loaded = True
+        legacy = len(self.legacy_vm_ids())
+        print(f"✅ VM registry loaded: {len(self._vm_keys)} vending machines" + (f" ({legacy} pending migration)" if legacy else ""))
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def register(self, vm_id: str, guild_id, vm_name: str, vm: Optional['VendingMachine'] = None, path: Optional[str] = None):
+        """VMをインデックスに追加 (既に登録済みの場合は名前・ギルドを更新)"""
+        if vm is not None:
+            self._instances[vm_id] = vm
+        if path is not None:
+            self._paths[vm_id] = path
+        guild_key = str(guild_id)
+        old_key = self._vm_keys.get(vm_id)
+        if old_key == (guild_key, vm_name):
+            return
+        if old_key:
+            self.unregister(vm_id)
+        self._name_index.setdefault(guild_key, {})[vm_name] = vm_id
+        self._guild_vms.setdefault(guild_key, []).append(vm_id)
+        self._vm_keys[vm_id] = (guild_key, vm_name)
+
+    def unregister(self, vm_id: str):
+        """VMをインデックスから削除"""
+        self._instances.pop(vm_id, None)
+        self._paths.pop(vm_id, None)
+        key = self._vm_keys.pop(vm_id, None)
+        if not key:
+            return
+        guild_key, vm_name = key
+        names = self._name_index.get(guild_key, {})
+        if names.get(vm_name) == vm_id:
+            del names[vm_name]
+        vm_ids = self._guild_vms.get(guild_key, [])
+        if vm_id in vm_ids:
+            vm_ids.remove(vm_id)
+
+    def get_vm_id(self, guild_id, vm_name: str) -> Optional[str]:
+        """ギルドIDとVM名からVM IDを返す (ファイル読み込みなし)"""
+        self.ensure_loaded()
+        return self._name_index.get(str(guild_id), {}).get(vm_name)
+
+    def get_path(self, vm_id: str) -> Optional[str]:
+        """VMファイルのパス (ファイル走査なし)"""
+        self.ensure_loaded()
+        return self._paths.get(vm_id)
+
+    def legacy_vm_ids(self) -> List[str]:
+        """旧形式 (vm_config 直下) のまま残っているVM IDの一覧"""
+        return [vm_id for vm_id, path in self._paths.items() if os.path.dirname(path) == VM_CONFIG_DIR]
+
+    def get_loaded(self, vm_id: str) -> Optional['VendingMachine']:
+        """読み込み済みのVMインスタンスだけを返す (未読み込みなら None、ファイルは読まない)"""
+        return self._instances.get(vm_id)
+
+    def get_vm(self, vm_id: str) -> 'VendingMachine':
+        """VMインスタンスを返す (初回のみファイルから読み込む)"""
+        vm = self._instances.get(vm_id)
+        if vm is None:
+            vm = VendingMachine.from_dict(VendingMachine.load_vm(vm_id))
+            self._instances[vm_id] = vm
+        return vm
+
+    def list_all_vms(self) -> List[str]:
+        """全ギルドのVM IDの一覧"""
+        self.ensure_loaded()
+        return list(self._vm_keys)
+
+    def list_guild_vms(self, guild_id) -> List[str]:
+        """ギルドに属するVM IDの一覧を返す"""
+        self.ensure_loaded()
+        return list(self._guild_vms.get(str(guild_id), []))
+
+    def list_guild_vm_names(self, guild_id) -> List[str]:
+        """ギルドに属するVM名の一覧を返す"""
+        self.ensure_loaded()
+        return list(self._name_index.get(str(guild_id), {}).keys())
+
+
+# プロセス全体で共有するレジストリ
+vm_registry = VMRegistry()
+
+
+def append_stock(ledger: StockLedger, items: List[str], dedupe: bool = False) -> int:
+    """台帳へ追記し、追加件数を返す (スレッドから呼んでもよい)"""
+    if dedupe:
+        added, _ = ledger.append_unique(items)
+        return added
+    return ledger.append(items)
+
+
+# =========================================================
+# 0.1 InventoryPoolRegistry (複数の自販機・ギルドで共有する在庫プール)
+# =========================================================
+POOL_DIR = os.path.join(VM_CONFIG_DIR, "pools")
+POOL_INDEX_FILE = os.path.join(POOL_DIR, "pools.json")
+
+
+class InventoryPoolRegistry:
+    """名前付きの共有在庫プールを管理するクラス
+
+    プールの在庫は1つの StockLedger にだけ置き、商品は "pool_id" で参照する。
+    補充は1か所への追記で済み、何台の自販機に並べても在庫ファイルは増えない。
+    払い出しは台帳のロック下で行うため、どの自販機から買われても同じアイテムが
+    二重に払い出されることはない。
+
+    pools.json: {pool_id: {"name", "owner_guild_id", "shared_guild_ids": [...]}}
+    """
+    def __init__(self):
+        self._loaded = False
+        self._pools: Dict[str, Dict[str, Any]] = {}
+        # {guild_id: {pool_name: pool_id}} 所有ギルドでの名前索引
+        self._name_index: Dict[str, Dict[str, str]] = {}
+        # {pool_id: {vm_id, ...}} プールを参照している自販機 (在庫変化の通知先)
+        self._refs: Dict[str, set] = {}
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(POOL_INDEX_FILE):
+            return
+        try:
+            with open(POOL_INDEX_FILE, "r", encoding="utf-8") as f:
+                self._pools = json.load(f)
+        except Exception as e:
+            print(f"⚠️ 警告: 在庫プール一覧 {POOL_INDEX_FILE} の読み込みに失敗しました: {e}")
+            self._pools = {}
+        for pool_id, pool in self._pools.items():
+            self._name_index.setdefault(str(pool["owner_guild_id"]), {})[pool["name"]] = pool_id
+
+    def _save(self):
+        atomic_write_json(POOL_INDEX_FILE, self._pools, indent=4)
+
+    # --- プールの作成・共有 ---
+    def create(self, guild_id, name: str) -> str:
+        self.ensure_loaded()
+        pool_id = os.urandom(8).hex()
+        self._pools[pool_id] = {"name": name, "owner_guild_id": str(guild_id), "shared_guild_ids": []}
+        self._name_index.setdefault(str(guild_id), {})[name] = pool_id
+        self._save()
+        return pool_id
+
+    def delete(self, pool_id: str):
+        self.ensure_loaded()
+        pool = self._pools.pop(pool_id, None)
+        if pool is None:
+            return
+        self._name_index.get(pool["owner_guild_id"], {}).pop(pool["name"], None)
+        self._refs.pop(pool_id, None)
+        self._save()
+        drop_ledger(POOL_DIR, pool_id, destroy=True)
+
+    def share(self, pool_id: str, guild_id):
+        pool = self._pools[pool_id]
+        if str(guild_id) not in pool["shared_guild_ids"]:
+            pool["shared_guild_ids"].append(str(guild_id))
+            self._save()
+
+    def get(self, pool_id: str) -> Optional[Dict[str, Any]]:
+        self.ensure_loaded()
+        return self._pools.get(pool_id)
+
+    def find(self, guild_id, name: str) -> Optional[str]:
+        """ギルドから使えるプールを名前で探す (自ギルドのプール → 共有されたプールの順)"""
+        self.ensure_loaded()
+        guild_key = str(guild_id)
+        pool_id = self._name_index.get(guild_key, {}).get(name)
+        if pool_id:
+            return pool_id
+        for pool_id, pool in self._pools.items():
+            if pool["name"] == name and guild_key in pool["shared_guild_ids"]:
+                return pool_id
+        return None
+
+    def list_for_guild(self, guild_id) -> List[str]:
+        self.ensure_loaded()
+        guild_key = str(guild_id)
+        return [
+            pool_id for pool_id, pool in self._pools.items()
+            if pool["owner_guild_id"] == guild_key or guild_key in pool["shared_guild_ids"]
+        ]
+
+    # --- 在庫 ---
+    def ledger(self, pool_id: str) -> StockLedger:
+        return get_ledger(POOL_DIR, pool_id)
+
+    def remaining(self, pool_id: str) -> int:
+        return self.ledger(pool_id).remaining
+
+    def add_stock(self, pool_id: str, items: List[str], dedupe: bool = False) -> int:
+        ledger = self.ledger(pool_id)
+        before = ledger.remaining
+        added = append_stock(ledger, items, dedupe)
+        self._after_add(pool_id, added, before)
+        return added
+
+    async def add_stock_async(self, pool_id: str, items: List[str], dedupe: bool = False) -> int:
+        """add_stock と同じだが、台帳への書き込み (重複チェックを含む) をスレッドで行う"""
+        ledger = self.ledger(pool_id)
+        before = ledger.remaining
+        added = await asyncio.to_thread(append_stock, ledger, items, dedupe)
+        self._after_add(pool_id, added, before)
+        return added
+
+    def _after_add(self, pool_id: str, added: int, before: int):
+        """補充後の通知 (イベントループ上で呼ぶ)"""
+        if added:
+            self.notify(pool_id)
+            for vm_id in list(self._refs.get(pool_id, ())):
+                try:
+                    vm = vm_registry.get_vm(vm_id)
+                except FileNotFoundError:
+                    continue
+                for product_name, product in list(vm.products.items()):
+                    if product.get("pool_id") == pool_id:
+                        vm._after_restock(product_name, before)
+
+    # --- 参照している自販機 ---
+    def sync_refs(self, vm_id: str, products: Dict[str, Dict[str, Any]]):
+        """自販機の商品が参照しているプールを逆引き索引に反映する"""
+        pool_ids = {product["pool_id"] for product in products.values() if product.get("pool_id")}
+        for pool_id, vm_ids in self._refs.items():
+            if pool_id not in pool_ids:
+                vm_ids.discard(vm_id)
+        for pool_id in pool_ids:
+            self._refs.setdefault(pool_id, set()).add(vm_id)
+
+    def drop_refs(self, vm_id: str):
+        for vm_ids in self._refs.values():
+            vm_ids.discard(vm_id)
+
+    def ref_count(self, pool_id: str) -> int:
+        return len(self._refs.get(pool_id, ()))
+
+    def notify(self, pool_id: str):
+        """プールの在庫が変わったことを、参照している読み込み済みの自販機へ伝える"""
+        for vm_id in list(self._refs.get(pool_id, ())):
+            vm = vm_registry.get_loaded(vm_id)
+            if vm is not None:
+                vm._touch()
+
+
+inventory_pools = InventoryPoolRegistry()
+
+
+# =========================================================
+# 0.5 PurchaseDeduplicator (interaction.id による購入の冪等化)
+# =========================================================
+class PurchaseDeduplicator:
+    """処理済みの購入を interaction.id ごとに覚えておくクラス
+    
+    同じインタラクションが再送・二重配送されても、2つ目以降は
+    最初に払い出したアイテムをそのまま返し、在庫を消費しない。
+    """
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        # 値は払い出したアイテム (まとめ買いの場合は {商品名: [アイテム, ...]})
+        self._results: "OrderedDict[int, Any]" = OrderedDict()
+
+    def get(self, interaction_id: int) -> Optional[Any]:
+        return self._results.get(interaction_id)
+
+    def record(self, interaction_id: int, item: Any):
+        self._results[interaction_id] = item
+        if len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+
+purchase_dedup = PurchaseDeduplicator()
+
+
+# =========================================================
+# 0.6 変更リスナー (パネルの自動更新などに使用)
+# =========================================================
+# VMの表示内容が変わるたびに callback(vm) が呼ばれる
+_change_listeners: List[Callable[['VendingMachine'], None]] = []
+
+
+def add_change_listener(callback: Callable[['VendingMachine'], None]):
+    if callback not in _change_listeners:
+        _change_listeners.append(callback)
+
+
+def remove_change_listener(callback: Callable[['VendingMachine'], None]):
+    if callback in _change_listeners:
+        _change_listeners.remove(callback)
+
+
+# 自販機が削除されるたびに callback(vm_id) が呼ばれる (表示キャッシュなどの破棄用)
+_delete_listeners: List[Callable[[str], None]] = []
+
+
+def add_delete_listener(callback: Callable[[str], None]):
+    if callback not in _delete_listeners:
+        _delete_listeners.append(callback)
+
+
+def remove_delete_listener(callback: Callable[[str], None]):
+    if callback in _delete_listeners:
+        _delete_listeners.remove(callback)
+
+
+# 在庫イベントのたびに callback(event, vm, product_name, remaining) が呼ばれる
+#   - "low_stock": 在庫が閾値 (low_stock_threshold) 以下になった
+#   - "restocked": 在庫切れだった商品が補充された
+_stock_listeners: List[Callable[[str, 'VendingMachine', str, int], None]] = []
+
+# 低在庫通知を再び有効にする在庫数 (閾値のこの倍率を上回るまで再通知しない)
+LOW_STOCK_REARM_RATIO = 1.5
+
+
+def add_stock_listener(callback: Callable[[str, 'VendingMachine', str, int], None]):
+    if callback not in _stock_listeners:
+        _stock_listeners.append(callback)
+
+
+def remove_stock_listener(callback: Callable[[str, 'VendingMachine', str, int], None]):
+    if callback in _stock_listeners:
+        _stock_listeners.remove(callback)
 
 # =========================================================
 # 1. VendingMachine クラス (自販機のコアロジックとファイル操作)
@@ -24,87 +455,481 @@ class VendingMachine:
         self.vm_id = vm_id
         self.guild_id = guild_id
         self.products: Dict[str, Dict[str, Any]] = {}
+        # 購入処理をVM単位で直列化するロック
+        self._purchase_lock = asyncio.Lock()
+        # 表示内容が変わる変更 (商品追加・補充・購入) のたびに増えるバージョン番号
+        self.version = 0
+        # 商品構成 (追加・削除・名前) が変わりうる保存のたびに増えるバージョン番号
+        self.catalog_version = 0
+        # このVMを表示しているパネルメッセージ [{"channel_id": str, "message_id": str}]
+        self.panels: List[Dict[str, str]] = []
+        # {商品名: AliasTable} ガチャ商品の抽選表 (在庫のあるプールが変わったときだけ作り直す)
+        self._gacha_tables: Dict[str, AliasTable] = {}
+        # {商品名: bool} 低在庫通知を送信済みかどうか (再通知は在庫が十分に戻ってから)
+        self._low_stock_alerted: Dict[str, bool] = {}
+        # 購入ロック内で払い出した台帳 (カーソルの fsync はロックの外で行う)
+        self._unsynced: List[StockLedger] = []
+
+    def _touch(self):
+        """表示キャッシュを無効化するためにバージョンを進め、リスナーへ通知する"""
+        self.version += 1
+        for callback in list(_change_listeners):
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"⚠️ 警告: VM変更リスナーでエラーが発生しました: {e}")
+
+    def _emit_stock_event(self, event: str, product_name: str, remaining: int):
+        for callback in list(_stock_listeners):
+            try:
+                callback(event, self, product_name, remaining)
+            except Exception as e:
+                print(f"⚠️ 警告: 在庫イベントリスナーでエラーが発生しました: {e}")
+
+    @staticmethod
+    def _get_vm_file_path(vm_id: str, guild_id) -> str:
+        return os.path.join(VM_GUILDS_DIR, str(guild_id), f"{vm_id}.json")
 
     @staticmethod
-    def _get_vm_file_path(vm_id: str) -> str:
+    def _get_legacy_vm_file_path(vm_id: str) -> str:
+        """schema_version 1 の保存先 (移行前の既存データの読み込みにのみ使用)"""
         return os.path.join(VM_CONFIG_DIR, f"{vm_id}.json")
 
+    @staticmethod
+    def _get_stock_dir(vm_id: str) -> str:
+        return os.path.join(VM_CONFIG_DIR, "stock", vm_id)
+
     @staticmethod
     def get_vm_id_by_name(guild_id: int, vm_name: str) -> Optional[str]:
-        """ギルドIDとVM名からVM IDを検索"""
-        for filename in os.listdir(VM_CONFIG_DIR):
-            if filename.endswith(".json"):
-                vm_id = filename.replace(".json", "")
-                try:
-                    data = VendingMachine.load_vm(vm_id)
-                    # 文字列比較を推奨
-                    if str(data.get("guild_id")) == str(guild_id) and data.get("name") == vm_name:
-                        return vm_id
-                except:
-                    continue
-        return None
+        """ギルドIDとVM名からVM IDを検索 (レジストリ参照のみ、ファイル走査なし)"""
+        return vm_registry.get_vm_id(guild_id, vm_name)
 
     @staticmethod
     def load_vm(vm_id: str) -> Dict[str, Any]:
-        """VM IDから自販機の状態を読み込み"""
-        file_path = VendingMachine._get_vm_file_path(vm_id)
+        """VM IDから自販機の状態を読み込み (旧形式のファイルも読める。変換は from_dict で行う)"""
+        file_path = vm_registry.get_path(vm_id) or VendingMachine._get_legacy_vm_file_path(vm_id)
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"VM ID {vm_id} のファイルが見つかりません。")
         with open(file_path, "r", encoding="utf-8") as f:
             return json.load(f)
 
     def save_vm(self):
-        """自販機の状態をファイルに保存"""
+        """自販機の状態をファイルに保存 (在庫本体は台帳側にあるため、件数のみ書き出す)"""
+        self.catalog_version += 1
+        self._touch()
+        for product_name, product in self.products.items():
+            if product.get("stock_id") or product.get("pool_id") or product.get("type") == "gacha":
+                product["stock_count"] = self.stock_count(product_name)
         data = {
+            "schema_version": SCHEMA_VERSION,
             "name": self.name,
             "vm_id": self.vm_id,
             "guild_id": self.guild_id,
-            "products": self.products
+            "products": self.products,
+            "panels": self.panels
         }
-        with open(VendingMachine._get_vm_file_path(self.vm_id), "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4)
+        file_path = VendingMachine._get_vm_file_path(self.vm_id, self.guild_id)
+        atomic_write_json(file_path, data, indent=4)
+        legacy_path = VendingMachine._get_legacy_vm_file_path(self.vm_id)
+        if os.path.exists(legacy_path):
+            # 新しい保存先への書き込みが確定してから旧形式のファイルを消す
+            os.remove(legacy_path)
+        vm_registry.register(self.vm_id, self.guild_id, self.name, self, path=file_path)
+        inventory_pools.sync_refs(self.vm_id, self.products)
+
+    @staticmethod
+    def delete_vm(vm_id: str):
+        """自販機のファイルを削除し、レジストリからも外す"""
+        try:
+            stock_ids = vm_registry.get_vm(vm_id).stock_ids()
+        except FileNotFoundError:
+            stock_ids = []
+        for file_path in (vm_registry.get_path(vm_id), VendingMachine._get_legacy_vm_file_path(vm_id)):
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+        stock_dir = VendingMachine._get_stock_dir(vm_id)
+        # 開いたままの台帳 (未販売でカーソルファイルがないものも含む) をキャッシュから外してから消す
+        for stock_id in stock_ids:
+            drop_ledger(stock_dir, stock_id)
+        shutil.rmtree(stock_dir, ignore_errors=True)
+        vm_registry.unregister(vm_id)
+        inventory_pools.drop_refs(vm_id)
+        for callback in list(_delete_listeners):
+            try:
+                callback(vm_id)
+            except Exception as e:
+                print(f"⚠️ 警告: VM削除リスナーでエラーが発生しました: {e}")
             
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'VendingMachine':
-        """辞書からVendingMachineインスタンスを再構築"""
+        """辞書からVendingMachineインスタンスを再構築
+
+        古い schema_version のデータはその場で変換し、新しい形式・保存先で保存し直す。
+        """
+        outdated = data.get("schema_version", 1) < SCHEMA_VERSION
+        data = upgrade_vm_data(data)
         vm = cls(data["name"], data["vm_id"], data["guild_id"])
         vm.products = data["products"]
+        vm.panels = data.get("panels", [])
+        inventory_pools.sync_refs(vm.vm_id, vm.products)
+        migrated = vm._migrate_inline_stock()
+        if outdated or migrated:
+            vm.save_vm()
         return vm
+
+    # --- 在庫台帳 ---
+    def _ledger(self, product_name: str, pool_name: Optional[str] = None) -> StockLedger:
+        """商品 (ガチャ商品の場合はそのプール) の在庫台帳を返す (未割り当てなら stock_id を発行)"""
+        product = self.products[product_name]
+        if pool_name is None and product.get("pool_id"):
+            # 共有在庫プールを参照している商品
+            return inventory_pools.ledger(product["pool_id"])
+        holder = product["pools"][pool_name] if pool_name is not None else product
+        if not holder.get("stock_id"):
+            holder["stock_id"] = os.urandom(6).hex()
+            ledger = get_ledger(VendingMachine._get_stock_dir(self.vm_id), holder["stock_id"])
+            self.save_vm() # 発行した stock_id を永続化
+            return ledger
+        return get_ledger(VendingMachine._get_stock_dir(self.vm_id), holder["stock_id"])
+
+    def stock_ids(self) -> List[str]:
+        """この自販機が持つ在庫台帳 (ガチャ商品のプールを含む) の stock_id の一覧"""
+        stock_ids = []
+        for product in self.products.values():
+            if product.get("stock_id"):
+                stock_ids.append(product["stock_id"])
+            for pool in product.get("pools", {}).values():
+                if pool.get("stock_id"):
+                    stock_ids.append(pool["stock_id"])
+        return stock_ids
+
+    def _migrate_inline_stock(self):
+        """旧形式 (VM JSON内の "stock" リスト) の在庫を台帳へ移す (移した場合は True、保存は呼び出し側)"""
+        migrated = False
+        for product_name, product in self.products.items():
+            if "stock" not in product:
+                continue
+            # 同じ内容の在庫を複数持つ商品もあるため重複は除外しない。
+            # 二重に積まれないよう、追記前のログ位置を先に保存しておき、
+            # 前回の移行が中断していた場合はその位置まで戻してから積み直す。
+            ledger = self._ledger(product_name)
+            marker = product.get("stock_migration")
+            if marker is None:
+                marker = product["stock_migration"] = {"generation": ledger.generation, "offset": ledger.log_size()}
+                self.save_vm()
+            elif marker["generation"] == ledger.generation:
+                ledger.truncate(marker["offset"])
+            if marker["generation"] == ledger.generation:
+                ledger.append(product["stock"] or [])
+            # (世代が変わっている場合は移行済みの在庫がコンパクションされた後なので積み直さない)
+            del product["stock"]
+            del product["stock_migration"]
+            migrated = True
+        return migrated
+
+    def stock_count(self, product_name: str):
+        """在庫数を返す (無限在庫の場合は "∞")"""
+        product = self.products[product_name]
+        if product.get("infinite_stock", False):
+            return "∞"
+        if product.get("type") == "gacha":
+            # 重み0のプールは排出されないため数えない
+            return sum(
+                self.pool_stock_count(product_name, pool_name)
+                for pool_name, pool in product.get("pools", {}).items() if pool.get("weight", 0) > 0
+            )
+        if not product.get("stock_id") and not product.get("pool_id"):
+            return 0
+        return self._ledger(product_name).remaining
+
+    def pool_stock_count(self, product_name: str, pool_name: str) -> int:
+        """ガチャ商品のプールごとの在庫数"""
+        if not self.products[product_name]["pools"][pool_name].get("stock_id"):
+            return 0
+        return self._ledger(product_name, pool_name).remaining
+
+    def add_stock(self, product_name: str, items: List[str], dedupe: bool = False, pool_name: Optional[str] = None) -> int:
+        """在庫を追加し、追加件数を返す (dedupe=True の場合は既存在庫と重複するものを除外)"""
+        pool_id = self.products[product_name].get("pool_id")
+        if pool_name is None and pool_id:
+            # 共有在庫プールへ追記し、プールを参照している全自販機へ通知
+            return inventory_pools.add_stock(pool_id, items, dedupe)
+        ledger = self._ledger(product_name, pool_name)
+        was_empty = ledger.remaining == 0
+        before = self.stock_count(product_name)
+        added = append_stock(ledger, items, dedupe)
+        self._after_add(product_name, pool_name, added, before, was_empty)
+        return added
+
+    async def add_stock_async(self, product_name: str, items: List[str], dedupe: bool = False, pool_name: Optional[str] = None) -> int:
+        """add_stock と同じだが、台帳への書き込み (重複チェックのハッシュ計算を含む) をスレッドで行う
+
+        大量の補充でイベントループ (ハートビート・購入処理) を止めないためのもの。
+        補充後の通知はイベントループ上で行う。
+        """
+        pool_id = self.products[product_name].get("pool_id")
+        if pool_name is None and pool_id:
+            return await inventory_pools.add_stock_async(pool_id, items, dedupe)
+        ledger = self._ledger(product_name, pool_name)
+        was_empty = ledger.remaining == 0
+        before = self.stock_count(product_name)
+        added = await asyncio.to_thread(append_stock, ledger, items, dedupe)
+        self._after_add(product_name, pool_name, added, before, was_empty)
+        return added
+
+    def _after_add(self, product_name: str, pool_name: Optional[str], added: int, before, was_empty: bool):
+        if added:
+            if pool_name is not None and was_empty:
+                # 空だったプールが抽選対象に戻るので抽選表を作り直す
+                self._gacha_tables.pop(product_name, None)
+            self._touch()
+            self._after_restock(product_name, before)
+
+    # --- 低在庫・入荷通知 ---
+    def _after_restock(self, product_name: str, before: int):
+        """補充後の処理: 低在庫通知の再有効化と、在庫切れからの入荷イベント"""
+        remaining = self.stock_count(product_name)
+        if remaining == "∞":
+            return
+        self._check_low_stock(product_name, 0)
+        if before == 0 and remaining > 0:
+            self._emit_stock_event("restocked", product_name, remaining)
+
+    def _check_low_stock(self, product_name: str, taken: int):
+        """在庫数を閾値と比較する (在庫カウンタを読むだけの O(1))
+
+        一度通知したら、在庫が閾値の LOW_STOCK_REARM_RATIO 倍を上回るまで
+        再通知しない (閾値付近での増減による連続通知を防ぐヒステリシス)。
+        """
+        product = self.products[product_name]
+        threshold = product.get("low_stock_threshold") or 0
+        if threshold <= 0 or product.get("infinite_stock", False):
+            return
+        remaining = self.stock_count(product_name)
+        alerted = self._low_stock_alerted.get(product_name)
+        if alerted is None:
+            # 起動後の初回は、今回の払い出し前の在庫で通知済みかどうかを判断する
+            alerted = remaining + taken <= threshold
+        if not alerted and remaining <= threshold:
+            alerted = True
+            self._emit_stock_event("low_stock", product_name, remaining)
+        elif alerted and remaining >= max(threshold + 1, int(threshold * LOW_STOCK_REARM_RATIO)):
+            alerted = False
+        self._low_stock_alerted[product_name] = alerted
+
+    # --- 共有在庫プール ---
+    def link_pool(self, product_name: str, pool_id: Optional[str]):
+        """商品を共有在庫プールに紐付ける (None で解除)。商品自身の未販売在庫はプールへ移す"""
+        product = self.products[product_name]
+        if pool_id and product.get("stock_id") and not product.get("pool_id"):
+            own = self._ledger(product_name)
+            leftover = own.peek_all()
+            if leftover:
+                inventory_pools.add_stock(pool_id, leftover, dedupe=True)
+            drop_ledger(VendingMachine._get_stock_dir(self.vm_id), product.pop("stock_id"), destroy=True)
+        if pool_id:
+            product["pool_id"] = pool_id
+        else:
+            product.pop("pool_id", None)
+        self.save_vm()
+
+    # --- ガチャ商品 ---
+    def set_gacha_pool(self, product_name: str, pool_name: str, weight: float):
+        """ガチャ商品のプールを追加・重み変更する"""
+        pools = self.products[product_name].setdefault("pools", {})
+        pools.setdefault(pool_name, {})["weight"] = weight
+        self._gacha_tables.pop(product_name, None)
+        self.save_vm()
+
+    def _gacha_table(self, product_name: str) -> AliasTable:
+        """在庫のあるプールだけを重みに応じて抽選する表 (キャッシュ)"""
+        table = self._gacha_tables.get(product_name)
+        if table is None:
+            pools = self.products[product_name].get("pools", {})
+            table = AliasTable({
+                pool_name: pool.get("weight", 0)
+                for pool_name, pool in pools.items()
+                if self.pool_stock_count(product_name, pool_name) > 0
+            })
+            self._gacha_tables[product_name] = table
+        return table
+
+    def _draw_gacha(self, product_name: str) -> Optional[str]:
+        """プールを重み付きで抽選し、そのプールの先頭アイテムを払い出す (抽選は O(1))"""
+        for _ in range(2):
+            table = self._gacha_table(product_name)
+            pool_name = table.sample()
+            if pool_name is None:
+                return None # 全プール在庫切れ
+            ledger = self._ledger(product_name, pool_name)
+            item = ledger.consume()
+            self._unsynced.append(ledger)
+            if ledger.remaining == 0:
+                # プールが空になったら次回の抽選から外す
+                self._gacha_tables.pop(product_name, None)
+            if item is not None:
+                return item
+        return None
         
-    def create_embed(self, selected_product_name: Optional[str] = None) -> discord.Embed:
-        """自販機の表示用Embedを作成"""
+    def create_embed(self, selected_product_name: Optional[str] = None, product_names: Optional[List[str]] = None, page_label: Optional[str] = None) -> discord.Embed:
+        """自販機の表示用Embedを作成 (product_names を渡した場合はその商品のみ表示)"""
         # (ロジックが長くなるため、簡略化してここでは基本的な表示のみ)
         embed = discord.Embed(
             title=f"🛒 {self.name} - 自動販売機",
             description="商品を選択して購入ボタンを押してください。",
             color=discord.Color.blue()
         )
-        for name, info in self.products.items():
-            stock_count = "∞" if info.get("infinite_stock", False) else len(info.get("stock", []))
+        for name in (product_names if product_names is not None else self.products):
+            info = self.products[name]
+            stock_count = self.stock_count(name)
             value_text = f"価格: **¥{info['price']}** | 在庫: **{stock_count}**個"
             embed.add_field(name=name, value=value_text, inline=False)
             
         if selected_product_name and selected_product_name in self.products:
             embed.title = f"🛒 {self.name} - {selected_product_name} 選択中"
+
+        if page_label:
+            embed.set_footer(text=page_label)
             
         return embed
         
+    def _take(self, product_name: str, quantity: int) -> List[str]:
+        """在庫から最大 quantity 件を取り出す (表示の更新通知は呼び出し側で1回だけ行う)"""
+        product = self.products[product_name]
+        if product.get("infinite_stock", False):
+            return [product.get("infinite_item", "無限アイテム (未設定)")] * quantity
+        if product.get("type") == "gacha":
+            items = []
+            for _ in range(quantity):
+                item = self._draw_gacha(product_name)
+                if item is None:
+                    break
+                items.append(item)
+            return items
+        # 台帳の先頭から取り出す (カーソル更新のみで、VM JSONは書き換えない)
+        ledger = self._ledger(product_name)
+        self._unsynced.append(ledger)
+        return ledger.consume_many(quantity)
+
+    def _take_unsynced(self) -> List[Tuple[StockLedger, int]]:
+        """購入ロック内で払い出した台帳と、確定が必要なカーソルの書き込み回数を取り出す"""
+        unsynced = {id(ledger): (ledger, ledger.cursor_seq) for ledger in self._unsynced}
+        self._unsynced = []
+        return list(unsynced.values())
+
+    @staticmethod
+    async def _sync_ledgers(unsynced: List[Tuple[StockLedger, int]]):
+        """カーソルの fsync をスレッドで待つ (購入ロックは解放済みのため、他の購入は止まらない)"""
+        if unsynced:
+            await asyncio.to_thread(lambda: [ledger.sync(seq) for ledger, seq in unsynced])
+
+    def _notify_stock_changed(self, product_names: List[str]):
+        """在庫の変化を通知する (共有在庫プールは参照している全自販機へ)"""
+        touch_self = False
+        for pool_id in {self.products[name].get("pool_id") for name in product_names}:
+            if pool_id:
+                # 同じプールを並べている他の自販機の在庫表示も更新する
+                inventory_pools.notify(pool_id)
+            else:
+                touch_self = True
+        if touch_self:
+            self._touch()
+
     def purchase_item(self, product_name: str) -> Optional[str]:
         """在庫からアイテムを取り出し、在庫を減らす"""
         if product_name not in self.products:
             return None
-            
-        product = self.products[product_name]
-        
-        if product.get("infinite_stock", False):
-            return product.get("infinite_item", "無限アイテム (未設定)")
-        
-        if product["stock"]:
-            item = product["stock"].pop(0) # 最初のアイテムを取り出す
-            self.save_vm() # 在庫が減ったので保存
-            return item
+        items = self._take(product_name, 1)
+        if not items:
+            return None # 在庫切れ
+        if not self.products[product_name].get("infinite_stock", False):
+            self._notify_stock_changed([product_name])
+            self._check_low_stock(product_name, 1)
+        return items[0]
+
+    async def purchase(self, product_name: str, interaction_id: int, buyer_id: Optional[int] = None) -> Tuple[Optional[str], bool]:
+        """購入をVM単位で直列化して実行する
         
-        return None # 在庫切れ
+        戻り値は (アイテム, 重複かどうか)。同じ interaction_id での2回目以降の
+        呼び出しは在庫を消費せず、最初のアイテムを重複フラグ付きで返す。
+        購入が成立した場合は売上台帳にも記録する。
+        アイテムは在庫カーソルの確定 (fsync) を待ってから返す。
+        """
+        async with self._purchase_lock:
+            previous = purchase_dedup.get(interaction_id)
+            if previous is not None:
+                return previous, True
+            item = self.purchase_item(product_name)
+            if item is not None:
+                purchase_dedup.record(interaction_id, item)
+                try:
+                    get_sales_ledger(self.vm_id).record(product_name, self.products[product_name]["price"], buyer_id)
+                except Exception as e:
+                    print(f"⚠️ 警告: 売上の記録に失敗しました ({self.vm_id}): {e}")
+            unsynced = self._take_unsynced()
+        await self._sync_ledgers(unsynced)
+        return item, False
+
+    async def purchase_cart(self, cart: Dict[str, int], interaction_id: int, buyer_id: Optional[int] = None) -> Tuple[Optional[Dict[str, List[str]]], bool]:
+        """複数商品・複数個をまとめて購入する (全商品の在庫が揃う場合のみ成立)
+
+        戻り値は ({商品名: [アイテム, ...]}, 重複かどうか)。在庫が足りない商品が
+        1つでもあれば何も消費せず None を返す。在庫の確認から払い出しまでを
+        購入ロック内で await を挟まずに行い、さらに関係する台帳のロックを保持するため、
+        他の自販機 (共有在庫プール) や他スレッドからの払い出しも途中で割り込まない。
+        """
+        async with self._purchase_lock:
+            previous = purchase_dedup.get(interaction_id)
+            if previous is not None:
+                return previous, True
+            # 同じ共有在庫プールを参照する商品があるため、台帳ごとに希望数を合計して確認する
+            demand: Dict[int, List[Any]] = {}
+            gacha: Dict[str, int] = {}
+            ledgers: Dict[int, StockLedger] = {}
+            for product_name, quantity in cart.items():
+                if product_name not in self.products or quantity <= 0:
+                    return None, False
+                product = self.products[product_name]
+                if product.get("infinite_stock", False):
+                    continue
+                if product.get("type") == "gacha":
+                    gacha[product_name] = quantity
+                    for pool_name, pool in product.get("pools", {}).items():
+                        if pool.get("stock_id"):
+                            ledger = self._ledger(product_name, pool_name)
+                            ledgers[id(ledger)] = ledger
+                    continue
+                if not product.get("stock_id") and not product.get("pool_id"):
+                    return None, False # 一度も補充されていない商品
+                ledger = self._ledger(product_name)
+                demand.setdefault(id(ledger), [ledger, 0])[1] += quantity
+                ledgers[id(ledger)] = ledger
+
+            with ExitStack() as stack:
+                # デッドロックしないよう、台帳のロックは常に同じ順序で取る
+                for ledger in sorted(ledgers.values(), key=lambda l: (l.stock_dir, l.stock_id)):
+                    stack.enter_context(ledger.lock)
+                for product_name, quantity in gacha.items():
+                    if self.stock_count(product_name) < quantity:
+                        return None, False
+                for ledger, quantity in demand.values():
+                    if ledger.remaining < quantity:
+                        return None, False
+                result = {product_name: self._take(product_name, quantity) for product_name, quantity in cart.items()}
+            limited = [name for name in result if not self.products[name].get("infinite_stock", False)]
+            self._notify_stock_changed(limited)
+            for product_name in limited:
+                self._check_low_stock(product_name, len(result[product_name]))
+            purchase_dedup.record(interaction_id, result)
+            sales = get_sales_ledger(self.vm_id)
+            for product_name, items in result.items():
+                try:
+                    sales.record(product_name, self.products[product_name]["price"], buyer_id, units=len(items))
+                except Exception as e:
+                    print(f"⚠️ 警告: 売上の記録に失敗しました ({self.vm_id}): {e}")
+            unsynced = self._take_unsynced()
+        await self._sync_ledgers(unsynced)
+        return result, False
 
 # =========================================================
 # 2. Cog: 自販機の作成・削除
@@ -141,7 +966,31 @@ class CreateVMCog(commands.Cog):
         except Exception as e:
             await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
 
+    @app_commands.command(
+        name="vm_delete",
+        description="自動販売機を削除します。"
+    )
+    @app_commands.describe(vm_name="削除する自販機の名前")
+    async def vm_delete_command(self, interaction: discord.Interaction, vm_name: str):
+        if not interaction.user.guild_permissions.administrator:
+            return await interaction.response.send_message("❌ このコマンドは管理者のみ実行できます。", ephemeral=True)
+
+        await interaction.response.defer(ephemeral=True)
+
+        vm_id = VendingMachine.get_vm_id_by_name(interaction.guild_id, vm_name)
+        if not vm_id:
+            return await interaction.followup.send(f"❌ 自販機`{vm_name}`が見つかりません。", ephemeral=True)
+
+        try:
+            VendingMachine.delete_vm(vm_id)
+            await interaction.followup.send(f"✅ 自販機`{vm_name}`を削除しました。", ephemeral=True)
+        except Exception as e:
+            await interaction.followup.send(f"❌ エラーが発生しました: {str(e)}", ephemeral=True)
+
 
 async def setup(bot: commands.Bot):
+    # 起動時に一度だけ vm_config/ を読み込み、以降はインメモリで検索する
+    inventory_pools.ensure_loaded()
+    vm_registry.ensure_loaded()
     await bot.add_cog(CreateVMCog(bot))
     # (削除や在庫管理などの他の管理コグもここに追加されます)
\ No newline at end of file
@@ -0,0 +1,66 @@
+# cogs/vm_migrate.py
+#
+# 既存の vm_config を一括でギルド別ディレクトリ・最新の schema_version へ移行するツール。
+# Bot は起動時に読み込んだ自販機を順次移行するため必須ではないが、
+# 既存環境をまとめて移行しておきたい場合に使う。
+#
+#   python -m cogs.vm_migrate            # 移行を実行
+#   python -m cogs.vm_migrate --dry-run  # 対象の一覧だけを表示
+
+import json
+import argparse
+from typing import Optional, List
+from .vm_management import SCHEMA_VERSION, vm_registry
+
+
+def find_outdated() -> List[str]:
+    """移行が必要なVM ID (旧形式の保存先、または古い schema_version) の一覧"""
+    vm_registry.ensure_loaded()
+    outdated = set(vm_registry.legacy_vm_ids())
+    for vm_id in vm_registry.list_all_vms():
+        path = vm_registry.get_path(vm_id)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                if json.load(f).get("schema_version", 1) < SCHEMA_VERSION:
+                    outdated.add(vm_id)
+        except Exception as e:
+            print(f"⚠️ 警告: 自販機ファイル {path} を読み込めません: {e}")
+    return sorted(outdated)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="vm_config をギルド別ディレクトリ・最新形式へ移行します。")
+    parser.add_argument("--dry-run", action="store_true", help="移行せずに対象の一覧だけを表示する")
+    args = parser.parse_args(argv)
+
+    outdated = find_outdated()
+    if not outdated:
+        print(f"✅ 移行が必要な自販機はありません (schema_version {SCHEMA_VERSION})。")
+        return 0
+
+    failed = 0
+    for vm_id in outdated:
+        source = vm_registry.get_path(vm_id)
+        if args.dry_run:
+            print(f"- {vm_id}: {source}")
+            continue
+        try:
+            # 読み込み時に変換され、新しい保存先へ原子的に書き込まれる
+            vm = vm_registry.get_vm(vm_id)
+            if vm_id in vm_registry.legacy_vm_ids():
+                # 形式は最新でも保存先が旧形式のままのものは保存し直して移動する
+                vm.save_vm()
+            print(f"✅ {vm_id}: {source} -> {vm_registry.get_path(vm_id)}")
+        except Exception as e:
+            failed += 1
+            print(f"ERROR: {vm_id} の移行に失敗しました: {e}")
+
+    if args.dry_run:
+        print(f"{len(outdated)} 台の自販機が移行対象です。")
+    else:
+        print(f"移行完了: {len(outdated) - failed} 台成功 / {failed} 台失敗")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
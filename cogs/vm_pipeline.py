@@ -0,0 +1,248 @@
+# cogs/vm_pipeline.py
+
+import discord
+from discord.ext import commands
+import os
+import json
+import asyncio
+from io import BytesIO
+from typing import Optional, List, Dict, Any
+from .purchase_notifications import send_purchase_notification, send_low_stock_alert
+
+# =========================================================
+# 設定
+# =========================================================
+SPOOL_DIR = "vm_spool"
+DEAD_LETTER_FILE = os.path.join(SPOOL_DIR, "dead_letter.jsonl")
+# 再投入中のデッドレター (再投入したジョブがすべて処理し終わるまで残す)
+REPLAY_FILE = os.path.join(SPOOL_DIR, "dead_letter.replaying.jsonl")
+
+QUEUE_MAX_SIZE = 1000   # キューの上限 (超えた場合は投入側が空きを待つ)
+WORKER_COUNT = 4        # ワーカー数
+MAX_ATTEMPTS = 5        # 1ジョブあたりの最大試行回数
+BACKOFF_BASE = 1.0      # リトライ間隔 (秒): 1, 2, 4, 8 ...
+
+
+# =========================================================
+# PostPurchasePipeline (購入後の副作用をバックグラウンドで処理)
+# =========================================================
+class PostPurchasePipeline:
+    """購入通知・DM送信を購入処理のクリティカルパスから外すワーカープール
+
+    ジョブは辞書で表す:
+    - {"type": "notification", "guild_id", "user_id", "product_name", "price", "item_content", "vm_id"?, "products"?}
+    - {"type": "dm", "user_id", "content", "attachment"?, "filename"?}
+      (attachment がある場合はその文字列をテキストファイルとして添付する)
+    - {"type": "low_stock", "guild_id", "vm_name", "product_name", "remaining", "threshold", "vm_id"?, "price"?}
+
+    失敗したジョブは指数バックオフでリトライし、それでも失敗したものは
+    dead_letter.jsonl に書き出して次回起動時に再投入する。再投入するスプールは
+    dead_letter.replaying.jsonl に移し、そのジョブがすべて処理し終わってから消す
+    (途中で落ちた場合は次回もう一度再投入する。同じ通知が重複することはあるが失われない)。
+    "_" で始まるキー (interaction など) はメモリ上でのみ使い、スプールには書かない。
+    """
+    def __init__(self):
+        self.bot: Optional[commands.Bot] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    async def start(self, bot: commands.Bot):
+        """ワーカーを起動し、前回までのデッドレターを再投入する"""
+        if self.running:
+            return
+        self.bot = bot
+        self._queue = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f"vm-pipeline-worker-{i}")
+            for i in range(WORKER_COUNT)
+        ]
+        jobs = self._take_dead_letters()
+        replay = {"remaining": len(jobs)}
+        for job in jobs:
+            job["_replay"] = replay
+            await self.submit(job)
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def drain(self):
+        """投入済みのジョブがすべて処理されるまで待つ"""
+        if self.running:
+            await self._queue.join()
+
+    async def submit(self, job: Dict[str, Any]):
+        """ジョブを投入する (ワーカー未起動の場合はその場で実行)"""
+        if not self.running:
+            await self._process(job)
+            self._finish_replay(job)
+            return
+        await self._queue.put(job)
+
+    # --- ワーカー ---
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            except Exception as e:
+                print(f"ERROR: 購入後処理ワーカーで予期せぬエラーが発生しました: {e}")
+            else:
+                self._finish_replay(job)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job: Dict[str, Any]):
+        """ジョブを実行し、失敗時はバックオフ付きでリトライ、最終的にデッドレターへ"""
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                await self._run(job)
+                return
+            except Exception as e:
+                if self._is_permanent(e):
+                    # 権限不足・宛先なし・本文が長すぎるなどはリトライしても成功しない
+                    await self._on_permanent_failure(job, e)
+                    return
+                if attempt == MAX_ATTEMPTS - 1:
+                    print(f"ERROR: 購入後処理 ({job.get('type')}) が {MAX_ATTEMPTS} 回失敗しました: {e}")
+                    self._append_dead_letter(job)
+                    return
+                await asyncio.sleep(BACKOFF_BASE * (2 ** attempt))
+
+    @staticmethod
+    def _is_permanent(error: Exception) -> bool:
+        """429 (レート制限) 以外の 4xx はリクエスト自体の問題なので再送しない"""
+        return isinstance(error, discord.HTTPException) and 400 <= error.status < 500 and error.status != 429
+
+    async def _run(self, job: Dict[str, Any]):
+        job_type = job.get("type")
+        if job_type == "notification":
+            await send_purchase_notification(
+                bot=self.bot,
+                guild_id=job["guild_id"],
+                user_id=job["user_id"],
+                product_name=job["product_name"],
+                price=job["price"],
+                item_content=job["item_content"],
+                raise_on_error=True,
+                vm_id=job.get("vm_id"),
+                products=job.get("products")
+            )
+        elif job_type == "low_stock":
+            await send_low_stock_alert(
+                bot=self.bot,
+                guild_id=job["guild_id"],
+                vm_name=job["vm_name"],
+                product_name=job["product_name"],
+                remaining=job["remaining"],
+                threshold=job["threshold"],
+                raise_on_error=True,
+                vm_id=job.get("vm_id"),
+                price=job.get("price")
+            )
+        elif job_type == "dm":
+            user = self.bot.get_user(int(job["user_id"])) or await self.bot.fetch_user(int(job["user_id"]))
+            await user.send(job["content"], **self._attachment(job))
+        else:
+            print(f"⚠️ 警告: 不明な購入後処理ジョブです: {job_type}")
+
+    @staticmethod
+    def _attachment(job: Dict[str, Any]) -> Dict[str, Any]:
+        """添付ファイルの引数 (リトライのたびに新しい File を作る)"""
+        if not job.get("attachment"):
+            return {}
+        data = BytesIO(job["attachment"].encode("utf-8"))
+        return {"file": discord.File(data, filename=job.get("filename", "items.txt"))}
+
+    async def _on_permanent_failure(self, job: Dict[str, Any], error: Exception):
+        interaction: Optional[discord.Interaction] = job.get("_interaction")
+        if job.get("type") == "dm" and interaction is not None and isinstance(error, (discord.Forbidden, discord.NotFound)):
+            # DMが閉じている場合は、購入者本人にだけ見えるメッセージで商品を届ける
+            try:
+                await interaction.followup.send(
+                    "❌ DMを送信できませんでした。あなたのDM設定（サーバーメンバーからのDM）を確認してください。\n"
+                    "今回の商品は以下の通りです（このメッセージはあなたにのみ表示されています）。\n"
+                    f"{job['content']}",
+                    ephemeral=True,
+                    **self._attachment(job)
+                )
+                return
+            except Exception as e:
+                print(f"ERROR: DM代替メッセージの送信に失敗しました: {e}")
+        print(f"ERROR: 購入後処理 ({job.get('type')}) を送信できませんでした: {error}")
+
+    # --- デッドレタースプール ---
+    def _append_dead_letter(self, job: Dict[str, Any]):
+        record = {k: v for k, v in job.items() if not k.startswith("_")}
+        try:
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            with open(DEAD_LETTER_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                # 再投入中のスプールを消す前に、再びスプールしたものを確定させる
+                os.fsync(f.fileno())
+        except Exception as e:
+            print(f"ERROR: デッドレターの書き込みに失敗しました: {e}")
+
+    def _take_dead_letters(self) -> List[Dict[str, Any]]:
+        """スプールを再投入用のファイルへ移して読み出す (ファイルは再投入の完了後に消す)
+
+        前回の再投入が途中で終わっていた場合は、その残りと新しいデッドレターを合わせて再投入する。
+        """
+        try:
+            if os.path.exists(DEAD_LETTER_FILE):
+                if os.path.exists(REPLAY_FILE):
+                    with open(DEAD_LETTER_FILE, "rb") as src, open(REPLAY_FILE, "ab") as dst:
+                        dst.write(src.read())
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                    os.remove(DEAD_LETTER_FILE)
+                else:
+                    os.replace(DEAD_LETTER_FILE, REPLAY_FILE)
+            if not os.path.exists(REPLAY_FILE):
+                return []
+            jobs = []
+            with open(REPLAY_FILE, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        try:
+                            jobs.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            continue
+        except Exception as e:
+            print(f"ERROR: デッドレターの読み込みに失敗しました: {e}")
+            return []
+        if jobs:
+            print(f"INFO: デッドレター {len(jobs)} 件を再投入します。")
+        else:
+            self._remove_replay_file()
+        return jobs
+
+    def _finish_replay(self, job: Dict[str, Any]):
+        """再投入したジョブが処理し終わったら数え、すべて終わったら再投入用のファイルを消す"""
+        replay = job.get("_replay")
+        if replay is None:
+            return
+        replay["remaining"] -= 1
+        if replay["remaining"] == 0:
+            self._remove_replay_file()
+
+    @staticmethod
+    def _remove_replay_file():
+        try:
+            os.remove(REPLAY_FILE)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"ERROR: 再投入済みのデッドレターを削除できませんでした: {e}")
+
+
+# プロセス全体で共有するパイプライン
+purchase_pipeline = PostPurchasePipeline()
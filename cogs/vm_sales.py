@@ -0,0 +1,231 @@
+# cogs/vm_sales.py
+
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from typing import Optional, List, Dict, Any, Iterator
+
+# =========================================================
+# 設定
+# =========================================================
+SALES_DIR = "vm_sales"
+TOP_BUYERS = 10          # 保持する上位購入者の人数
+SNAPSHOT_EVERY = 100     # この件数の売上ごとに集計スナップショットを保存
+
+
+def _day_key(ts: float) -> str:
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
+
+
+# =========================================================
+# SalesLedger (追記型の売上台帳 + 逐次更新される集計)
+# =========================================================
+class SalesLedger:
+    """1台の自販機の売上を記録するクラス
+
+    - {vm_id}.jsonl      : 売上1件を1行で追記 (vm_id, product, price, buyer, ts)
+    - {vm_id}.stats.json : 集計のスナップショットと、反映済みの台帳バイト位置
+
+    売上のたびに日別・商品別の売上/個数と上位購入者を更新するため、
+    /vm_stats は履歴を読み直さずに集計だけから答えられる。
+    起動時はスナップショットを読み、それ以降に追記された分だけ再生する。
+    """
+    def __init__(self, vm_id: str):
+        self.vm_id = vm_id
+        self._lock = threading.Lock()
+        os.makedirs(SALES_DIR, exist_ok=True)
+        self.log_path = os.path.join(SALES_DIR, f"{vm_id}.jsonl")
+        self.snapshot_path = os.path.join(SALES_DIR, f"{vm_id}.stats.json")
+
+        # {day: {product: [units, revenue]}}
+        self.daily: Dict[str, Dict[str, List[int]]] = {}
+        # {product: [units, revenue]}
+        self.products: Dict[str, List[int]] = {}
+        # {buyer_id: [units, revenue]}
+        self.buyers: Dict[str, List[int]] = {}
+        # [[buyer_id, revenue], ...] 売上の多い順 (最大 TOP_BUYERS 件)
+        self.top_buyers: List[List[Any]] = []
+        self.total_units = 0
+        self.total_revenue = 0
+        self._offset = 0
+        self._since_snapshot = 0
+        self._load()
+
+    # --- 読み込み ---
+    def _load(self):
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                    snapshot = json.load(f)
+                self.daily = snapshot["daily"]
+                self.products = snapshot["products"]
+                self.buyers = snapshot["buyers"]
+                self.top_buyers = snapshot["top_buyers"]
+                self.total_units = snapshot["total_units"]
+                self.total_revenue = snapshot["total_revenue"]
+                self._offset = snapshot["offset"]
+            except Exception as e:
+                print(f"⚠️ 警告: 売上集計 {self.snapshot_path} が読み込めないため再集計します: {e}")
+                self._reset_aggregates()
+        if not os.path.exists(self.log_path):
+            return
+        # スナップショット以降の売上だけを再生
+        with open(self.log_path, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self._apply(json.loads(line))
+                self._offset += len(line)
+
+    def _reset_aggregates(self):
+        self.daily, self.products, self.buyers, self.top_buyers = {}, {}, {}, []
+        self.total_units = self.total_revenue = self._offset = 0
+
+    def _save_snapshot(self):
+        snapshot = {
+            "offset": self._offset,
+            "daily": self.daily,
+            "products": self.products,
+            "buyers": self.buyers,
+            "top_buyers": self.top_buyers,
+            "total_units": self.total_units,
+            "total_revenue": self.total_revenue,
+        }
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+        self._since_snapshot = 0
+
+    # --- 記録 ---
+    def record(self, product: str, price: int, buyer_id, ts: Optional[float] = None, units: int = 1):
+        """売上を1件追記し、集計を更新する"""
+        record = {
+            "vm_id": self.vm_id,
+            "product": product,
+            "price": price,
+            "units": units,
+            "buyer": str(buyer_id),
+            "ts": ts if ts is not None else time.time(),
+        }
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.log_path, "ab") as f:
+                f.write(line)
+            self._offset += len(line)
+            self._apply(record)
+            self._since_snapshot += 1
+            if self._since_snapshot >= SNAPSHOT_EVERY:
+                try:
+                    self._save_snapshot()
+                except Exception as e:
+                    print(f"⚠️ 警告: 売上集計のスナップショット保存に失敗しました: {e}")
+
+    def _apply(self, record: Dict[str, Any]):
+        units = record.get("units", 1)
+        revenue = record["price"] * units
+        product = record["product"]
+        buyer = record["buyer"]
+
+        day = self.daily.setdefault(_day_key(record["ts"]), {})
+        day.setdefault(product, [0, 0])
+        day[product][0] += units
+        day[product][1] += revenue
+
+        self.products.setdefault(product, [0, 0])
+        self.products[product][0] += units
+        self.products[product][1] += revenue
+
+        self.buyers.setdefault(buyer, [0, 0])
+        self.buyers[buyer][0] += units
+        self.buyers[buyer][1] += revenue
+
+        self.total_units += units
+        self.total_revenue += revenue
+        self._update_top_buyers(buyer, self.buyers[buyer][1])
+
+    def _update_top_buyers(self, buyer: str, revenue: int):
+        """購入者の累計は増える一方なので、上位 TOP_BUYERS 件だけを差分更新すればよい"""
+        for entry in self.top_buyers:
+            if entry[0] == buyer:
+                entry[1] = revenue
+                break
+        else:
+            if len(self.top_buyers) < TOP_BUYERS:
+                self.top_buyers.append([buyer, revenue])
+            elif revenue > self.top_buyers[-1][1]:
+                self.top_buyers[-1] = [buyer, revenue]
+            else:
+                return
+        self.top_buyers.sort(key=lambda e: e[1], reverse=True)
+
+    # --- 参照 ---
+    def summary(self, days: int) -> Dict[str, Any]:
+        """直近 days 日間の集計 (履歴は読まず、日別集計のみ参照)"""
+        now = time.time()
+        units = revenue = 0
+        per_product: Dict[str, List[int]] = {}
+        for i in range(days):
+            day = self.daily.get(_day_key(now - i * 86400))
+            if not day:
+                continue
+            for product, (p_units, p_revenue) in day.items():
+                per_product.setdefault(product, [0, 0])
+                per_product[product][0] += p_units
+                per_product[product][1] += p_revenue
+                units += p_units
+                revenue += p_revenue
+        return {
+            "units": units,
+            "revenue": revenue,
+            "products": per_product,
+            "top_buyers": [list(e) for e in self.top_buyers],
+            "total_units": self.total_units,
+            "total_revenue": self.total_revenue,
+        }
+
+    def iter_records(self, since: Optional[float] = None, until: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """台帳を1行ずつ読み、期間内の売上を順に返す (全件をメモリに載せない)"""
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                if since is not None and record["ts"] < since:
+                    continue
+                if until is not None and record["ts"] >= until:
+                    continue
+                yield record
+
+    def flush(self):
+        with self._lock:
+            if self._since_snapshot:
+                self._save_snapshot()
+
+
+# =========================================================
+# 台帳のキャッシュ
+# =========================================================
+_sales_ledgers: Dict[str, SalesLedger] = {}
+
+
+def get_sales_ledger(vm_id: str) -> SalesLedger:
+    ledger = _sales_ledgers.get(vm_id)
+    if ledger is None:
+        ledger = SalesLedger(vm_id)
+        _sales_ledgers[vm_id] = ledger
+    return ledger
+
+
+def flush_all():
+    """全台帳の集計スナップショットを保存 (終了時)"""
+    for ledger in list(_sales_ledgers.values()):
+        try:
+            ledger.flush()
+        except Exception as e:
+            print(f"⚠️ 警告: 売上集計の保存に失敗しました ({ledger.vm_id}): {e}")
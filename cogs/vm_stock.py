@@ -0,0 +1,428 @@
+# cogs/vm_stock.py
+
+import os
+import json
+import hashlib
+import random
+import threading
+from typing import Optional, List, Dict, Iterable, Set, Tuple
+
+# =========================================================
+# 設定
+# =========================================================
+# 消費済み領域がこのサイズを超え、かつファイルの半分以上になったらコンパクションする
+COMPACT_MIN_BYTES = 1024 * 1024
+# カーソルファイルの固定長レコード: "世代 オフセット\n"
+CURSOR_FORMAT = "%010d %020d\n"
+CURSOR_SIZE = len(CURSOR_FORMAT % (0, 0))
+
+
+# =========================================================
+# StockLedger (商品ごとの追記型在庫ログ + 消費カーソル)
+# =========================================================
+class StockLedger:
+    """1商品分の在庫を追記専用ログで管理するクラス
+
+    - {stock_id}.{世代}.log : 1行に1アイテム (JSON文字列) を追記する
+    - {stock_id}.cursor     : 現在の世代と、次に払い出す行のバイトオフセット
+
+    購入時はログを1行読み、固定長のカーソルを書き換えるだけなので O(1)。
+    カーソルの fsync は sync() で行い、同時に待っている購入の分を1回にまとめる。
+    消費済み領域が一定量を超えると、バックグラウンドで未消費部分だけを
+    新しい世代のログにコピーし、カーソルの書き換えで切り替える。
+    """
+    def __init__(self, stock_dir: str, stock_id: str):
+        self.stock_dir = stock_dir
+        self.stock_id = stock_id
+        self._lock = threading.RLock()
+        self._compacting = False
+        # 未消費アイテムのハッシュ索引 (重複チェック用、初回の重複チェック時に構築)
+        self._hashes: Optional[Set[bytes]] = None
+        # カーソルの書き込み回数と、fsync で確定済みの回数 (グループコミット用)
+        self.cursor_seq = 0
+        self._synced_seq = 0
+        self._cursor_created = False
+        self._sync_lock = threading.Lock()
+
+        os.makedirs(stock_dir, exist_ok=True)
+        self._cursor_path = os.path.join(stock_dir, f"{stock_id}.cursor")
+        self.generation, self.offset = self._read_cursor()
+        log_exists = os.path.exists(self._log_path(self.generation))
+        self._fh = open(self._log_path(self.generation), "a+b")
+        if not log_exists:
+            self._fsync_dir()
+        self._cleanup_stale_generations()
+        self._repair_tail()
+        self.remaining = self._count_remaining()
+
+    @property
+    def lock(self) -> threading.RLock:
+        """複数の台帳にまたがる操作 (まとめ買い) で、確認から払い出しまでを割り込ませないためのロック"""
+        return self._lock
+
+    # --- ファイル操作 ---
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self.stock_dir, f"{self.stock_id}.{generation}.log")
+
+    def _read_cursor(self):
+        if not os.path.exists(self._cursor_path):
+            return 0, 0
+        try:
+            with open(self._cursor_path, "rb") as f:
+                generation, offset = f.read(CURSOR_SIZE).split()
+                return int(generation), int(offset)
+        except Exception as e:
+            print(f"⚠️ 警告: 在庫カーソル {self._cursor_path} が読み込めません: {e}")
+            return 0, 0
+
+    def _write_cursor(self):
+        """固定長レコードをその場で上書きする (数十バイトのみ書き込み、確定は sync() で行う)"""
+        record = (CURSOR_FORMAT % (self.generation, self.offset)).encode()
+        created = not os.path.exists(self._cursor_path)
+        fd = os.open(self._cursor_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, record, 0)
+        finally:
+            os.close(fd)
+        self.cursor_seq += 1
+        self._cursor_created = self._cursor_created or created
+
+    def _fsync_cursor(self):
+        fd = os.open(self._cursor_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def sync(self, seq: Optional[int] = None):
+        """seq 回目 (省略時は現在) までのカーソルの書き込みを fsync で確定させる (ブロッキング)
+
+        払い出したアイテムを購入者へ渡す前に、イベントループ外のスレッドから呼ぶ。
+        他のスレッドの fsync で既に確定していれば何もしない (グループコミット)。
+        """
+        with self._sync_lock:
+            if seq is not None and self._synced_seq >= seq:
+                return
+            with self._lock:
+                target = self.cursor_seq
+                created, self._cursor_created = self._cursor_created, False
+            try:
+                self._fsync_cursor()
+            except FileNotFoundError:
+                return # 台帳が削除済み
+            if created:
+                self._fsync_dir()
+            self._synced_seq = target
+
+    def _fsync_dir(self):
+        """ファイルの作成・置き換えをディレクトリエントリごと確定させる"""
+        dir_fd = os.open(self.stock_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _sync_log(self):
+        """追記したログを確定させる (補充コマンドの完了報告より前に呼ぶ)"""
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def _cleanup_stale_generations(self):
+        """コンパクション途中で残った古い/未確定の世代ログを削除"""
+        current = os.path.basename(self._log_path(self.generation))
+        prefix = f"{self.stock_id}."
+        for filename in os.listdir(self.stock_dir):
+            if filename.startswith(prefix) and filename.endswith(".log") and filename != current:
+                try:
+                    os.remove(os.path.join(self.stock_dir, filename))
+                except OSError:
+                    pass
+
+    def _repair_tail(self):
+        """書き込み途中で終わった末尾の行を切り捨てる"""
+        self._fh.seek(0, os.SEEK_END)
+        size = self._fh.tell()
+        if size == 0:
+            return
+        self._fh.seek(size - 1)
+        if self._fh.read(1) == b"\n":
+            return
+        self._fh.seek(0)
+        data = self._fh.read()
+        self._fh.truncate(data.rfind(b"\n") + 1)
+
+    def _count_remaining(self) -> int:
+        """起動時に一度だけ、カーソル以降の行数を数える"""
+        count = 0
+        self._fh.seek(self.offset)
+        while True:
+            chunk = self._fh.read(1024 * 1024)
+            if not chunk:
+                break
+            count += chunk.count(b"\n")
+        return count
+
+    # --- 在庫操作 ---
+    @staticmethod
+    def _encode(item: str) -> bytes:
+        return (json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8")
+
+    @staticmethod
+    def _hash(item: str) -> bytes:
+        return hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest()
+
+    def _build_hash_index(self):
+        """未消費アイテムのハッシュ索引を構築する (1回だけ全件走査)"""
+        hashes = set()
+        self._fh.seek(self.offset)
+        for line in self._fh:
+            hashes.add(self._hash(json.loads(line.decode("utf-8"))))
+        self._hashes = hashes
+
+    def append(self, items: Iterable[str]) -> int:
+        """アイテムをログ末尾に追記し、追加した件数を返す"""
+        items = list(items)
+        data = b"".join(self._encode(item) for item in items)
+        if not data:
+            return 0
+        with self._lock:
+            self._fh.write(data)
+            self._sync_log()
+            added = data.count(b"\n")
+            self.remaining += added
+            if self._hashes is not None:
+                self._hashes.update(self._hash(item) for item in items)
+        return added
+
+    def append_unique(self, items: Iterable[str]) -> Tuple[int, int]:
+        """未消費の在庫・同じバッチ内と重複しないアイテムだけを追記する
+        
+        戻り値は (追加件数, 重複でスキップした件数)。
+        """
+        with self._lock:
+            if self._hashes is None:
+                self._build_hash_index()
+            fresh = []
+            skipped = 0
+            for item in items:
+                digest = self._hash(item)
+                if digest in self._hashes:
+                    skipped += 1
+                    continue
+                self._hashes.add(digest)
+                fresh.append(item)
+            if fresh:
+                data = b"".join(self._encode(item) for item in fresh)
+                self._fh.write(data)
+                self._sync_log()
+                self.remaining += len(fresh)
+        return len(fresh), skipped
+
+    def log_size(self) -> int:
+        """現在の世代のログのバイト数"""
+        with self._lock:
+            self._fh.seek(0, os.SEEK_END)
+            return self._fh.tell()
+
+    def truncate(self, size: int):
+        """ログを size バイトまで切り詰める (中断した在庫移行のやり直し用)"""
+        with self._lock:
+            self._fh.truncate(max(size, self.offset))
+            self._sync_log()
+            self.remaining = self._count_remaining()
+            self._hashes = None
+
+    def consume(self) -> Optional[str]:
+        """先頭のアイテムを1つ取り出す (在庫切れなら None、購入者へ渡す前に sync() すること)"""
+        with self._lock:
+            if self.remaining <= 0:
+                return None
+            self._fh.seek(self.offset)
+            line = self._fh.readline()
+            self.offset += len(line)
+            self.remaining -= 1
+            self._write_cursor()
+            item = json.loads(line.decode("utf-8"))
+            if self._hashes is not None:
+                self._hashes.discard(self._hash(item))
+        self._maybe_compact()
+        return item
+
+    def consume_many(self, count: int) -> List[str]:
+        """先頭から最大 count 件をまとめて取り出す (カーソルの書き込みは1回だけ、渡す前に sync() すること)"""
+        with self._lock:
+            count = min(count, self.remaining)
+            if count <= 0:
+                return []
+            self._fh.seek(self.offset)
+            items = []
+            for _ in range(count):
+                line = self._fh.readline()
+                self.offset += len(line)
+                items.append(json.loads(line.decode("utf-8")))
+            self.remaining -= count
+            self._write_cursor()
+            if self._hashes is not None:
+                for item in items:
+                    self._hashes.discard(self._hash(item))
+        self._maybe_compact()
+        return items
+
+    def peek_all(self) -> List[str]:
+        """未消費のアイテムをすべて返す (管理・移行用)"""
+        with self._lock:
+            self._fh.seek(self.offset)
+            return [json.loads(line.decode("utf-8")) for line in self._fh if line.endswith(b"\n")]
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+    def destroy(self):
+        """ログとカーソルを削除する (商品・自販機削除時)"""
+        with self._lock:
+            self._fh.close()
+            for filename in os.listdir(self.stock_dir):
+                if filename.startswith(f"{self.stock_id}."):
+                    try:
+                        os.remove(os.path.join(self.stock_dir, filename))
+                    except OSError:
+                        pass
+
+    # --- コンパクション ---
+    def _maybe_compact(self):
+        if self._compacting or self.offset < COMPACT_MIN_BYTES:
+            return
+        with self._lock:
+            self._fh.seek(0, os.SEEK_END)
+            if self._compacting or self.offset * 2 < self._fh.tell():
+                return
+            self._compacting = True
+        threading.Thread(target=self._compact, name=f"stock-compact-{self.stock_id}", daemon=True).start()
+
+    def _compact(self):
+        """未消費部分を新しい世代のログへ移し、カーソルを切り替える"""
+        try:
+            with self._lock:
+                if self._fh.closed:
+                    return # 台帳が閉じられた (自販機・商品の削除など)
+                base = self.offset
+                self._fh.seek(0, os.SEEK_END)
+                snapshot_end = self._fh.tell()
+            new_generation = self.generation + 1
+            new_path = self._log_path(new_generation)
+
+            # 大半のコピーはロック外で行い、購入を止めない
+            with open(self._log_path(self.generation), "rb") as src, open(new_path, "wb") as dst:
+                src.seek(base)
+                remaining_bytes = snapshot_end - base
+                while remaining_bytes > 0:
+                    chunk = src.read(min(1024 * 1024, remaining_bytes))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    remaining_bytes -= len(chunk)
+
+                with self._lock:
+                    if self._fh.closed:
+                        return # コピー中に閉じられた (未確定の世代は次に開いたときに消える)
+                    # コピー中に追記された分を追いかけてコピー
+                    self._fh.seek(snapshot_end)
+                    tail = self._fh.read()
+                    dst.write(tail)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                    self._fsync_dir()
+
+                    old_path = self._log_path(self.generation)
+                    self._fh.close()
+                    self.generation = new_generation
+                    self.offset -= base
+                    self._fh = open(new_path, "a+b")
+                    # カーソルの書き換えがコミットポイント (古いログを消す前に確定させる)
+                    self._write_cursor()
+                    self._fsync_cursor()
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        pass
+        except Exception as e:
+            print(f"⚠️ 警告: 在庫ログ {self.stock_id} のコンパクションに失敗しました: {e}")
+        finally:
+            self._compacting = False
+
+
+# =========================================================
+# AliasTable (重み付き抽選を O(1) で行うエイリアス表)
+# =========================================================
+class AliasTable:
+    """Vose のエイリアス法による重み付き抽選表
+
+    構築は O(n)、1回の抽選は乱数2つと配列参照だけの O(1)。
+    重みが0以下のキーは抽選対象から外す。
+    """
+    def __init__(self, weights: Dict[str, float]):
+        items = [(key, float(weight)) for key, weight in weights.items() if weight > 0]
+        self.keys: List[str] = [key for key, _ in items]
+        n = len(items)
+        self._prob: List[float] = [0.0] * n
+        self._alias: List[int] = [0] * n
+        if n == 0:
+            return
+
+        total = sum(weight for _, weight in items)
+        scaled = [weight * n / total for _, weight in items]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large:
+            # 浮動小数点誤差で残ったものは確率1として扱う
+            self._prob[i] = 1.0
+
+    def __bool__(self) -> bool:
+        return bool(self.keys)
+
+    def sample(self, rng: random.Random = random) -> Optional[str]:
+        if not self.keys:
+            return None
+        i = rng.randrange(len(self.keys))
+        return self.keys[i] if rng.random() < self._prob[i] else self.keys[self._alias[i]]
+
+
+# =========================================================
+# 開いている台帳のキャッシュ
+# =========================================================
+_ledgers: Dict[str, StockLedger] = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger(stock_dir: str, stock_id: str) -> StockLedger:
+    """台帳を開く (プロセス内で同じ台帳は1つだけ保持する)"""
+    key = os.path.join(stock_dir, stock_id)
+    ledger = _ledgers.get(key)
+    if ledger is None:
+        with _ledgers_lock:
+            ledger = _ledgers.get(key)
+            if ledger is None:
+                ledger = StockLedger(stock_dir, stock_id)
+                _ledgers[key] = ledger
+    return ledger
+
+
+def drop_ledger(stock_dir: str, stock_id: str, destroy: bool = False):
+    """キャッシュから台帳を外す (destroy=True の場合はファイルも削除)"""
+    with _ledgers_lock:
+        ledger = _ledgers.pop(os.path.join(stock_dir, stock_id), None)
+    if ledger is None and destroy and os.path.isdir(stock_dir):
+        ledger = StockLedger(stock_dir, stock_id)
+    if ledger is None:
+        return
+    if destroy:
+        ledger.destroy()
+    else:
+        ledger.close()
@@ -2,8 +2,9 @@
 
 import discord
 import os
-import json
 from datetime import datetime
+# 設定はプロセス全体で共有するキャッシュ経由で読み書きする
+from cogs.purchase_notifications import NOTIFICATION_CONFIG_DIR, notification_config_cache
 
 # ===============================================
 # 1. PurchaseNotificationManager クラス (設定ファイルの読み書き)
@@ -12,12 +13,9 @@ class PurchaseNotificationManager:
     """通知チャンネルの設定を管理するクラス"""
     def __init__(self, guild_id):
         self.guild_id = str(guild_id)
-        # 設定を保存するディレクトリ。例: notification_config/123456789...
-        self.config_dir = os.path.join("notification_config", self.guild_id)
+        # 設定を保存するディレクトリ。例: notification_config/123456789... (保存時に作成する)
+        self.config_dir = os.path.join(NOTIFICATION_CONFIG_DIR, self.guild_id)
         self.config_file = os.path.join(self.config_dir, "config.json")
-        
-        if not os.path.exists(self.config_dir):
-            os.makedirs(self.config_dir)
     
     def set_notification_channel(self, channel_id):
         """通知チャンネルを設定"""
@@ -26,24 +24,16 @@ class PurchaseNotificationManager:
         self._save_config(config)
     
     def get_notification_channel_id(self):
-        """通知チャンネルIDを取得"""
-        config = self._load_config()
-        return config.get("notification_channel_id")
+        """通知チャンネルIDを取得 (キャッシュ参照のみ)"""
+        return notification_config_cache.get(self.guild_id).get("notification_channel_id")
     
     def _load_config(self):
-        """設定ファイルを読み込み"""
-        if os.path.exists(self.config_file):
-            try:
-                with open(self.config_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except:
-                pass
-        return {}
+        """設定を読み込み (キャッシュのコピーを返す)"""
+        return dict(notification_config_cache.get(self.guild_id))
     
     def _save_config(self, config):
-        """設定ファイルに保存"""
-        with open(self.config_file, "w", encoding="utf-8") as f:
-            json.dump(config, f, ensure_ascii=False, indent=4)
+        """設定ファイルに保存 (キャッシュも更新)"""
+        notification_config_cache.save(self.guild_id, config)
 
 # ===============================================
 # 2. send_purchase_notification 関数 (通知の送信)
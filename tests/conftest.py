@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# cogs/ をインポートできるようにし、vm_config などは一時ディレクトリに作らせる
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(tempfile.mkdtemp(prefix="vm_tests_"))
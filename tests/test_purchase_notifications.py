@@ -0,0 +1,35 @@
+import asyncio
+
+from cogs.purchase_notifications import PurchaseNotificationManager, send_low_stock_alert
+
+
+class FakeChannel:
+    def __init__(self, channel_id, sent):
+        self.id = channel_id
+        self.sent = sent
+
+    async def send(self, embed=None, **kwargs):
+        self.sent.append((self.id, embed.title))
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    def get_channel(self, channel_id):
+        return FakeChannel(channel_id, self.sent)
+
+
+def test_low_stock_alert_follows_routing_rules():
+    manager = PurchaseNotificationManager(42)
+    manager.set_notification_channel(100)
+    manager.add_route({"vm_id": "vm1", "channel_id": "200"})
+    manager.add_route({"product": "A", "min_price": 500, "channel_id": "300"})
+    bot = FakeBot()
+
+    async def run():
+        await send_low_stock_alert(bot, 42, "自販機1", "A", 1, 3, vm_id="vm1", price=1000)
+        await send_low_stock_alert(bot, 42, "自販機2", "B", 1, 3, vm_id="vm2", price=1000)
+
+    asyncio.run(run())
+    assert [channel_id for channel_id, _ in bot.sent] == [200, 300, 100]
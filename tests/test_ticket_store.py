@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT_DIR
+from cogs.ticket import ticket_store
+from cogs.ticket.ticket_store import TicketStore
+
+
+def test_pending_changes_are_written_at_exit(tmp_path):
+    # flush() を呼ばずにプロセスが終了しても、キューに積まれた変更は書き込まれる
+    script = (
+        "from cogs.ticket.ticket_store import TicketStore\n"
+        "store = TicketStore('ticket_data.json', 'ticket_data.journal')\n"
+        "for i in range(200):\n"
+        "    store.set(str(i), {'opener_id': str(i)})\n"
+        "store.delete('7')\n"
+    )
+    subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=dict(os.environ, PYTHONPATH=ROOT_DIR), check=True)
+
+    store = TicketStore(tmp_path / "ticket_data.json", tmp_path / "ticket_data.journal")
+    assert len(store.data) == 199 and "7" not in store.data
+
+
+def test_changes_after_close_are_still_journaled(tmp_path):
+    store = TicketStore(tmp_path / "ticket_data.json", tmp_path / "ticket_data.journal")
+    store.set("1", {"opener_id": "1"})
+    store.close()
+    store.set("2", {"opener_id": "2"})
+    store.delete("1")
+    store.close()
+
+    reloaded = TicketStore(tmp_path / "ticket_data.json", tmp_path / "ticket_data.journal")
+    assert reloaded.data == {"2": {"opener_id": "2"}}
+
+
+def test_journal_is_replayed_over_snapshot(tmp_path):
+    store = TicketStore(tmp_path / "ticket_data.json", tmp_path / "ticket_data.journal")
+    store.set("1", {"opener_id": "1"})
+    store.set("2", {"opener_id": "2"})
+    store.set("1", {"opener_id": "1", "handler_ids": ["9"]})
+    store.delete("2")
+    store.close()
+
+    reloaded = TicketStore(tmp_path / "ticket_data.json", tmp_path / "ticket_data.journal")
+    assert reloaded.data == {"1": {"opener_id": "1", "handler_ids": ["9"]}}
+
+
+def test_torn_journal_tail_is_discarded(tmp_path):
+    journal = tmp_path / "ticket_data.journal"
+    store = TicketStore(tmp_path / "ticket_data.json", journal)
+    store.set("1", {"opener_id": "1"})
+    store.close()
+    with open(journal, "ab") as f:
+        f.write(b'{"op": "set", "id": "2", "da')  # 書き込み途中で落ちた行
+
+    reloaded = TicketStore(tmp_path / "ticket_data.json", journal)
+    assert reloaded.data == {"1": {"opener_id": "1"}}
+    assert journal.read_bytes().endswith(b"\n")
+    reloaded.set("3", {"opener_id": "3"})
+    reloaded.close()
+    assert set(TicketStore(tmp_path / "ticket_data.json", journal).data) == {"1", "3"}
+
+
+def test_snapshot_rotation_empties_the_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(ticket_store, "SNAPSHOT_EVERY", 5)
+    journal = tmp_path / "ticket_data.journal"
+    store = TicketStore(tmp_path / "ticket_data.json", journal)
+    for i in range(5):
+        store.set(str(i), {"opener_id": str(i)})
+    store.flush()
+    store.delete("0")
+    store.close()
+
+    assert journal.read_bytes().count(b"\n") == 1
+    reloaded = TicketStore(tmp_path / "ticket_data.json", journal)
+    assert set(reloaded.data) == {"1", "2", "3", "4"}
@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace
+
+from cogs import vm_alerts
+from cogs.vm_alerts import StockAlertDispatcher, subscription_store
+
+
+def test_restock_during_flush_is_delivered(monkeypatch):
+    monkeypatch.setattr(vm_alerts, "RESTOCK_BATCH_WINDOW", 0.01)
+    monkeypatch.setattr(vm_alerts, "DM_BATCH_SIZE", 1)
+    monkeypatch.setattr(vm_alerts, "DM_BATCH_INTERVAL", 0.01)
+    vm = SimpleNamespace(vm_id="alert-test", name="alerttest", guild_id=1, products={"A": {}, "B": {}})
+    dispatcher = StockAlertDispatcher()
+    sent = []
+
+    async def submit(job):
+        sent.append(job["user_id"])
+        if len(sent) == 1:
+            # 1通目の送信中 (まだ DM_BATCH_INTERVAL の待ちが残っている) に別の商品が入荷する
+            dispatcher.on_stock_event("restocked", vm, "B", 1)
+
+    monkeypatch.setattr(vm_alerts.purchase_pipeline, "submit", submit)
+
+    async def run():
+        subscription_store.subscribe(vm.vm_id, "A", 1)
+        subscription_store.subscribe(vm.vm_id, "A", 2)
+        subscription_store.subscribe(vm.vm_id, "B", 3)
+        dispatcher.on_stock_event("restocked", vm, "A", 1)
+        while dispatcher._flush_task is not None and not dispatcher._flush_task.done():
+            await asyncio.sleep(0.01)
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert sorted(sent) == ["1", "2", "3"]
@@ -0,0 +1,28 @@
+import asyncio
+
+from cogs.vm_management import VendingMachine, inventory_pools
+
+
+def _product(pool_id=None):
+    product = {"price": 100, "description": "", "stock_count": 0, "infinite_stock": False, "infinite_item": ""}
+    if pool_id:
+        product["pool_id"] = pool_id
+    return product
+
+
+def test_cart_over_shared_pool_is_all_or_nothing():
+    # 2商品が同じ共有在庫プール (在庫3) を参照している場合、合計4個のまとめ買いは成立しない
+    pool_id = inventory_pools.create(1, "cart-shared")
+    vm = VendingMachine("cart-test", "carttest", 1)
+    vm.products["A"] = _product(pool_id)
+    vm.products["B"] = _product(pool_id)
+    vm.save_vm()
+    inventory_pools.add_stock(pool_id, ["x1", "x2", "x3"])
+
+    result, duplicate = asyncio.run(vm.purchase_cart({"A": 2, "B": 2}, interaction_id=1))
+    assert result is None and not duplicate
+    assert inventory_pools.remaining(pool_id) == 3
+
+    result, _ = asyncio.run(vm.purchase_cart({"A": 2, "B": 1}, interaction_id=2))
+    assert result == {"A": ["x1", "x2"], "B": ["x3"]}
+    assert inventory_pools.remaining(pool_id) == 0
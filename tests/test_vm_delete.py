@@ -0,0 +1,19 @@
+import os
+
+from cogs import vm_stock
+from cogs.vm_management import VendingMachine
+
+
+def test_delete_vm_closes_unsold_ledgers():
+    vm = VendingMachine("delete-test", "deletetest", 1)
+    vm.products["A"] = {"price": 100, "description": "", "stock_count": 0, "infinite_stock": False, "infinite_item": ""}
+    vm.save_vm()
+    vm.add_stock("A", ["x1", "x2"])  # 未販売なのでカーソルファイルはない
+    stock_dir = VendingMachine._get_stock_dir(vm.vm_id)
+    key = os.path.join(stock_dir, vm.products["A"]["stock_id"])
+    ledger = vm_stock._ledgers[key]
+
+    VendingMachine.delete_vm(vm.vm_id)
+    assert key not in vm_stock._ledgers
+    assert ledger._fh.closed
+    assert not os.path.exists(stock_dir)
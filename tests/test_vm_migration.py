@@ -0,0 +1,40 @@
+import copy
+
+from cogs.vm_management import VendingMachine, SCHEMA_VERSION
+
+
+def _legacy_data(vm_id, stock):
+    return {
+        "schema_version": SCHEMA_VERSION,
+        "name": vm_id,
+        "vm_id": vm_id,
+        "guild_id": 1,
+        "products": {
+            "A": {"price": 100, "description": "", "infinite_stock": False, "infinite_item": "", "stock": stock},
+        },
+        "panels": [],
+    }
+
+
+def test_inline_stock_migration_keeps_identical_units():
+    vm = VendingMachine.from_dict(_legacy_data("migrate-dup", ["code", "code", "other"]))
+    assert "stock" not in vm.products["A"]
+    assert "stock_migration" not in vm.products["A"]
+    assert vm.stock_count("A") == 3
+
+
+def test_interrupted_inline_stock_migration_is_not_doubled():
+    for appended in (["code", "code", "other"], ["code"]):
+        vm_id = f"migrate-crash-{len(appended)}"
+        data = _legacy_data(vm_id, ["code", "code", "other"])
+        # 追記前の位置を保存した後、VM の保存前 (または追記の途中) で落ちた状態を再現する
+        vm = VendingMachine(vm_id, vm_id, 1)
+        vm.products = copy.deepcopy(data["products"])
+        ledger = vm._ledger("A")
+        vm.products["A"]["stock_migration"] = {"generation": ledger.generation, "offset": ledger.log_size()}
+        ledger.append(appended)
+        data["products"] = copy.deepcopy(vm.products)
+
+        vm = VendingMachine.from_dict(data)
+        assert vm.stock_count("A") == 3
+        assert "stock" not in vm.products["A"]
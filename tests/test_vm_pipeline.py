@@ -0,0 +1,53 @@
+import asyncio
+import json
+import os
+
+from cogs import vm_pipeline
+from cogs.vm_pipeline import PostPurchasePipeline
+
+
+def _use_spool(monkeypatch, tmp_path):
+    monkeypatch.setattr(vm_pipeline, "SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(vm_pipeline, "DEAD_LETTER_FILE", str(tmp_path / "dead_letter.jsonl"))
+    monkeypatch.setattr(vm_pipeline, "REPLAY_FILE", str(tmp_path / "dead_letter.replaying.jsonl"))
+
+
+def test_interrupted_replay_keeps_dead_letters(monkeypatch, tmp_path):
+    _use_spool(monkeypatch, tmp_path)
+    jobs = [{"type": "dm", "user_id": i, "content": f"job {i}"} for i in range(3)]
+    with open(vm_pipeline.DEAD_LETTER_FILE, "w", encoding="utf-8") as f:
+        for job in jobs:
+            f.write(json.dumps(job) + "\n")
+
+    delivered = []
+
+    async def stuck(self, job):
+        if job["user_id"] == 1:
+            await asyncio.Event().wait()  # 処理中に停止される
+        delivered.append(job["user_id"])
+
+    async def interrupted():
+        pipeline = PostPurchasePipeline()
+        await pipeline.start(bot=None)
+        await asyncio.sleep(0.05)
+        await pipeline.stop()
+
+    monkeypatch.setattr(PostPurchasePipeline, "_run", stuck)
+    asyncio.run(interrupted())
+    assert not os.path.exists(vm_pipeline.DEAD_LETTER_FILE)
+    assert os.path.exists(vm_pipeline.REPLAY_FILE)
+
+    async def ok(self, job):
+        delivered.append(job["user_id"])
+
+    async def resumed():
+        pipeline = PostPurchasePipeline()
+        await pipeline.start(bot=None)
+        await pipeline.drain()
+        await pipeline.stop()
+
+    delivered.clear()
+    monkeypatch.setattr(PostPurchasePipeline, "_run", ok)
+    asyncio.run(resumed())
+    assert sorted(delivered) == [0, 1, 2]
+    assert not os.path.exists(vm_pipeline.REPLAY_FILE)
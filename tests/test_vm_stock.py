@@ -0,0 +1,157 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from cogs import vm_stock
+from cogs.vm_management import VendingMachine
+from cogs.vm_stock import StockLedger, AliasTable
+
+
+def _product():
+    return {"price": 100, "description": "", "stock_count": 0, "infinite_stock": False, "infinite_item": ""}
+
+
+def test_purchase_syncs_cursor_off_the_event_loop(monkeypatch):
+    vm = VendingMachine("sync-test", "synctest", 1)
+    vm.products["A"] = _product()
+    vm.save_vm()
+    vm.add_stock("A", [f"x{i}" for i in range(20)])
+    ledger = vm._ledger("A")
+
+    fsync_threads = []
+    real_fsync = vm_stock.os.fsync
+
+    def fsync(fd):
+        fsync_threads.append(threading.get_ident())
+        real_fsync(fd)
+
+    monkeypatch.setattr(vm_stock.os, "fsync", fsync)
+
+    async def run():
+        loop_thread = threading.get_ident()
+        results = await asyncio.gather(*(vm.purchase("A", interaction_id=1000 + i) for i in range(10)))
+        return loop_thread, results
+
+    loop_thread, results = asyncio.run(run())
+    assert sorted(item for item, _ in results) == sorted(f"x{i}" for i in range(10))
+    # 払い出しはすべて確定済みで、fsync はイベントループのスレッドでは行われていない
+    assert ledger._synced_seq == ledger.cursor_seq
+    assert fsync_threads and loop_thread not in fsync_threads
+
+
+def _reopen(ledger: StockLedger) -> StockLedger:
+    """プロセスの再起動を模して、同じファイルから台帳を開き直す"""
+    ledger.close()
+    return StockLedger(ledger.stock_dir, ledger.stock_id)
+
+
+def _wait_compaction(ledger: StockLedger):
+    deadline = time.monotonic() + 5
+    while ledger._compacting and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not ledger._compacting
+
+
+def test_cursor_survives_reopen(tmp_path):
+    ledger = StockLedger(str(tmp_path), "s")
+    ledger.append([f"x{i}" for i in range(5)])
+    assert ledger.consume() == "x0"
+    assert ledger.consume_many(2) == ["x1", "x2"]
+    ledger.sync()
+
+    ledger = _reopen(ledger)
+    assert ledger.remaining == 2
+    assert ledger.consume_many(5) == ["x3", "x4"]
+    assert ledger.consume() is None
+    ledger.close()
+
+
+def test_torn_log_tail_is_discarded(tmp_path):
+    ledger = StockLedger(str(tmp_path), "s")
+    ledger.append(["a", "b"])
+    ledger.close()
+    with open(ledger._log_path(0), "ab") as f:
+        f.write(b'"c')  # 書き込み途中で落ちた行
+
+    ledger = StockLedger(str(tmp_path), "s")
+    assert ledger.remaining == 2
+    ledger.append(["d"])
+    assert ledger.consume_many(5) == ["a", "b", "d"]
+    ledger.close()
+
+
+def test_compaction_switches_generation(tmp_path, monkeypatch):
+    monkeypatch.setattr(vm_stock, "COMPACT_MIN_BYTES", 0)
+    ledger = StockLedger(str(tmp_path), "s")
+    ledger.append([f"x{i}" for i in range(10)])
+    assert ledger.consume_many(6) == [f"x{i}" for i in range(6)]
+    _wait_compaction(ledger)
+    assert ledger.generation == 1
+    assert not os.path.exists(ledger._log_path(0))
+
+    ledger = _reopen(ledger)
+    assert (ledger.generation, ledger.remaining) == (1, 4)
+    assert ledger.consume_many(10) == ["x6", "x7", "x8", "x9"]
+    ledger.close()
+
+
+def test_crash_before_cursor_switch_keeps_old_generation(tmp_path):
+    # 新しい世代のログを書き終えたが、カーソルを切り替える前に落ちた
+    ledger = StockLedger(str(tmp_path), "s")
+    ledger.append(["a", "b", "c"])
+    assert ledger.consume() == "a"
+    ledger.close()
+    with open(ledger._log_path(1), "wb") as f:
+        f.write(b'"b"\n"c"\n')
+
+    ledger = StockLedger(str(tmp_path), "s")
+    assert (ledger.generation, ledger.remaining) == (0, 2)
+    assert not os.path.exists(ledger._log_path(1))
+    assert ledger.consume_many(5) == ["b", "c"]
+    ledger.close()
+
+
+def test_crash_after_cursor_switch_drops_old_generation(tmp_path, monkeypatch):
+    # カーソルを切り替えた後、古い世代のログを消す前に落ちた
+    monkeypatch.setattr(vm_stock, "COMPACT_MIN_BYTES", 0)
+    ledger = StockLedger(str(tmp_path), "s")
+    ledger.append(["a", "b", "c", "d"])
+    ledger.consume_many(3)
+    _wait_compaction(ledger)
+    ledger.close()
+    with open(ledger._log_path(0), "wb") as f:
+        f.write(b'"a"\n"b"\n"c"\n"d"\n')
+
+    ledger = StockLedger(str(tmp_path), "s")
+    assert (ledger.generation, ledger.remaining) == (1, 1)
+    assert not os.path.exists(ledger._log_path(0))
+    assert ledger.consume_many(5) == ["d"]
+    ledger.close()
+
+
+def test_append_unique_skips_unsold_duplicates(tmp_path):
+    ledger = StockLedger(str(tmp_path), "s")
+    ledger.append(["a", "b"])
+    assert ledger.append_unique(["a", "c", "c", "d"]) == (2, 2)
+    assert ledger.consume() == "a"
+    # 払い出し済みのアイテムは再び補充できる
+    assert ledger.append_unique(["a", "b"]) == (1, 1)
+
+    ledger = _reopen(ledger)
+    assert ledger.append_unique(["c", "e"]) == (1, 1)
+    assert ledger.consume_many(10) == ["b", "c", "d", "a", "e"]
+    ledger.close()
+
+
+def test_alias_table_follows_weights():
+    table = AliasTable({"common": 7, "rare": 2, "epic": 1, "never": 0})
+    rng = random.Random(0)
+    counts = Counter(table.sample(rng) for _ in range(20000))
+    assert "never" not in counts
+    for key, weight in (("common", 0.7), ("rare", 0.2), ("epic", 0.1)):
+        assert abs(counts[key] / 20000 - weight) < 0.02
+    assert AliasTable({"x": 0}).sample(rng) is None
+    assert not AliasTable({})
@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT_DIR
+
+
+# vm_stress は自販機・在庫プールのグローバルな状態を使うため、シナリオごとに別プロセスで実行する
+@pytest.mark.parametrize("args", [
+    ["--purchases", "300", "--seed", "1"],
+    ["--purchases", "300", "--seed", "1", "--pool", "--mode", "cart"],
+    ["--purchases", "300", "--seed", "1", "--shared-pool", "--mode", "cart"],
+])
+def test_stress_harness_has_no_violations(args, tmp_path):
+    env = dict(os.environ, PYTHONPATH=ROOT_DIR)
+    proc = subprocess.run(
+        [sys.executable, "-m", "tools.vm_stress", *args],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=300,
+    )
+    assert proc.returncode == 0, proc.stdout + proc.stderr
@@ -0,0 +1,308 @@
+# tools/vm_stress.py
+#
+# 自販機の購入処理の負荷試験・売り越しチェッカー。
+# Discord には接続せず、偽のインタラクションで handle_purchase / handle_cart_purchase を
+# 大量に同時実行し、スループット・応答レイテンシ (p50/p99) と
+# 「在庫アイテムはちょうど1回だけ払い出される」ことを検証する。
+# 同時に別スレッドからも同じ台帳を直接払い出し続け、購入処理の台帳読み出しには
+# ディスクI/O相当の遅延 (--io-delay) を入れて、在庫の確認から払い出しまでの間
+# (購入ロック内) に他スレッドが割り込めるようにする (--threads 0 で無効)。
+# 一時ディレクトリ内で動くため、既存の vm_config などには触れない。
+#
+#   python -m tools.vm_stress
+#   python -m tools.vm_stress --purchases 5000 --stock 3000 --concurrency 500 --mode mixed --pool
+#   python -m tools.vm_stress --mode cart --shared-pool   (全商品が1つの在庫プールを共有)
+#
+# 不変条件が破れた場合は終了コード 1 を返す。
+
+import os
+import re
+import sys
+import time
+import asyncio
+import random
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from typing import Optional, List, Dict, Any
+
+ITEM_PATTERN = re.compile(r"ITEM-[0-9A-Za-z]+-\d+")
+CART_REPLY_PATTERN = re.compile(r"✅ (\d+) 個の購入が完了しました")
+
+
+# =========================================================
+# 偽の Discord オブジェクト
+# =========================================================
+class FakeUser:
+    def __init__(self, bot: 'FakeBot', user_id: int):
+        self.bot = bot
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+
+    async def send(self, content: Optional[str] = None, file=None, **kwargs):
+        text = content or ""
+        if file is not None:
+            text += "\n" + file.fp.read().decode("utf-8")
+        self.bot.dms.append((self.id, text))
+
+
+class FakeBot:
+    """パイプラインが使う最小限のBot (DMは記録するだけ、通知チャンネルはなし)"""
+    def __init__(self):
+        self.dms: List[Any] = []
+        self.user = None
+
+    def get_user(self, user_id: int) -> FakeUser:
+        return FakeUser(self, user_id)
+
+    async def fetch_user(self, user_id: int) -> FakeUser:
+        return FakeUser(self, user_id)
+
+    def get_channel(self, channel_id: int):
+        return None
+
+    def get_guild(self, guild_id: int):
+        return None
+
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, content: Optional[str] = None, **kwargs):
+        pass
+
+
+class FakeFollowup:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self.interaction = interaction
+
+    async def send(self, content: Optional[str] = None, **kwargs):
+        if self.interaction.answered_at is None:
+            self.interaction.answered_at = time.perf_counter()
+        self.interaction.replies.append(content or "")
+
+
+class FakeInteraction:
+    def __init__(self, interaction_id: int, user_id: int, guild_id: int):
+        self.id = interaction_id
+        self.guild_id = guild_id
+        self.user = type("User", (), {"id": user_id})()
+        self.message = None
+        self.response = FakeResponse()
+        self.followup = FakeFollowup(self)
+        self.replies: List[str] = []
+        self.answered_at: Optional[float] = None
+
+
+# =========================================================
+# 負荷試験本体
+# =========================================================
+def _percentile(values: List[float], ratio: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+async def run(args) -> bool:
+    # 一時ディレクトリに移動してから読み込む (vm_config などはここに作られる)
+    from cogs.vm_management import VendingMachine, inventory_pools
+    from cogs.vm_pipeline import purchase_pipeline
+    from cogs.vm_sales import get_sales_ledger
+    from cogs.vending_machine import handle_purchase, handle_cart_purchase
+    from cogs.vm_stock import StockLedger
+
+    rng = random.Random(args.seed)
+    guild_id = 1
+    bot = FakeBot()
+    await purchase_pipeline.start(bot)
+
+    # 自販機と在庫の準備
+    use_pool = args.pool or args.shared_pool
+    vms = [VendingMachine(f"stress-{i}", f"stress{i}", guild_id) for i in range(2 if use_pool else 1)]
+    product_names = [f"P{i}" for i in range(args.products)]
+    stocked: Counter = Counter()
+    if args.shared_pool:
+        # 1つのプールを全商品で共有する (まとめ買いで同じプールを複数行から引く)
+        shared_id = inventory_pools.create(guild_id, "stress-shared")
+        pool_ids = {name: shared_id for name in product_names}
+    elif args.pool:
+        pool_ids = {name: inventory_pools.create(guild_id, f"stress-{name}") for name in product_names}
+    else:
+        pool_ids = {}
+    for vm in vms:
+        for name in product_names:
+            vm.products[name] = {
+                "price": 100,
+                "description": "stress",
+                "stock_count": 0,
+                "infinite_stock": False,
+                "infinite_item": ""
+            }
+            if use_pool:
+                vm.products[name]["pool_id"] = pool_ids[name]
+        vm.save_vm()
+    per_product = args.stock // args.products
+    for name in product_names:
+        items = [f"ITEM-{name}-{n}" for n in range(per_product)]
+        if use_pool:
+            inventory_pools.add_stock(pool_ids[name], items)
+        else:
+            vms[0].add_stock(name, items)
+        stocked.update(items)
+
+    # 購入リクエストの生成 (一部は同じインタラクションの再送)
+    requests = []
+    for n in range(args.purchases):
+        interaction = FakeInteraction(10_000 + n, 1_000 + rng.randrange(args.buyers), guild_id)
+        vm = rng.choice(vms)
+        cart_mode = args.mode == "cart" or (args.mode == "mixed" and rng.random() < 0.3)
+        if cart_mode:
+            picks = rng.sample(product_names, min(len(product_names), rng.randint(1, 3)))
+            payload = {name: rng.randint(1, 5) for name in picks}
+        else:
+            payload = rng.choice(product_names)
+        requests.append((interaction, vm.vm_id, payload))
+        if rng.random() < args.duplicate_rate:
+            requests.append((interaction, vm.vm_id, payload))
+    rng.shuffle(requests)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+
+    async def one(interaction: FakeInteraction, vm_id: str, payload):
+        async with semaphore:
+            started = time.perf_counter()
+            if isinstance(payload, dict):
+                await handle_cart_purchase(interaction, vm_id, payload)
+            else:
+                await handle_purchase(interaction, vm_id, payload)
+            latencies.append((interaction.answered_at or time.perf_counter()) - started)
+
+    # 別スレッドから台帳を直接払い出す競合相手。購入処理側の払い出しは遅延させ、
+    # その間 (GILを手放している間) に競合スレッドが動けるようにする
+    ledgers = list({id(ledger): ledger for ledger in (vms[0]._ledger(name) for name in product_names)}.values())
+    stop = threading.Event()
+    taken_by_threads: List[str] = []
+
+    def compete(seed: int):
+        thread_rng = random.Random(seed)
+        taken = []
+        while not stop.is_set():
+            taken.extend(thread_rng.choice(ledgers).consume_many(thread_rng.randint(1, 2)))
+            time.sleep(0.001)
+        taken_by_threads.extend(taken)
+
+    loop_thread = threading.get_ident()
+    consume_many = StockLedger.consume_many
+
+    def slow_consume_many(ledger, count: int) -> List[str]:
+        if threading.get_ident() == loop_thread:
+            time.sleep(args.io_delay / 1000)
+        return consume_many(ledger, count)
+
+    threads = [threading.Thread(target=compete, args=(rng.random(),)) for _ in range(args.threads)]
+    if threads:
+        StockLedger.consume_many = slow_consume_many
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(*request) for request in requests))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        StockLedger.consume_many = consume_many
+    elapsed = time.perf_counter() - started
+    await purchase_pipeline.drain()
+    await purchase_pipeline.stop()
+
+    # 集計と不変条件の検証
+    purchased: Counter = Counter()
+    for _, text in bot.dms:
+        purchased.update(ITEM_PATTERN.findall(text))
+    delivered = purchased + Counter(taken_by_threads)
+    interactions = {id(request[0]): request[0] for request in requests}.values()
+    succeeded = sum(1 for i in interactions if any(r.startswith("✅") for r in i.replies))
+    sold_out = sum(1 for i in interactions if any(r.startswith("❌") for r in i.replies))
+    duplicates = sum(1 for i in interactions for r in i.replies if r.startswith("⚠️"))
+    # 共有プールを二重に数えないよう、台帳ごとに1回だけ数える
+    remaining = sum({id(ledger): ledger.remaining for ledger in (vms[0]._ledger(name) for name in product_names)}.values())
+
+    errors = []
+    repeated = [item for item, count in delivered.items() if count > 1]
+    if repeated:
+        errors.append(f"{len(repeated)} 件のアイテムが複数回払い出されました (例: {repeated[:3]})")
+    unknown = [item for item in delivered if item not in stocked]
+    if unknown:
+        errors.append(f"在庫にないアイテムが {len(unknown)} 件払い出されました (例: {unknown[:3]})")
+    if sum(delivered.values()) + remaining != sum(stocked.values()):
+        errors.append(
+            f"払い出し {sum(delivered.values())} 件 + 残り在庫 {remaining} 件 が "
+            f"補充した {sum(stocked.values())} 件と一致しません"
+        )
+    recorded = sum(get_sales_ledger(vm.vm_id).total_units for vm in vms)
+    if recorded != sum(purchased.values()):
+        errors.append(f"売上台帳の販売数 {recorded} 件が購入での払い出し {sum(purchased.values())} 件と一致しません")
+    # まとめ買いは全数が揃った場合のみ成立する (一部だけ払い出して成立扱いにしない)
+    partial = []
+    for interaction, _, payload in requests:
+        if not isinstance(payload, dict):
+            continue
+        for reply in interaction.replies:
+            match = CART_REPLY_PATTERN.match(reply)
+            if match and int(match.group(1)) != sum(payload.values()):
+                partial.append((payload, reply.splitlines()[0]))
+    if partial:
+        errors.append(f"まとめ買いで希望数と異なる個数のまま成立した購入が {len(partial)} 件ありました (例: {partial[:1]})")
+    unexpected = [r for i in interactions for r in i.replies if r.startswith("❌") and "在庫" not in r]
+    if unexpected:
+        errors.append(f"在庫切れ以外のエラー応答が {len(unexpected)} 件ありました (例: {unexpected[:1]})")
+
+    print("=== 自販機 購入負荷試験 ===")
+    pool_label = " (全商品で1つの共有在庫プール)" if args.shared_pool else " (共有在庫プール)" if args.pool else ""
+    print(f"モード: {args.mode} / 自販機: {len(vms)} 台{pool_label} / 商品: {args.products} / 同時実行: {args.concurrency}")
+    print(f"リクエスト: {len(requests):,} 件 (うち再送 {len(requests) - args.purchases:,} 件) / 所要時間: {elapsed:.2f} 秒")
+    print(f"スループット: {len(requests) / elapsed:,.0f} req/s")
+    print(f"応答レイテンシ: p50 {_percentile(latencies, 0.50) * 1000:.2f} ms / p99 {_percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"成立: {succeeded:,} 件 / 在庫切れ: {sold_out:,} 件 / 重複検出: {duplicates:,} 件")
+    print(f"払い出し: {sum(delivered.values()):,} 個 (うち競合スレッド {len(taken_by_threads):,} 個) / 残り在庫: {remaining:,} 個 / 補充: {sum(stocked.values()):,} 個")
+    if errors:
+        for error in errors:
+            print(f"ERROR: {error}")
+        return False
+    print("✅ 不変条件OK: すべての在庫アイテムはちょうど1回だけ払い出されました。")
+    return True
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="自販機の購入処理の負荷試験と売り越しチェックを行います。")
+    parser.add_argument("--purchases", type=int, default=2000, help="購入リクエスト数 (再送を除く)")
+    parser.add_argument("--stock", type=int, default=1500, help="補充する在庫の総数")
+    parser.add_argument("--products", type=int, default=5, help="商品数")
+    parser.add_argument("--buyers", type=int, default=300, help="購入者の人数")
+    parser.add_argument("--concurrency", type=int, default=300, help="同時に処理するインタラクション数")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="同じインタラクションを再送する割合")
+    parser.add_argument("--mode", choices=["single", "cart", "mixed"], default="mixed", help="単品購入 / まとめ買い / 混在")
+    parser.add_argument("--pool", action="store_true", help="2台の自販機で共有在庫プールを使う")
+    parser.add_argument("--shared-pool", action="store_true", help="2台の自販機の全商品で1つの共有在庫プールを使う")
+    parser.add_argument("--threads", type=int, default=2, help="台帳を直接払い出して購入処理と競合させるスレッド数")
+    parser.add_argument("--io-delay", type=float, default=0.5, help="競合スレッドがあるとき、購入処理の払い出しに入れる遅延 (ミリ秒)")
+    parser.add_argument("--seed", type=int, default=None, help="乱数シード")
+    args = parser.parse_args(argv)
+
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="vm_stress_") as work_dir:
+        os.chdir(work_dir)
+        try:
+            ok = asyncio.run(run(args))
+        finally:
+            os.chdir(original_dir)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())